@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+'''
+Approximate maximum inner product search (MIPS) over ALS item factors with an IVF index
+
+Exact top-k scores every item for every user (O(items x rank) per user, see scoring.py).
+The IVF index scores only the items of a few clusters per user.
+
+Reduction of MIPS to nearest neighbour search: with M the largest item norm, items are
+augmented to [v, sqrt(M^2 - |v|^2)] and queries to [q, 0]. All augmented items have norm M,
+so |q' - v'|^2 = |q|^2 + M^2 - 2 q.v and the nearest items are the highest inner products.
+
+Index:
+    centroids - nlist k-means centroids of the augmented items
+    list_offsets, list_items - inverted lists: the items of list l are
+                               list_items[list_offsets[l]:list_offsets[l+1]]
+    item_factors, item_ids - the original (not augmented) factors used for exact re-scoring
+
+A query scores the centroids, probes its nprobe nearest lists and ranks their items by
+exact inner product. Raising nprobe (or lowering nlist) trades latency for recall;
+recall_at_k measures it against exact top-k.
+'''
+
+import numpy as np
+
+# size budget (in float32 elements) of one block of point-centroid distances
+DISTANCE_ELEMENTS = 1 << 25
+
+
+def augment_items(item_factors):
+    '''
+    Returns items augmented with sqrt(M^2 - |v|^2) (see module docstring)
+    '''
+    norms = (item_factors.astype(np.float64)**2).sum(axis=1)
+    extra = np.sqrt(np.maximum(norms.max() - norms, 0)).astype(np.float32)
+    return np.hstack([item_factors, extra[:, None]])
+
+def nearest_centroids(points, centroids, n=1):
+    '''
+    Returns indices (len(points) x n) of the n nearest centroids of every point
+    '''
+    c_norms = (centroids**2).sum(axis=1)
+    rows = max(1, DISTANCE_ELEMENTS // len(centroids))
+    nearest = np.empty((len(points), n), dtype=np.int64)
+    for start in range(0, len(points), rows):
+        # |p - c|^2 up to the constant |p|^2
+        d = c_norms[None, :] - 2 * points[start:start + rows] @ centroids.T
+        if n==1:
+            nearest[start:start + rows, 0] = d.argmin(axis=1)
+        else:
+            part = np.argpartition(d, n - 1, axis=1)[:, :n]
+            order = np.argsort(np.take_along_axis(d, part, axis=1), axis=1)
+            nearest[start:start + rows] = np.take_along_axis(part, order, axis=1)
+    return nearest
+
+def kmeans(points, nlist, n_iter=10, sample=None, seed=42):
+    '''
+    Returns nlist x dim centroids from Lloyd's k-means on (a random sample of) points
+    Empty clusters are restarted at random points
+    '''
+    rng = np.random.RandomState(seed)
+    if sample is not None and sample < len(points):
+        points = points[rng.choice(len(points), sample, replace=False)]
+
+    centroids = points[rng.choice(len(points), nlist, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = nearest_centroids(points, centroids)[:, 0]
+        counts = np.bincount(assign, minlength=nlist)
+        sums = np.zeros_like(centroids, dtype=np.float64)
+        np.add.at(sums, assign, points)
+        empty = counts==0
+        centroids[~empty] = (sums[~empty] / counts[~empty, None]).astype(np.float32)
+        centroids[empty] = points[rng.choice(len(points), empty.sum())]
+    return centroids
+
+def build_index(item_factors, item_ids=None, nlist=None, n_iter=10, seed=42):
+    '''
+    Returns IVF index dict over item_factors (see module docstring)
+
+    item_factors: n_items x rank float32 array
+    item_ids: original book id of each row (row numbers if None)
+    nlist: number of inverted lists (4 sqrt(n_items) if None)
+    n_iter: k-means iterations (k-means is trained on at most 64 points per list)
+    '''
+    item_factors = np.ascontiguousarray(item_factors, dtype=np.float32)
+    n_items = item_factors.shape[0]
+    if nlist is None:
+        nlist = int(4 * np.sqrt(n_items))
+    nlist = max(1, min(nlist, n_items))
+
+    augmented = augment_items(item_factors)
+    centroids = kmeans(augmented, nlist, n_iter=n_iter, sample=64*nlist, seed=seed)
+    assign = nearest_centroids(augmented, centroids)[:, 0]
+
+    list_items = np.argsort(assign, kind='stable')
+    list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assign, minlength=nlist), out=list_offsets[1:])
+
+    return {'centroids': centroids, 'list_offsets': list_offsets, 'list_items': list_items,
+            'item_factors': item_factors,
+            'item_ids': np.arange(n_items) if item_ids is None else np.asarray(item_ids)}
+
+def search(index, queries, k=500, nprobe=8, exclude=None):
+    '''
+    Returns item indices (n x k) and scores (n x k) of the approximate top k items of
+    every query, highest score first (-1 and -inf pad rows with fewer than k candidates)
+
+    queries: n x rank user factors
+    nprobe: number of inverted lists scanned per query
+    exclude: optional seen items of each query, dict with indptr and indices of item rows
+             (see scoring.seen_items)
+    '''
+    queries = np.asarray(queries, dtype=np.float32)
+    centroids = index['centroids']
+    nprobe = min(nprobe, len(centroids))
+
+    probes = _probe(queries, centroids, nprobe)
+
+    top = np.full((len(queries), k), -1, dtype=np.int64)
+    scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    offsets, items, factors = index['list_offsets'], index['list_items'], index['item_factors']
+
+    for i, q in enumerate(queries):
+        candidates = np.concatenate([items[offsets[l]:offsets[l + 1]] for l in probes[i]])
+        if exclude is not None:
+            seen = exclude['indices'][exclude['indptr'][i]:exclude['indptr'][i + 1]]
+            candidates = candidates[~np.isin(candidates, seen)]
+        s = factors[candidates] @ q
+        n = min(k, len(candidates))
+        if n==0:
+            continue
+        part = np.argpartition(-s, n - 1)[:n]
+        order = np.argsort(-s[part], kind='stable')
+        top[i, :n] = candidates[part[order]]
+        scores[i, :n] = s[part[order]]
+    return top, scores
+
+def _probe(queries, centroids, nprobe):
+    '''
+    Returns the nprobe lists nearest to each [query, 0] in the augmented space
+    '''
+    padded = np.hstack([queries, np.zeros((len(queries), 1), dtype=np.float32)])
+    return nearest_centroids(padded, centroids, nprobe)
+
+def recall_at_k(index, user_factors, k=500, nprobe=8, sample=1000, seed=42):
+    '''
+    Returns mean recall@k of search against exact top k (scoring.topk)
+    on a random sample of rows of user_factors, and the search time per query in ms
+    '''
+    from time import time
+    from scoring import topk
+
+    rng = np.random.RandomState(seed)
+    rows = rng.choice(len(user_factors), min(sample, len(user_factors)), replace=False)
+    queries = user_factors[rows]
+
+    exact, _ = topk(queries, index['item_factors'], k)
+    start = time()
+    approx, _ = search(index, queries, k, nprobe)
+    ms = 1000 * (time() - start) / len(queries)
+
+    hits = [len(np.intersect1d(e, a[a >= 0])) for e, a in zip(exact, approx)]
+    return float(np.mean(hits)) / exact.shape[1], ms
+
+def recommend_ann(spark, model, user_ids, k=500, nlist=None, nprobe=8, user_col='user_id', item_col='book_id',
+                  seen=None):
+    '''
+    Returns approximate top k recommendations of an ALSModel for the users in user_ids,
+    with the schema of model.recommendForUserSubset
+
+    The index is built on the driver from the item factors; the user factors of
+    user_ids are collected and searched on the driver.
+
+    seen: optional df with user_col and item_col (e.g. train), or its prebuilt lists of id and
+          seen (modeling.seen_books); each user's books in it are excluded from their top k
+    '''
+    import pyspark.sql.functions as F
+    from scoring import factors_to_numpy, as_seen_lists, seen_to_positions
+    from numpy_als import recs_to_df
+
+    item_ids, item_factors = factors_to_numpy(model.itemFactors)
+    index = build_index(item_factors, item_ids, nlist=nlist)
+
+    subset = model.userFactors.join(F.broadcast(user_ids.select(F.col(user_col).alias('id')).distinct()), 'id')
+    exclude = None
+    if seen is not None:
+        rows = subset.join(as_seen_lists(seen, user_col, item_col), 'id', 'left').orderBy('id').collect()
+        users = np.array([row.id for row in rows], dtype=np.int32)
+        user_factors = np.array([row.features for row in rows], dtype=np.float32)
+        indptr, indices = seen_to_positions([row.seen or [] for row in rows], item_ids)
+        exclude = {'indptr': indptr, 'indices': indices}
+    else:
+        users, user_factors = factors_to_numpy(subset)
+
+    top, scores = search(index, user_factors, k, nprobe, exclude)
+    recs = recs_to_df(spark, users, index['item_ids'][np.maximum(top, 0)], scores, valid=top >= 0)
+    if user_col!='user_id' or item_col!='book_id':
+        recs = recs.select(F.col('user_id').alias(user_col),
+                           F.expr('transform(recommendations, r -> named_struct("{}", r.book_id, "rating", r.rating))'.format(item_col))
+                                .alias('recommendations'))
+    return recs
+
+def benchmark_ann(user_factors, item_factors, fraction, rank, k=500, nlists=[None], nprobes=[1, 2, 4, 8, 16, 32]):
+    '''
+    Measures recall@k and per-query latency of the IVF index for several nlist/nprobe settings
+    Appends the results to ann_benchmark.txt
+
+    The exact time per query is from batched scoring.topk over 1000 users.
+    '''
+    from time import localtime, strftime, time
+    from scoring import topk
+
+    start = time()
+    topk(user_factors[:1000], item_factors, k)
+    exact_ms = 1000 * (time() - start) / min(1000, len(user_factors))
+
+    for nlist in nlists:
+        start = time()
+        index = build_index(item_factors, nlist=nlist)
+        build_time = time() - start
+        for nprobe in nprobes:
+            recall, ms = recall_at_k(index, user_factors, k, nprobe)
+            line = '{}: {}% rank={} k={} nlist={} nprobe={}: recall@k={:.4f}, {:.2f} ms/query (exact {:.2f} ms/query, build {:.1f}s)'\
+                        .format(strftime("%Y-%m-%d %H:%M:%S", localtime()), int(fraction*100), rank, k,
+                                len(index['centroids']), nprobe, recall, ms, exact_ms, build_time)
+            print(line)
+            f = open("ann_benchmark.txt", "a")
+            f.write(line + '\n')
+            f.close()
+    return
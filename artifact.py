@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+'''
+Memory-mappable export of ALS factors for single-node consumers (serve, foldin, refresh, ann)
+
+Layout of an artifact directory:
+    header.json - format, rank, lambda, fraction, implicit, alpha, dtype, n_users, n_items,
+                  training_fingerprint (split_cache fingerprint of the splits the
+                  model was fit on, given by the caller; None if unknown), created
+    user_ids.npy - original user_id of each user factor row (int32, sorted)
+    book_ids.npy - original book_id of each item factor row (int32, sorted)
+    user_factors.npy - n_users x rank, float32 or float16, C-contiguous
+    item_factors.npy - n_items x rank, float32 or float16, C-contiguous
+
+Every array is a plain .npy file, so load_artifact opens them with mmap_mode='r':
+no Spark session, no copies, and pages are read only when they are touched.
+An ALSModel saved by get_recs needs a Spark job to read its factor dfs;
+export_als_model converts it once. ensure_artifact exports it again when the
+artifact's training_fingerprint no longer matches the model's.
+
+Artifacts are written under a temporary name and renamed into place, so a directory
+at an artifact path is always complete. They live next to the models when the output
+root is local, otherwise in the local directory GOODREADS_ARTIFACTS (default: artifacts).
+'''
+
+import os
+import json
+import numpy as np
+
+FORMAT = 1
+
+
+def artifact_root():
+    '''
+    Returns the local directory artifacts are written to
+    '''
+    from storage import get_root, is_local, local_path
+    if is_local(get_root()):
+        return local_path(get_root())
+    return os.environ.get('GOODREADS_ARTIFACTS', 'artifacts')
+
+def artifact_path(model_path):
+    '''
+    Returns local artifact directory for the ALSModel (or numpy model) at model_path
+    '''
+    return os.path.join(artifact_root(), os.path.basename(model_path.rstrip('/')) + '_factors')
+
+def save_artifact(model, path, fraction, lamb=None, fingerprint=None, dtype=np.float32):
+    '''
+    Writes the factors of a model dict as an artifact at path (see module docstring)
+    Returns path
+
+    model: model dict with user/item factors and ids (numpy_als.fit, refresh.refresh_model)
+    fraction: downsample fraction of the training data
+    lamb: regularization parameter (the model's reg if None)
+    fingerprint: split_cache.training_fingerprint of the splits the model was fit on
+    dtype: np.float32 or np.float16 factors
+    '''
+    from shutil import rmtree
+    from time import localtime, strftime
+
+    assert np.dtype(dtype) in [np.dtype(np.float32), np.dtype(np.float16)], 'dtype must be float32 or float16'
+    lamb = model.get('reg') if lamb is None else lamb
+
+    tmp_path = path.rstrip('/') + '_writing'
+    if os.path.isdir(tmp_path):
+        rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    for name, array, array_dtype in [('user_ids', model['user_ids'], np.int32),
+                                     ('book_ids', model['book_ids'], np.int32),
+                                     ('user_factors', model['user_factors'], dtype),
+                                     ('item_factors', model['item_factors'], dtype)]:
+        np.save(os.path.join(tmp_path, name + '.npy'), np.ascontiguousarray(array, dtype=array_dtype))
+
+    header = {'format': FORMAT,
+              'rank': int(model['item_factors'].shape[1]),
+              'lambda': lamb,
+              'fraction': fraction,
+              'implicit': bool(model.get('implicit', False)),
+              'alpha': model.get('alpha', 1.0),
+              'dtype': np.dtype(dtype).name,
+              'n_users': int(len(model['user_ids'])),
+              'n_items': int(len(model['book_ids'])),
+              'training_fingerprint': fingerprint,
+              'created': strftime("%Y-%m-%d %H:%M:%S", localtime())}
+    with open(os.path.join(tmp_path, 'header.json'), 'w') as f:
+        json.dump(header, f)
+
+    if os.path.isdir(path):
+        rmtree(path)
+    os.rename(tmp_path, path)
+    print('Wrote {} ({} users, {} books, rank {}, {})'.format(path, header['n_users'], header['n_items'],
+                                                               header['rank'], header['dtype']))
+    return path
+
+def read_header(path):
+    '''
+    Returns header dict of the artifact at path, None if there is none
+    '''
+    header_path = os.path.join(path, 'header.json')
+    if not os.path.isfile(header_path):
+        return None
+    with open(header_path) as f:
+        return json.load(f)
+
+def load_artifact(path, mmap=True, dtype=None):
+    '''
+    Opens an artifact without Spark
+    Returns model dict (user_ids, user_factors, book_ids, item_factors, rank, reg, implicit, alpha)
+    plus fraction, training_fingerprint and dtype from the header
+
+    mmap: boolean option to memory-map the arrays (mmap_mode='r') instead of reading them
+    dtype: optional factor dtype to convert to (e.g. 'float32' for float16 artifacts
+           that are scored often); float16 factors are then copied into memory,
+           float32 ones stay memory-mapped
+    '''
+    header = read_header(path)
+    assert header is not None, 'No artifact at {}'.format(path)
+    assert header['format']==FORMAT, 'Unknown artifact format {}'.format(header['format'])
+
+    mode = 'r' if mmap else None
+    model = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mode)
+                for name in ['user_ids', 'book_ids', 'user_factors', 'item_factors']}
+    if dtype is not None and np.dtype(dtype)!=model['item_factors'].dtype:
+        model['user_factors'] = model['user_factors'].astype(dtype)
+        model['item_factors'] = model['item_factors'].astype(dtype)
+
+    model.update({'rank': header['rank'], 'reg': header['lambda'], 'implicit': header['implicit'],
+                  'alpha': header['alpha'], 'fraction': header['fraction'],
+                  'training_fingerprint': header['training_fingerprint'], 'dtype': header['dtype']})
+    return model
+
+def export_als_model(spark, model, path, fraction, lamb, implicit=False, alpha=1.0, fingerprint=None,
+                     dtype=np.float32):
+    '''
+    Collects the factors of an ALSModel (or the ALSModel saved at a path) and writes them as an artifact
+    Returns path
+
+    model: pyspark.ml ALSModel, or the path it was saved to
+    '''
+    from scoring import factors_to_numpy
+
+    if isinstance(model, str):
+        from pyspark.ml.recommendation import ALSModel
+        model = ALSModel.load(model)
+
+    user_ids, user_factors = factors_to_numpy(model.userFactors)
+    book_ids, item_factors = factors_to_numpy(model.itemFactors)
+    factors = {'user_ids': user_ids, 'user_factors': user_factors,
+               'book_ids': book_ids, 'item_factors': item_factors,
+               'reg': lamb, 'implicit': implicit, 'alpha': alpha}
+    return save_artifact(factors, path, fraction, lamb, fingerprint, dtype)
+
+def ensure_artifact(spark, model_path, fraction, lamb, implicit=False, alpha=1.0, fingerprint=None):
+    '''
+    Returns artifact path of the ALSModel saved at model_path, exporting it first if there is none
+    or if the artifact's training_fingerprint differs from the model's
+
+    fingerprint: split_cache.training_fingerprint the model must have been fit on
+                 (e.g. from modeling.saved_model_path, which refits stale models);
+                 asserted against the fingerprint recorded with the model
+    '''
+    from modeling import model_fingerprint
+
+    recorded = model_fingerprint(model_path)
+    assert fingerprint is None or recorded==fingerprint, \
+            '{} was fit on other splits, refit it (modeling.saved_model_path)'.format(model_path)
+
+    path = artifact_path(model_path)
+    header = read_header(path)
+    if header is None or header['training_fingerprint']!=recorded:
+        if header is not None:
+            print('NOTICE: {} was exported from an older fit of {}, exporting again'.format(path, model_path))
+        export_als_model(spark, model_path, path, fraction, lamb, implicit=implicit, alpha=alpha, 
+                         fingerprint=recorded)
+    return path
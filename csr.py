@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+'''
+Export of interaction splits to on-disk CSR / CSC arrays for single-node NumPy/SciPy code
+
+Layout of an export directory:
+    meta.json - n_users, n_items and per-split row counts
+    user_ids.npy - original user_id of each dense user index (int32, sorted)
+    book_ids.npy - original book_id of each dense book index (int32, sorted)
+    [split]/csr_indptr.npy - int64, n_users+1
+    [split]/csr_indices.npy - dense book index of each interaction (int32)
+    [split]/csr_rating.npy - int8
+    [split]/csr_is_reviewed.npy - int8
+    [split]/csc_indptr.npy, csc_indices.npy (dense user index), csc_rating.npy, csc_is_reviewed.npy
+
+All splits of an export share one dense id space (0..n_users-1, 0..n_items-1).
+Every array is a plain .npy file, so load_csr can open it with mmap_mode='r':
+loading takes milliseconds and needs no Spark session.
+'''
+
+import os
+import json
+import numpy as np
+
+VALUE_COLUMNS = ['rating', 'is_reviewed']
+
+
+def collect_columns(df, columns, dtypes):
+    '''
+    Streams columns of a spark df to the driver into numpy arrays
+    Returns list of arrays, one per column
+
+    Rows are pulled one partition at a time with toLocalIterator,
+    so the driver never holds more than one partition of Row objects.
+    '''
+    n = df.count()
+    arrays = [np.empty(n, dtype=dtype) for dtype in dtypes]
+
+    i = 0
+    for row in df.select(*columns).toLocalIterator():
+        for a, value in zip(arrays, row):
+            a[i] = value
+        i += 1
+
+    return [a[:i] for a in arrays]
+
+def build_csr(row_idx, col_idx, values, n_rows):
+    '''
+    Builds compressed sparse row arrays from coordinate arrays
+    Returns indptr, indices, dict of value arrays (same keys as values)
+
+    row_idx, col_idx: dense integer indices of each entry
+    values: dict of name -> array of values of each entry
+    n_rows: number of rows (rows with no entries get empty slices)
+
+    Entries are ordered by (row, col). Use with swapped row/col for CSC.
+    '''
+    order = np.lexsort((col_idx, row_idx))
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row_idx, minlength=n_rows), out=indptr[1:])
+
+    return indptr, col_idx[order].astype(np.int32), dict((k, v[order]) for k, v in values.items())
+
+def matrices_from_df(df, value_col='rating', dtype=np.float32):
+    '''
+    Collects a spark df of interactions into in-memory CSR (users x books) and
+    CSC (books x users) arrays over dense indices
+    Returns csr, csc: dicts like load_csr's, with indptr, indices, value_col, 
+    user_ids, book_ids, shape and fmt
+
+    df: spark df with user_id, book_id and value_col
+    value_col: column to use as the matrix values (e.g. 'rating' or 'is_reviewed')
+    dtype: numpy type of the values
+    '''
+    users, books, values = collect_columns(df, ['user_id', 'book_id', value_col], [np.int32, np.int32, dtype])
+
+    user_ids = np.unique(users)
+    book_ids = np.unique(books)
+    user_idx = np.searchsorted(user_ids, users)
+    book_idx = np.searchsorted(book_ids, books)
+
+    matrices = []
+    for fmt, rows, cols, shape in [('csr', user_idx, book_idx, (len(user_ids), len(book_ids))),
+                                   ('csc', book_idx, user_idx, (len(book_ids), len(user_ids)))]:
+        indptr, indices, vals = build_csr(rows, cols, {value_col: values}, shape[0])
+        matrices.append({'indptr': indptr, 'indices': indices, value_col: vals[value_col],
+                         'user_ids': user_ids, 'book_ids': book_ids, 'shape': shape, 'fmt': fmt})
+    return matrices
+
+def export_csr(spark, splits, out_dir, add_isrev=True):
+    '''
+    Writes splits to out_dir as CSR and CSC arrays (see module docstring)
+    Returns out_dir
+
+    spark: spark
+    splits: dict of split name -> spark df with user_id, book_id, rating
+            (e.g. {'train': train, 'val': val, 'test': test} from read_sample_split_pq)
+    out_dir: local directory to write to
+    add_isrev: boolean option to look up is_reviewed in the full interactions
+               for splits without an is_reviewed column (filled with 0 if False)
+    '''
+    from time import localtime, strftime
+
+    collected = {}
+    for name, df in splits.items():
+        if 'is_reviewed' not in df.columns:
+            if add_isrev:
+                from data_prep import read_interactions
+                isrev = read_interactions(spark).select('user_id', 'book_id', 'is_reviewed')
+                df = df.join(isrev, ['user_id', 'book_id'], 'left').fillna(0, subset=['is_reviewed'])
+            else:
+                from pyspark.sql.functions import lit
+                df = df.withColumn('is_reviewed', lit(0))
+
+        print('{}: Collecting {} split'.format(strftime("%Y-%m-%d %H:%M:%S", localtime()), name))
+        collected[name] = collect_columns(df, ['user_id', 'book_id'] + VALUE_COLUMNS,
+                                          [np.int32, np.int32, np.int8, np.int8])
+
+    # one dense id space shared by all splits, in sorted order of the original ids
+    user_ids = np.unique(np.concatenate([c[0] for c in collected.values()]))
+    book_ids = np.unique(np.concatenate([c[1] for c in collected.values()]))
+
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, 'user_ids.npy'), user_ids)
+    np.save(os.path.join(out_dir, 'book_ids.npy'), book_ids)
+
+    meta = {'n_users': int(len(user_ids)), 'n_items': int(len(book_ids)), 'splits': {}}
+
+    for name, (users, books, rating, is_reviewed) in collected.items():
+        user_idx = np.searchsorted(user_ids, users)
+        book_idx = np.searchsorted(book_ids, books)
+        values = {'rating': rating, 'is_reviewed': is_reviewed}
+
+        split_dir = os.path.join(out_dir, name)
+        os.makedirs(split_dir, exist_ok=True)
+        for fmt, rows, cols, n_rows in [('csr', user_idx, book_idx, len(user_ids)),
+                                        ('csc', book_idx, user_idx, len(book_ids))]:
+            indptr, indices, vals = build_csr(rows, cols, values, n_rows)
+            np.save(os.path.join(split_dir, '{}_indptr.npy'.format(fmt)), indptr)
+            np.save(os.path.join(split_dir, '{}_indices.npy'.format(fmt)), indices)
+            for k, v in vals.items():
+                np.save(os.path.join(split_dir, '{}_{}.npy'.format(fmt, k)), v)
+
+        meta['splits'][name] = {'nnz': int(len(users))}
+        print('{}: Wrote {} split ({} interactions) to {}'.format(strftime("%Y-%m-%d %H:%M:%S", localtime()),
+                                                                 name, len(users), split_dir))
+
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    return out_dir
+
+def load_csr(out_dir, split='train', fmt='csr', mmap=True):
+    '''
+    Opens an exported split without Spark
+    Returns dict with indptr, indices, rating, is_reviewed, user_ids, book_ids, shape
+
+    out_dir: directory written by export_csr
+    split: split name, e.g. 'train'
+    fmt: 'csr' (rows are users) or 'csc' (rows are books)
+    mmap: boolean option to memory-map the arrays (mmap_mode='r') instead of reading them
+    '''
+    mode = 'r' if mmap else None
+
+    with open(os.path.join(out_dir, 'meta.json')) as f:
+        meta = json.load(f)
+
+    arrays = {}
+    for name in ['indptr', 'indices'] + VALUE_COLUMNS:
+        arrays[name] = np.load(os.path.join(out_dir, split, '{}_{}.npy'.format(fmt, name)), mmap_mode=mode)
+    arrays['user_ids'] = np.load(os.path.join(out_dir, 'user_ids.npy'), mmap_mode=mode)
+    arrays['book_ids'] = np.load(os.path.join(out_dir, 'book_ids.npy'), mmap_mode=mode)
+
+    arrays['fmt'] = fmt
+    if fmt=='csr':
+        arrays['shape'] = (meta['n_users'], meta['n_items'])
+    else:
+        arrays['shape'] = (meta['n_items'], meta['n_users'])
+
+    return arrays
+
+def to_scipy(arrays, value='rating'):
+    '''
+    Returns scipy.sparse matrix (csr or csc, matching the export) over the loaded arrays
+    Both are users x books: a csc export stores shape as (books, users), its indptr runs over books.
+    The index arrays are shared with the memory map, not copied.
+
+    arrays: dict returned by load_csr
+    value: 'rating' or 'is_reviewed'
+    '''
+    import scipy.sparse as sp
+
+    data = (arrays[value], arrays['indices'], arrays['indptr'])
+    if arrays['fmt']=='csr':
+        return sp.csr_matrix(data, shape=arrays['shape'], copy=False)
+    return sp.csc_matrix(data, shape=tuple(arrays['shape'][::-1]), copy=False)
@@ -1,9 +1,15 @@
 #!/usr/bin/env python
 
+from storage import data_path, source_path, path_exist, mark_written
+
+# number of user_id buckets used for the interactions and split stores
+# (recorded in each store's _bucketing.json, so it can change without breaking old stores)
+NUM_BUCKETS = 200
 
 def read_data_from_csv(spark, which_csv):
     '''
     Reads in specified data file from Brian McFee's hdfs
+        (or the data root set in storage)
     Returns: spark df object 
 
     spark: spark
@@ -12,21 +18,76 @@ def read_data_from_csv(spark, which_csv):
     
     if which_csv=='interactions':
         print('Reading interactions from csv')
-        df=spark.read.csv('hdfs:/user/bm106/pub/goodreads/goodreads_interactions.csv', header = True, 
+        df=spark.read.csv(source_path('goodreads_interactions.csv'), header = True, 
                                     schema = 'user_id INT, book_id INT, is_read INT, rating INT, is_reviewed INT')
         return df
     elif which_csv=='users':
         print('Reading users from csv')
-        df=spark.read.csv('hdfs:/user/bm106/pub/goodreads/user_id_map.csv', header = True, 
+        df=spark.read.csv(source_path('user_id_map.csv'), header = True, 
                                     schema = 'user_id_csv INT, user_id STRING')
         return df
     elif which_csv=='books':
         print('Reading books from csv')
-        df=spark.read.csv('hdfs:/user/bm106/pub/goodreads/book_id_map.csv', header = True, 
+        df=spark.read.csv(source_path('book_id_map.csv'), header = True, 
                                     schema = 'book_id_csv INT, book_id STRING')
         return df
     
-def downsample(spark, full_data, fraction=0.01, seed=42):
+def read_interactions(spark):
+    '''
+    Returns full interactions df
+    Reads from Parquet if already saved (with any ingested patches applied, see ingest.py),
+    otherwise reads the csv and writes it to Parquet
+    '''
+    full_data_path = data_path('interactions_100_full.parquet')
+    if path_exist(full_data_path):
+        # if full interactions dataset already saved to parquet, read in pq df
+        print('Reading interactions file from Parquet')
+        from ingest import read_patched
+        df = read_patched(spark, full_data_path)
+    else:
+        print('Reading interactions file from csv')
+        df_csv = read_data_from_csv(spark, 'interactions')
+        # write full interactions dataset to bucketed parquet if not already saved
+        df = write_bucketed(spark, df_csv, full_data_path)
+
+    return df
+
+# resolution of hash-based user sampling (fractions are rounded to 1/SAMPLE_BUCKETS)
+SAMPLE_BUCKETS = 10000
+
+def user_sample_bucket(seed=42, salt='sample'):
+    '''
+    Returns column with each user's sampling bucket in [0, SAMPLE_BUCKETS),
+    from a seeded hash of user_id
+
+    A user is in the fraction-f sample iff its bucket < f*SAMPLE_BUCKETS,
+    so samples for smaller fractions are always subsets of larger ones.
+
+    salt: name of the draw; samples with different salts are independent of each other
+          (the downsampled users all have 'sample' buckets below the fraction, so
+          subsamples of them need their own salt)
+    '''
+    import pyspark.sql.functions as F
+    return F.pmod(F.hash('user_id', F.lit(seed), F.lit(salt)), F.lit(SAMPLE_BUCKETS))
+
+def tag_min_fraction(df, fractions, seed=42):
+    '''
+    Takes in spark df of interactions
+    Returns df with a 'min_fraction' column: the smallest of fractions whose
+    hash-based user sample (see user_sample_bucket) includes the row's user.
+    Users outside the largest fraction are dropped.
+    '''
+    import pyspark.sql.functions as F
+
+    bucket = user_sample_bucket(seed)
+    min_fraction = None
+    for f in sorted(fractions, reverse=True):
+        this = F.when(bucket < int(round(f*SAMPLE_BUCKETS)), F.lit(float(f)))
+        min_fraction = this if min_fraction is None else this.otherwise(min_fraction)
+
+    return df.withColumn('min_fraction', min_fraction).filter(F.col('min_fraction').isNotNull())
+
+def downsample(spark, full_data, fraction=0.01, seed=42, method='sample'):
     ''' 
     Takes in spark df
     Returns downsampled df
@@ -35,6 +96,10 @@ def downsample(spark, full_data, fraction=0.01, seed=42):
         fraction - decimal percentage of users to retrieve 
                     (i.e. 0.01, 0.05, 0.25)
         seed - set random seed for reproducibility
+        method - 'sample': sample distinct user ids and join back to the data
+                 'hash': keep users whose seeded user_id hash falls below the fraction 
+                         (see user_sample_bucket). No distinct or join, and samples are nested:
+                         the 1% users are a subset of the 5% users, and so on.
 
     Notes from assignment:
     - Downsampling should follow similar logic to partitioning: 
@@ -45,10 +110,16 @@ def downsample(spark, full_data, fraction=0.01, seed=42):
 
     assert fraction <= 1, 'Downsample fraction must not be greater than 1'
     assert fraction > 0, 'Downsample fraction must be greater than 0'
+    assert method in ['sample', 'hash'], 'method must be \'sample\' or \'hash\''
 
     if fraction==1:
         down = full_data
 
+    elif method=='hash':
+        print('Downsampling to {}% by user_id hash'.format(int(fraction*100)))
+        down = full_data.filter(user_sample_bucket(seed) < int(round(fraction*SAMPLE_BUCKETS))) \
+                        .select('user_id', 'book_id', 'rating')
+
     else:
         full_data.createOrReplaceTempView('full_data')
         unique_ids = spark.sql('SELECT distinct user_id FROM full_data')
@@ -58,49 +129,18 @@ def downsample(spark, full_data, fraction=0.01, seed=42):
         downsampled_ids.persist()
 
         # can also read in is_read and/or is_reviewed if necessary
+        # if full_data is bucketed by user_id, the sampled ids keep its partitioning
+        # and this join runs bucket-to-bucket without a shuffle
         down = spark.sql('SELECT downsampled_ids.user_id, book_id, rating FROM downsampled_ids INNER JOIN full_data on downsampled_ids.user_id=full_data.user_id')
     
     return down
 
 
-def run_cmd(args_list):
-    '''
-    Runs command from shell outside Spark session
-
-    adapted from: 
-    http://www.learn4master.com/big-data/pyspark/pyspark-check-if-file-exists
-    '''
-    import subprocess
-    proc = subprocess.Popen(args_list, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-    proc.communicate()
-    return proc.returncode
- 
-def path_exist(path):
-    '''
-    Returns True if path already exists in hdfs
-    Returns False if path does not exist in hdfs
-
-    path: filepath to check
-
-    adapted from: 
-    http://www.learn4master.com/big-data/pyspark/pyspark-check-if-file-exists
-    '''
-    cmd = ['hdfs', 'dfs', '-test', '-e', path]
-    code = run_cmd(cmd)
-    if code == 0:
-        print(path, ' exists')
-        return True
-    else:
-        print(path, ' does not exist.')
-        return False
-    return
-
 def write_to_parquet(spark, df, path):
     '''
     Takes in spark df
-    Orders df by user_id
-        - Will we ever need to order by book_id?
+    Sorts each partition by user_id (no global orderBy shuffle)
+        - use write_bucketed for interaction and split stores
     Writes to Parquet
     Returns Parquet-written dataframe
 
@@ -116,7 +156,8 @@ def write_to_parquet(spark, df, path):
     except:
         # write to parquet
         print('Begin writing ', path)
-        df.orderBy('user_id').write.parquet(path)
+        df.sortWithinPartitions('user_id').write.parquet(path)
+        mark_written(path)
         print('Done writing ', path)
 
         # read parquet
@@ -125,7 +166,149 @@ def write_to_parquet(spark, df, path):
     return pq
 
 
-def train_val_test_split(spark, down, seed=42, rm_unobserved=True, debug=False, debug_show=False):
+def compact_types(df):
+    '''
+    Casts interaction columns to compact types:
+        user_id, book_id -> int (int32)
+        rating, is_read, is_reviewed -> tinyint (int8)
+    Columns that are not present are left alone
+    '''
+    import pyspark.sql.functions as F
+
+    types = {'user_id': 'int', 'book_id': 'int',
+             'rating': 'tinyint', 'is_read': 'tinyint', 'is_reviewed': 'tinyint'}
+
+    return df.select([F.col(c).cast(types[c]).alias(c) if c in types else F.col(c) for c in df.columns])
+
+def bucketed_table_name(path):
+    '''
+    Returns catalog table name used to register the bucketed store at path
+    '''
+    import re
+    import posixpath
+    return 'bucketed_' + re.sub('[^0-9a-zA-Z_]', '_', posixpath.basename(path.rstrip('/')))
+
+def write_bucketed(spark, df, path, num_buckets=NUM_BUCKETS, version=None):
+    '''
+    Takes in spark df of interactions
+    Writes it to path as Parquet bucketed by user_id and sorted by (user_id, book_id)
+    Returns bucketed df read back from path
+
+    Unlike write_to_parquet, there is no global orderBy (range-partition shuffle):
+    rows are hashed into num_buckets buckets and sorted within each bucket.
+    Joins and aggregations on user_id between stores with the same bucket count
+    then need no shuffle.
+
+    The bucket count, sort columns and schema are recorded in [path]/_bucketing.json,
+    so the layout can be re-registered in any later session (see read_bucketed).
+    version: version id of the written data, recorded in _bucketing.json
+             (a new random id if None, see ingest.store_version)
+    '''
+    import json
+    from uuid import uuid4
+    from storage import join, write_text
+
+    table = bucketed_table_name(path)
+    df = compact_types(df)
+    sort_cols = ['user_id', 'book_id'] if 'book_id' in df.columns else ['user_id']
+
+    print('Begin writing ', path, ' ({} buckets)'.format(num_buckets))
+    spark.sql('DROP TABLE IF EXISTS {}'.format(table))
+    df.write.mode('overwrite') \
+            .bucketBy(num_buckets, 'user_id') \
+            .sortBy(*sort_cols) \
+            .option('path', path) \
+            .saveAsTable(table)
+
+    meta = {'bucket_columns': ['user_id'], 
+            'sort_columns': sort_cols, 
+            'num_buckets': num_buckets, 
+            'schema': json.loads(df.schema.json()),
+            'version': version if version is not None else uuid4().hex}
+    write_text(join(path, '_bucketing.json'), json.dumps(meta))
+    mark_written(path)
+    print('Done writing ', path)
+
+    return read_bucketed(spark, path)
+
+def is_bucketed(path):
+    '''
+    Returns True if path was written by write_bucketed
+    '''
+    from storage import join
+    return path_exist(path) and path_exist(join(path, '_bucketing.json'))
+
+def bucketing_meta(path):
+    '''
+    Returns layout dict recorded by write_bucketed in [path]/_bucketing.json
+    '''
+    import json
+    from storage import join, read_text
+    return json.loads(read_text(join(path, '_bucketing.json')))
+
+def read_bucketed(spark, path):
+    '''
+    Returns df for a store written by write_bucketed
+
+    Registers the files at path as an external bucketed table (if not already registered
+    in this session) using the layout in [path]/_bucketing.json, so that Spark knows the
+    bucketing and can plan shuffle-free joins on user_id.
+    '''
+    from pyspark.sql.types import StructType
+
+    table = bucketed_table_name(path)
+
+    if table not in [t.name for t in spark.catalog.listTables()]:
+        meta = bucketing_meta(path)
+        schema = StructType.fromJson(meta['schema'])
+        columns = ', '.join('{} {}'.format(f.name, f.dataType.simpleString()) for f in schema.fields)
+        spark.sql("CREATE TABLE {} ({}) USING parquet CLUSTERED BY ({}) SORTED BY ({}) INTO {} BUCKETS LOCATION '{}'"\
+                        .format(table, columns, ', '.join(meta['bucket_columns']), ', '.join(meta['sort_columns']), 
+                                meta['num_buckets'], path))
+
+    return spark.table(table)
+
+def read_parquet_store(spark, path):
+    '''
+    Returns df stored at path, using read_bucketed for bucketed stores
+    and a plain parquet read for stores written before bucketing
+    '''
+    if is_bucketed(path):
+        return read_bucketed(spark, path)
+    return spark.read.parquet(path)
+
+def tag_holdout(df, seed=42, split_mode='sampleBy'):
+    '''
+    Takes in spark df of interactions
+    Returns df with a boolean 'holdout' column marking half of each user's interactions
+
+    df: interactions with at least user_id and book_id columns
+    seed: random seed / hash salt, so different seeds pick different halves
+    split_mode:
+        'sampleBy' - each interaction is held out with probability 0.5, independently,
+                     like sampleBy with a fraction of 0.5 for every user. The coin flip is
+                     a seeded hash of (user_id, book_id) instead of rand(seed), so it does
+                     not depend on how the joined df is partitioned and reruns pick the same half.
+        'exact' - exactly half (rounded down) of each user's interactions.
+                  Interactions are ranked by a seeded hash of (user_id, book_id)
+                  inside a window partitioned by user_id, so sampling happens on the executors
+                  and no user ids are collected to the driver.
+    '''
+    import pyspark.sql.functions as F
+    from pyspark.sql import Window
+
+    if split_mode=='exact':
+        w_rank = Window.partitionBy('user_id').orderBy(F.hash('user_id', 'book_id', F.lit(seed)), 'book_id')
+        w_user = Window.partitionBy('user_id')
+
+        return df.withColumn('holdout_rank', F.row_number().over(w_rank)) \
+                 .withColumn('user_count', F.count('*').over(w_user)) \
+                 .withColumn('holdout', F.col('holdout_rank') <= F.floor(F.col('user_count')/2)) \
+                 .drop('holdout_rank', 'user_count')
+
+    return df.withColumn('holdout', uniform_draw(seed, F.col('user_id'), F.col('book_id'), F.lit('holdout')) <= 0.5)
+
+def train_val_test_split(spark, down, seed=42, rm_unobserved=True, split_mode='sampleBy', debug=False, debug_show=False):
 
     '''
     Takes in spark df of downsampled interactions
@@ -136,6 +319,9 @@ def train_val_test_split(spark, down, seed=42, rm_unobserved=True, debug=False,
         down - downsampled dataframe to be split into test, val, and train
         seed - random seed to use for splitting and sampling
         rm_unobserved - boolean option to remove all unobserved items and move unobserved users to train
+        split_mode - how to hold out half of each val/test user's interactions (see tag_holdout)
+                     'sampleBy': approximate 50% per user
+                     'exact': exactly half (rounded down) per user
         debug: boolean option to print debug statements
         debug_show: boolean option to show tables for debugging (used with synthetic data)
 
@@ -150,156 +336,62 @@ def train_val_test_split(spark, down, seed=42, rm_unobserved=True, debug=False,
             (i.e., which have no interactions in the training set, or in the 
             observed portion of the validation and test users), can be omitted.
 
-    To-do:
-     - Speed up queries by repartitioning?
+    Every interaction gets a single 'split' tag (train, val or test),
+    and the output dfs are derived from the tagged df by filtering
+    or by semi/anti-joining on user_id and book_id (no EXCEPTs).
     '''
+    import pyspark.sql.functions as F
+
+    assert split_mode in ['sampleBy', 'exact'], 'split_mode must be \'sampleBy\' or \'exact\''
+
     print('Getting all distinct users from downsampled data')
     users=down.select('user_id').distinct()
-    print('Sampling users with randomSplit')
-    users_train, users_val, users_test = users.randomSplit([0.6, 0.2, 0.2], seed=seed)
-    users_train.persist()
-    users_val.persist()
-    users_test.persist()
-    users_train.createOrReplaceTempView('users_train')
-    users_val.createOrReplaceTempView('users_val')
-    users_test.createOrReplaceTempView('users_test')
-    down.createOrReplaceTempView('down')
+    print('Sampling users into 60/20/20 roles')
+    # one uniform draw per user split at 0.6 and 0.8, like randomSplit([0.6, 0.2, 0.2]),
+    # but without a union of three samples, so the users keep down's user_id partitioning
+    # (a bucketed down joins back below without a shuffle). The draw is a seeded hash of
+    # user_id, so a user's role does not depend on the partitioning or order of users.
+    user_roles = users.withColumn('draw', uniform_draw(seed, F.col('user_id'), F.lit('role'))) \
+                      .withColumn('role', F.when(F.col('draw') < 0.6, F.lit('train')) \
+                                           .when(F.col('draw') < 0.8, F.lit('val')) \
+                                           .otherwise(F.lit('test'))) \
+                      .drop('draw')
+    user_roles.persist()
+
+    print('Tagging interactions with user roles')
+    tagged = down.select('user_id', 'book_id', 'rating').join(user_roles, 'user_id')
+
+    print('Holding out half of the interactions of validation and test users')
+    tagged = tag_holdout(tagged, seed=seed, split_mode=split_mode)
+
+    # held out interactions of val/test users keep the user's role, all others are used for training
+    tagged = tagged.withColumn('split', F.when((F.col('role')!='train') & F.col('holdout'), F.col('role')) \
+                                         .otherwise(F.lit('train'))) \
+                   .select('user_id', 'book_id', 'rating', 'split')
+    tagged.persist()
 
     if debug:
         print ('\n')
-        users_all_count = users.count()
-        users_train_count = users_train.count()
-        users_val_count = users_val.count()
-        users_test_count = users_test.count()
+        users_all_count = user_roles.count()
         print('&&& all down users count: ', users_all_count)
-        print('&&& train users count: ', users_train_count)
-        print('&&& val users count: ', users_val_count)
-        print('&&& test users count: ', users_test_count)
-        print('&&& (train+val+test)/all (should be 1): ', (users_train_count + users_val_count + users_test_count)/users_all_count)
-        print ('\n')
-    
-    print('Setting training users')
-    #Training Set - 60% of users
-    train_60 = spark.sql('SELECT users_train.user_id, book_id, rating FROM users_train INNER JOIN down on users_train.user_id=down.user_id')
-
-    if debug:
-        train_60_users_count = train_60.select(train_60.user_id).distinct().count()
-        train_60_count = train_60.count()
-        print ('\n')
-        print('&&& train_60 interactions count: ', train_60_count)
-        print('&&& train_60 distinct users count: ', train_60_users_count)
-        print('&&& train_60_users_count/users_train_count (should be 1): ', train_60_users_count/users_train_count)
-        print ('\n')
-
-    print('Setting validation users')
-    #Validation Set - 20% of users
-    val_all = spark.sql('SELECT users_val.user_id, book_id, rating FROM users_val INNER JOIN down on users_val.user_id=down.user_id')
-    val_all = val_all.cache()
-
-    if debug:
-        print ('\n')
-        val_all_count = val_all.count()
-        val_all_users_count = val_all.select(val_all.user_id).distinct().count()
-        print('&&& val all interactions count: ', val_all_count)
-        print('&&& val all distinct users count: ', val_all_users_count)
-        print('&&& val_all_users_count/users_val_count (should be 1): ', val_all_users_count/users_val_count)
-        print ('\n')
-
-    # Sample 50% of interactions from each user in val_all
-    print('Begin collecting validation users as map')
-    val_dict = val_all.select(val_all.user_id).distinct().rdd.map(lambda x : (x[0], 0.5)).collectAsMap() #slowest step. better way?
-    print('Done collecting validation users as map')
-    print('Sampling interactions for validation users')
-    val_50 = val_all.sampleBy("user_id", fractions=val_dict, seed=seed)
-    val_50.persist()
-
-    if debug:
-        print ('\n')
-        val_count = val_50.count()
-        val_final_users_count= val_50.select(val_50.user_id).distinct().count()
-        print('&&& val_50 distinct users count: ', val_final_users_count)
-        print('&&& val_final_users_count/val_all_users_count (should be 1): ', val_final_users_count/val_all_users_count)
-        print('&&& val final interactions count: ', val_count)
-        print('&&& val final / val all interactions count (should be .5): ', val_count/val_all_count)
-        if debug_show:
-            print('val_all: ')
-            val_all.orderBy('user_id').show(val_all_count)
-            print('val_50: ')
-            val_50.orderBy('user_id').show(val_count)
-        print ('\n')
-
-    #Put other 50% of interactions back into train
-    val_all.createOrReplaceTempView('val_all')
-    val_50.createOrReplaceTempView('val_50')
-    print('Selecting remaining interactions for training')
-    val_to_train = spark.sql('SELECT * FROM val_all EXCEPT SELECT * FROM val_50')
-    print('Merging remaining interactions with train')
-    train_80=train_60.union(val_to_train) # can add .distinct() if necessary
-
-    if debug:
-        train_80_count = train_80.count()
-        train_80_users = train_80.select(train_80.user_id).distinct().count()
-        print ('\n')
-        print('&&& train_80 distinct users count: ', train_80_users)
-        print('&&& train_80 distinct users count / (train_60 distinct users count + val_final_users_count) (should be 1): ', train_80_users/(train_60_users_count+val_final_users_count))
-        print('&&& train_80 interactions count: ', train_80_count)
-        print('&&& train_80 interactions / (train_60_count + val_all_count - val_count) (should be 1): ', train_80_count/(train_60_count + val_all_count - val_count))
-        print ('\n')
-
-    print('Setting test users')
-    #Test Set - 20% of users
-    test_all = spark.sql('SELECT users_test.user_id, book_id, rating FROM users_test INNER JOIN down on users_test.user_id=down.user_id')
-    test_all = test_all.cache()
-
-    if debug:
-        print ('\n')
-        test_all_count = test_all.count()
-        test_all_users_count = test_all.select(test_all.user_id).distinct().count()
-        print('&&& test all interactions count: ', test_all_count)
-        print('&&& test all distinct users count: ', test_all_users_count)
-        print('&&& test_all_users_count/users_test_count (should be 1): ', test_all_users_count/users_test_count)
-        print ('\n')
-
-    # Sample 50% of interactions from each user in test_all
-    print('Begin collecting test users as map')
-    test_dict = test_all.select(test_all.user_id).distinct().rdd.map(lambda x : (x[0], 0.5)).collectAsMap() #slowest step. better way?
-    print('Done collecting test users as map')
-    print('Sampling interactions for test users')
-    test_50 = test_all.sampleBy("user_id", fractions=test_dict, seed=seed)
-    test_50.persist()
-
-    if debug:
-        print ('\n')
-        test_count = test_50.count()
-        test_final_users_count = test_50.select(test_50.user_id).distinct().count()
-        print('&&& test_50 final distinct users count: ', test_final_users_count)
-        print('&&& test_final_users_count/test_all_users_count (should be 1): ', test_final_users_count/test_all_users_count)
-        print('&&& test final interactions count: ', test_count)
-        print('&&& test final / test all interactions count (should be .5): ', test_count/test_all_count)
+        print('&&& users by role (train should be ~0.6, val and test ~0.2 each): ')
+        user_roles.groupBy('role').agg(F.count('*').alias('users'), (F.count('*')/users_all_count).alias('prop')).show()
+        print('&&& interactions and users by split tag: ')
+        tagged.groupBy('split').agg(F.count('*').alias('interactions'), F.countDistinct('user_id').alias('users')).show()
+        print('&&& held out share of val and test users\' interactions (should be ~0.5, exact mode <= 0.5): ')
+        per_user = tagged.join(user_roles.filter(user_roles.role!='train'), 'user_id') \
+                         .groupBy('user_id', 'role').agg(F.count('*').alias('n'), F.sum((F.col('split')!='train').cast('int')).alias('held'))
+        per_user.groupBy('role').agg((F.sum('held')/F.sum('n')).alias('held_prop'), 
+                                     F.sum((F.col('held')==F.col('n')).cast('int')).alias('users_all_held_out'),
+                                     F.sum((F.col('held')==0).cast('int')).alias('users_none_held_out')).show()
+        print('&&& tagged count / down count (should be 1): ', tagged.count()/down.count())
         if debug_show:
-            print('test_all: ')
-            test_all.orderBy('user_id').show(test_all_count)
-            print('test_50: ')
-            test_50.orderBy('user_id').show(test_count)
+            print('tagged: ')
+            tagged.orderBy('user_id', 'book_id').show(tagged.count())
         print ('\n')
 
-    #Put other 50% of interactions back into train
-    test_all.createOrReplaceTempView('test_all')
-    test_50.createOrReplaceTempView('test_50')
-    print('Selecting remaining interactions for training')
-    test_to_train = spark.sql('SELECT * FROM test_all EXCEPT SELECT * FROM test_50')
-    print('Merging remaining interactions with train')
-    train_100=train_80.union(test_to_train) # can add .distinct() if necessary
-
-    if debug:
-        train_final_count = train_100.count()
-        train_final_users = train_100.select(train_100.user_id).distinct().count()
-        print ('\n')
-        print('&&& train_100 distinct users count: ', train_final_users)
-        print('&&& train_100 distinct users count / (train_80 distinct users count + test_final_users_count) (should be 1): ', train_final_users/(train_80_users+test_final_users_count))
-        print('&&& train_100 interactions count: ', train_final_count)
-        print('&&& train_100 interactions /(train_80_count + test_all_count - test_count) (should be 1): ', train_final_count/(train_80_count + test_all_count - test_count))
-        print ('\n')
+    train_100 = tagged.filter(tagged.split=='train')
+    holdout = tagged.filter(tagged.split!='train')
 
     if rm_unobserved:
         
@@ -312,73 +404,250 @@ def train_val_test_split(spark, down, seed=42, rm_unobserved=True, debug=False,
         '''
         print('Getting all distinct users in train')
         train_100_users = train_100.select('user_id').distinct()
-        train_100_users.createOrReplaceTempView('train_100_users')
-        print('Selecting val interactions with observed users')
-        val_inters_ob_users = spark.sql('SELECT train_100_users.user_id, book_id, rating FROM val_50 INNER JOIN train_100_users ON val_50.user_id = train_100_users.user_id')
-        val_inters_ob_users.createOrReplaceTempView('val_inters_ob_users')
-        print('Selecting val interactions with unobserved users')
-        val_inters_unob_users = spark.sql('SELECT * FROM val_50 EXCEPT SELECT * FROM val_inters_ob_users')
-        print('Putting interactions with unobserved users into train')
-        train_observes_val=train_100.union(val_inters_unob_users) # can add .distinct() if necessary
-
-        print('Selecting test interactions with observed users')
-        test_inters_ob_users = spark.sql('SELECT train_100_users.user_id, book_id, rating FROM test_50 INNER JOIN train_100_users ON test_50.user_id = train_100_users.user_id')
-        test_inters_ob_users.createOrReplaceTempView('test_inters_ob_users')
-        print('Selecting test interactions with unobserved users')
-        test_inters_unob_users = spark.sql('SELECT * FROM test_50 EXCEPT SELECT * FROM test_inters_ob_users')
+        print('Selecting val and test interactions with observed users')
+        holdout_ob_users = holdout.join(train_100_users, 'user_id', 'left_semi')
+        print('Selecting val and test interactions with unobserved users')
+        holdout_unob_users = holdout.join(train_100_users, 'user_id', 'left_anti')
         print('Putting interactions with unobserved users into train')
-        train = train_observes_val.union(test_inters_unob_users) # can add .distinct() if necessary
-
-        if debug:
-            tr_users_count = train.select('user_id').distinct().count()
-            va_users_count = val_inters_ob_users.select('user_id').distinct().count()
-            te_users_count = test_inters_ob_users.select('user_id').distinct().count()
-            print('\n')
-            print('&&& After dealing with unobserved users, train has {} users, val has {} users, and test has {} users'.format(tr_users_count, va_users_count, te_users_count))
-            test_and_val_users = val_inters_ob_users.select('user_id').distinct().union(test_inters_ob_users.select('user_id').distinct())
-            train_users_putback = train.select('user_id').distinct()
-            test_and_val_users.createOrReplaceTempView('test_and_val_users')
-            train_users_putback.createOrReplaceTempView('train_users_putback')
-            unobserved_users = spark.sql('SELECT * FROM test_and_val_users EXCEPT SELECT * FROM train_users_putback')
-            print('&&& Number of users that were put back: ', test_inters_unob_users.union(val_inters_unob_users).select('user_id').distinct().count())
-            print('&&& Number of interactions that were put back: ', test_inters_unob_users.union(val_inters_unob_users).count())
-            print('&&& Number of currently unobserved users (should be 0): ', unobserved_users.count())
-            print('&&& train user count / total user count (should be 1): ', tr_users_count/users_all_count)
-            print('&&& (train + val + test) count / total count (should be 1): ', (train.count() + val_inters_ob_users.count() + test_inters_ob_users.count())/down.count() )
-            print('\n')
+        train = train_100.union(holdout_unob_users.withColumn('split', F.lit('train')))
 
         # Remove unobserved items from val and test
         print('Getting all distinct observed items')
         observed_items = train.select('book_id').distinct()
-        observed_items.createOrReplaceTempView('observed_items')
-        print('Removing unobserved items from validation')
-        val = spark.sql('SELECT user_id, observed_items.book_id, rating FROM observed_items INNER JOIN val_inters_ob_users on observed_items.book_id=val_inters_ob_users.book_id')
-        print('Removing unobserved items from test')
-        test = spark.sql('SELECT user_id, observed_items.book_id, rating FROM observed_items INNER JOIN test_inters_ob_users on observed_items.book_id=test_inters_ob_users.book_id')
+        print('Removing unobserved items from validation and test')
+        holdout_ob = holdout_ob_users.join(observed_items, 'book_id', 'left_semi')
 
         if debug:
-            tr_items_count = train.select('book_id').distinct().count()
-            va_items_count = val.select('book_id').distinct().count()
-            te_items_count = test.select('book_id').distinct().count()
             print('\n')
-            print('&&& After dealing with unobserved books, train has {} items, val has {} items, and test has {} items'.format(tr_items_count, va_items_count, te_items_count))
-            test_and_val_items = val.select('book_id').distinct().union(test.select('book_id').distinct())
-            train_items = train.select('book_id').distinct()
-            test_and_val_items.createOrReplaceTempView('test_and_val_items')
-            train_items.createOrReplaceTempView('train_items')
-            unobserved_items = spark.sql('SELECT * FROM test_and_val_items EXCEPT SELECT * FROM train_items')
-            print('&&& Number of removed items:', val_inters_ob_users.union(test_inters_ob_users).select('book_id').distinct.count() - val.union(test).select('book_id').distinct.count())
-            print('&&& Number of removed interactions:', val_inters_ob_users.union(test_inters_ob_users).count() - val.union(test).count())
-            print('&&& Number of currently unobserved items (should be 0):', unobserved_items.count())
+            print('&&& Number of users that were put back: ', holdout_unob_users.select('user_id').distinct().count())
+            print('&&& Number of interactions that were put back: ', holdout_unob_users.count())
+            print('&&& Number of removed interactions with unobserved items: ', holdout_ob_users.count() - holdout_ob.count())
+            print('&&& Number of currently unobserved users (should be 0): ', holdout_ob.join(train, 'user_id', 'left_anti').count())
+            print('&&& Number of currently unobserved items (should be 0): ', holdout_ob.join(train, 'book_id', 'left_anti').count())
+            print('&&& Number of removed items: ', holdout_ob_users.select('book_id').distinct().count() - holdout_ob.select('book_id').distinct().count())
+            print('&&& train user count / total user count (should be 1): ', train.select('user_id').distinct().count()/users_all_count)
+            print('&&& (train + val + test + removed) count / total count (should be 1): ', 
+                  (train.count() + holdout_ob_users.count())/down.count())
             print('\n')
 
+        val = holdout_ob.filter(holdout_ob.split=='val')
+        test = holdout_ob.filter(holdout_ob.split=='test')
+
     if rm_unobserved==False:
         train = train_100
-        val = val_50
-        test = test_50
+        val = holdout.filter(holdout.split=='val')
+        test = holdout.filter(holdout.split=='test')
+
+    train = train.select('user_id', 'book_id', 'rating')
+    val = val.select('user_id', 'book_id', 'rating')
+    test = test.select('user_id', 'book_id', 'rating')
+
+    return train, val, test
+
+def tag_splits_fused(df, seed=42):
+    '''
+    Takes in spark df of interactions
+    Returns df of user_id, book_id, rating and a 'split' tag (train, val or test)
+
+    The tag of an interaction depends only on that user's own interactions and the seed:
+        - user role from a seeded hash of user_id (60% train, 20% val, 20% test)
+        - val/test users hold out exactly floor(n/2) interactions,
+          ranked by a seeded hash of (user_id, book_id)
+    so any subset of users can be re-tagged on its own (see ingest.py).
+    Other columns of df (e.g. min_fraction) are kept.
+    '''
+    import pyspark.sql.functions as F
+    from pyspark.sql import Window
+
+    user_bucket = F.pmod(F.hash('user_id', F.lit(seed), F.lit('role')), F.lit(100))
+    role = F.when(user_bucket < 60, F.lit('train')) \
+            .when(user_bucket < 80, F.lit('val')) \
+            .otherwise(F.lit('test'))
+
+    w_rank = Window.partitionBy('user_id').orderBy(F.hash('user_id', 'book_id', F.lit(seed)), 'book_id')
+    w_user = Window.partitionBy('user_id')
+
+    return df.withColumn('role', role) \
+             .withColumn('holdout_rank', F.row_number().over(w_rank)) \
+             .withColumn('user_count', F.count('*').over(w_user)) \
+             .withColumn('split', F.when((F.col('role')!='train') & \
+                                         (F.col('holdout_rank') <= F.floor(F.col('user_count')/2)), F.col('role')) \
+                                   .otherwise(F.lit('train'))) \
+             .drop('role', 'holdout_rank', 'user_count')
+
+def train_val_test_split_fused(spark, down, seed=42, num_partitions=None, broadcast_items=True, debug=False):
+    '''
+    Takes in spark df of downsampled interactions
+    Returns train, val, test dfs
+
+    Fused version of train_val_test_split(rm_unobserved=True, split_mode='exact'):
+        - down is partitioned by user_id once (the only shuffle of the interactions,
+          and none at all if down comes from a store bucketed by user_id)
+        - user roles come from a seeded hash of user_id (60% train, 20% val, 20% test),
+          so no distinct/randomSplit/join back to down is needed
+        - the holdout flag comes from the same window pass as tag_holdout(split_mode='exact')
+        - the observed item set is one aggregation over the train-tagged rows,
+          broadcast into a semi-join so val and test are not shuffled again
+        - all three splits are filtered out of the one persisted, user-partitioned df
+
+    Arguments:
+        spark - spark
+        down - downsampled dataframe to be split into test, val, and train
+        seed - hash salt for user roles and holdouts
+        num_partitions - number of user_id partitions to repartition down into
+                         (None keeps down's partitioning if it is already by user_id)
+        broadcast_items - boolean option to broadcast the observed item set
+        debug: boolean option to print debug statements
+
+    Unobserved users cannot occur: a val/test user with n interactions keeps
+    n - floor(n/2) >= 1 of them in train, which is what rm_unobserved=True enforces.
+    '''
+    import pyspark.sql.functions as F
+
+    if num_partitions:
+        parted = down.repartition(num_partitions, 'user_id')
+    else:
+        # the user_id windows below add the shuffle only if down is not already
+        # partitioned by user_id (a bucketed down is read without one)
+        parted = down
+
+    print('Tagging interactions with user roles and holdout flags')
+    tagged = tag_splits_fused(parted.select('user_id', 'book_id', 'rating'), seed=seed)
+    tagged.persist()
+
+    print('Getting all distinct observed items')
+    observed_items = tagged.filter(tagged.split=='train').select('book_id').distinct()
+    if broadcast_items:
+        observed_items = F.broadcast(observed_items)
+
+    train = tagged.filter(tagged.split=='train')
+    holdout_ob = tagged.filter(tagged.split!='train').join(observed_items, 'book_id', 'left_semi')
+    val = holdout_ob.filter(holdout_ob.split=='val')
+    test = holdout_ob.filter(holdout_ob.split=='test')
+
+    if debug:
+        print('\n')
+        print('&&& interactions and users by split tag (before removing unobserved items): ')
+        tagged.groupBy('split').agg(F.count('*').alias('interactions'), F.countDistinct('user_id').alias('users')).show()
+        print('&&& Number of removed interactions with unobserved items: ', tagged.filter(tagged.split!='train').count() - holdout_ob.count())
+        print('\n')
+
+    train = train.select('user_id', 'book_id', 'rating')
+    val = val.select('user_id', 'book_id', 'rating')
+    test = test.select('user_id', 'book_id', 'rating')
 
     return train, val, test
 
+def benchmark_splits(spark, fractions=[0.01, 0.05, 0.25], split_modes=['sampleBy', 'exact', 'fused'], 
+                     seed=42, low_item_threshold=10):
+    '''
+    Times train_val_test_split against train_val_test_split_fused
+    Appends wall times to split_benchmark.txt
+
+    Each split is materialized with count() on train, val and test.
+    The downsampled df is cached (and counted) before timing so that reading,
+    filtering and downsampling are not part of the measurement.
+    '''
+    from time import localtime, strftime, time
+
+    df = read_interactions(spark)
+    df_nolow = remove_lowitem_users(spark, remove_zeros(spark, df), low_item_threshold)
+
+    for fraction in fractions:
+        down = downsample(spark, df_nolow, fraction=fraction, seed=seed)
+
+        for split_mode in split_modes:
+            spark.catalog.clearCache()
+            down.cache()
+            down_count = down.count()
+
+            start = time()
+            if split_mode=='fused':
+                train, val, test = train_val_test_split_fused(spark, down, seed=seed)
+            else:
+                train, val, test = train_val_test_split(spark, down, seed=seed, rm_unobserved=True, split_mode=split_mode)
+            counts = (train.count(), val.count(), test.count())
+            elapsed = time() - start
+
+            print('{}: {}% split_mode={}: {:.1f}s (down={}, train={}, val={}, test={})'\
+                        .format(strftime("%Y-%m-%d %H:%M:%S", localtime()), int(fraction*100), split_mode, 
+                                elapsed, down_count, *counts))
+            f = open("split_benchmark.txt", "a")
+            f.write('{}: {}% split_mode={}: {:.1f}s (down={}, train={}, val={}, test={})\n'\
+                        .format(strftime("%Y-%m-%d %H:%M:%S", localtime()), int(fraction*100), split_mode, 
+                                elapsed, down_count, *counts))
+            f.close()
+
+    spark.catalog.clearCache()
+    return
+
+def dense_index(spark, df, col, idx_col):
+    '''
+    Returns df of the distinct values of col with a dense index idx_col in 0..N-1
+    (in sorted order of col)
+
+    zipWithIndex numbers rows partition by partition on the executors,
+    so the ids are never collected to the driver.
+    '''
+    ids = df.select(col).distinct().orderBy(col)
+    indexed = ids.rdd.zipWithIndex().map(lambda x: (x[0][0], x[1]))
+    return spark.createDataFrame(indexed, '{} INT, {} INT'.format(col, idx_col))
+
+def get_id_maps(spark, train, fraction, save=True, synthetic=False, final_test=False, fingerprint=None):
+    '''
+    Returns user_map (user_id, user_idx, ...) and book_map (book_id, book_idx, ...) 
+    with dense contiguous indices for the users and books of train
+
+    After downsampling and filtering, user_id and book_id are sparse, and ALS sizes its
+    factor blocks and recommendation arrays by the ids it sees. Fitting on the dense
+    indices makes them scale with the number of observed users and books.
+
+    spark: spark
+    train: training split the model is fit on
+    fraction: downsample fraction of train (used in the saved map names)
+    save: boolean option to save the maps to Parquet (reused if already saved,
+          so a saved model and its maps always agree)
+    fingerprint: split_cache fingerprint of the splits train comes from (see training_fingerprint);
+                 saved maps are keyed by it, so splits rebuilt with other parameters or from
+                 newer interactions get new maps. Maps of an unknown train (None) are not saved.
+    synthetic: boolean option for synthetic data (maps are not saved and 
+               the original Goodreads string ids are not attached)
+    final_test: boolean option for the final train split (saved under separate names)
+
+    For Goodreads data the maps also carry the original string ids from
+    user_id_map.csv / book_id_map.csv (user_id_str, book_id_str).
+    '''
+    prefix = 'idmap_final' if final_test else 'idmap'
+    if fingerprint is None:
+        save = False
+        users_path = books_path = None
+    else:
+        users_path = data_path('{}_{}_{}_users.parquet'.format(prefix, int(fraction*100), fingerprint[:12]))
+        books_path = data_path('{}_{}_{}_books.parquet'.format(prefix, int(fraction*100), fingerprint[:12]))
+
+    if (not synthetic) and (fingerprint is not None) and path_exist(users_path) and path_exist(books_path):
+        return spark.read.parquet(users_path), spark.read.parquet(books_path)
+
+    print('Building dense user and book indices')
+    user_map = dense_index(spark, train, 'user_id', 'user_idx')
+    book_map = dense_index(spark, train, 'book_id', 'book_idx')
+
+    if not synthetic:
+        users_csv = read_data_from_csv(spark, 'users')
+        books_csv = read_data_from_csv(spark, 'books')
+        user_map = user_map.join(users_csv.withColumnRenamed('user_id', 'user_id_str'), 
+                                 user_map.user_id==users_csv.user_id_csv, 'left').drop('user_id_csv')
+        book_map = book_map.join(books_csv.withColumnRenamed('book_id', 'book_id_str'), 
+                                 book_map.book_id==books_csv.book_id_csv, 'left').drop('book_id_csv')
+
+        if save:
+            user_map = write_to_parquet(spark, user_map, users_path)
+            book_map = write_to_parquet(spark, book_map, books_path)
+
+    user_map.persist()
+    book_map.persist()
+    return user_map, book_map
+
 def remove_lowitem_users(spark, df0, low_item_threshold=10):
     '''
     Input: 
@@ -413,6 +682,62 @@ def remove_lowitem_users(spark, df0, low_item_threshold=10):
 
     return df_nolow
     
+def kcore_filter(spark, df0, user_threshold=10, book_threshold=10, max_rounds=20, checkpoint=True):
+    '''
+    Input: 
+        spark = spark
+        df0 = data file where ratings of 0 may have been removed
+        user_threshold = keep users with more than this many interactions
+        book_threshold = keep books with more than this many interactions
+        max_rounds = upper bound on filtering rounds
+        checkpoint = boolean option to checkpoint after every round
+    Returns: interactions where every user has > user_threshold and 
+             every book has > book_threshold interactions (the k-core)
+
+    Dropping books can push users back under the threshold (and vice versa),
+    so both filters are repeated until a round removes nothing.
+    Each round uses window counts over user_id and book_id instead of a GROUP BY 
+    and a join back to the data. Checkpointing (reliable if a checkpoint dir is set, 
+    local otherwise) cuts the lineage between rounds.
+    '''
+    import pyspark.sql.functions as F
+    from pyspark.sql import Window
+    from time import localtime, strftime
+
+    assert type(user_threshold)==int and type(book_threshold)==int, 'thresholds must be integers'
+    assert user_threshold >= 0 and book_threshold >= 0, 'thresholds must be non-negative'
+
+    w_user = Window.partitionBy('user_id')
+    w_book = Window.partitionBy('book_id')
+
+    df = df0
+    n_prev = df.count()
+    print('{}: k-core filtering {} interactions (users > {}, books > {})'\
+                .format(strftime("%Y-%m-%d %H:%M:%S", localtime()), n_prev, user_threshold, book_threshold))
+
+    for i in range(max_rounds):
+        if user_threshold > 0:
+            df = df.withColumn('user_count', F.count('*').over(w_user)) \
+                   .filter(F.col('user_count') > user_threshold).drop('user_count')
+        if book_threshold > 0:
+            df = df.withColumn('book_count', F.count('*').over(w_book)) \
+                   .filter(F.col('book_count') > book_threshold).drop('book_count')
+
+        if checkpoint:
+            try:
+                df = df.checkpoint()
+            except Exception:
+                # no checkpoint directory set
+                df = df.localCheckpoint()
+
+        n = df.count()
+        print('{}: k-core round {}: {} interactions left'.format(strftime("%Y-%m-%d %H:%M:%S", localtime()), i+1, n))
+        if n == n_prev:
+            break
+        n_prev = n
+
+    return df
+
 def remove_zeros (spark, df):
     '''
     Removes all interactions with a rating of 0
@@ -423,7 +748,8 @@ def remove_zeros (spark, df):
 
 def read_sample_split_pq(spark,  fraction=0.01, seed=42, \
                          save_pq=False, rm_unobserved=True, rm_zeros=True, low_item_threshold=10, 
-                         synthetic=False, debug=False, hybrid=False):
+                         synthetic=False, debug=False, hybrid=False, split_mode='sampleBy', low_book_threshold=0,
+                         synth_args=None):
     '''
     By default, reads in interactions data (and writes to Parquet if not already saved)
         - Also has option to use synthetic data
@@ -441,12 +767,24 @@ def read_sample_split_pq(spark,  fraction=0.01, seed=42, \
              - will be reset to "False" if rm_unobserved==False
              - will be reset to "False" if rm_zeros==False
     rm_unobserved: boolean option to remove all unobserved items and move unobserved users to train
+    low_item_threshold: remove users with <= this many interactions
+    low_book_threshold: if > 0, also remove books with <= this many interactions,
+                        repeating both filters until stable (see kcore_filter)
+                        - splits are saved with a '_book[threshold]' suffix
     synthetic: boolean option to use synthetic data (will use goodreads data if False)
+    synth_args: if synthetic, dict of generate_synth_data arguments to use generated data
+                at scale instead of the fixed examples (rm_zeros and low_item_threshold
+                are then applied as for goodreads data)
     debug: boolean option to debug train_val_test_split
+    split_mode: 'sampleBy' or 'exact', see train_val_test_split
+                'fused' uses train_val_test_split_fused (requires rm_unobserved=True)
+                        and hash-based downsampling
+                - splits made with 'exact' or 'fused' are saved under an '_exact' or '_fused' suffix
+
+    Saved splits are only reused if their manifests match every parameter above and the
+    current version of the interactions store; otherwise they are rebuilt (see split_cache.py).
     '''
-    #get netid
-    from getpass import getuser
-    net_id=getuser()
+    assert (split_mode!='fused') or rm_unobserved, 'split_mode=\'fused\' requires rm_unobserved=True'
 
     # retain only 2 decimal places (round down to nearest 0.01)
     fraction = int(fraction*100)/100
@@ -469,33 +807,33 @@ def read_sample_split_pq(spark,  fraction=0.01, seed=42, \
         print('NOTICE: Will not save data with ratings of zero to Parquet.')
         save_pq = False
 
-    if synthetic==False:
+    # True only if train, val, test are read from (or were just published as) bucketed splits
+    bucketed = False
 
-        # set hdfs paths
-        train_path = 'hdfs:/user/{}/interactions_{}_train_low{}.parquet'.format(net_id, int(fraction*100), low_item_threshold)
-        val_path = 'hdfs:/user/{}/interactions_{}_val_low{}.parquet'.format(net_id, int(fraction*100), low_item_threshold)
-        test_path = 'hdfs:/user/{}/interactions_{}_test_low{}.parquet'.format(net_id, int(fraction*100), low_item_threshold)
+    if synthetic==False:
 
-        try:
-            # read in dfs from parquet if they exist
-            train = spark.read.parquet(train_path)
-            val = spark.read.parquet(val_path)
-            test = spark.read.parquet(test_path)
+        # set split paths
+        train_path, val_path, test_path = split_paths(fraction, low_item_threshold, split_mode, low_book_threshold)
+
+        # saved splits are reused only if their manifests match all split parameters
+        # and the current interactions data (see split_cache.py)
+        from split_cache import split_params, read_cached_splits, publish_splits
+        params = split_params(fraction, seed=seed, rm_zeros=rm_zeros, rm_unobserved=rm_unobserved, 
+                              low_item_threshold=low_item_threshold, low_book_threshold=low_book_threshold, 
+                              split_mode=split_mode)
+        cached = read_cached_splits(spark, [train_path, val_path, test_path], params)
+
+        if cached is not None:
+            train, val, test = cached
+            # splits with ingested patches are a union of base and patch rows (see ingest.read_patched)
+            from ingest import list_batches
+            bucketed = not any(list_batches(path) for path in [train_path, val_path, test_path])
             down = None # no access to downsampled df
             print('Succesfullly read splits from hdfs')
 
-        except:
+        else:
 
-            full_data_path = 'hdfs:/user/'+net_id+'/interactions_100_full.parquet'
-            if path_exist(full_data_path):
-                # if full interactions dataset already saved to parquet, read in pq df
-                print('Reading interactions file from Parquet')
-                df = spark.read.parquet(full_data_path)
-            else:
-                print('Reading interactions file from csv')
-                df_csv = read_data_from_csv(spark, 'interactions')
-                # write full interactions dataset to parquet if not already saved
-                df = write_to_parquet(spark, df_csv, 'interactions_100_full')
+            df = read_interactions(spark)
 
             if rm_zeros:
                 # remove all interactions with a rating of 0
@@ -504,42 +842,64 @@ def read_sample_split_pq(spark,  fraction=0.01, seed=42, \
                 df0 = df
             
             # remove iteractions of users with low number of interaction
-            df_nolow = remove_lowitem_users(spark, df0, low_item_threshold)
+            if low_book_threshold > 0:
+                # and of books with low number of interactions, until stable
+                df_nolow = kcore_filter(spark, df0, user_threshold=low_item_threshold, book_threshold=low_book_threshold)
+            else:
+                df_nolow = remove_lowitem_users(spark, df0, low_item_threshold)
 
             # downsample 
-            down = downsample(spark, df_nolow, fraction=fraction, seed=seed)
+            # fused splits sample users by hash, so every fraction is nested in the next
+            # and matches save_splits_single_pass
+            down = downsample(spark, df_nolow, fraction=fraction, seed=seed, 
+                              method='hash' if split_mode=='fused' else 'sample')
 
             # split into train/val/test
-            train, val, test = train_val_test_split(spark, down, seed=seed, rm_unobserved=rm_unobserved, debug=debug, debug_show=False)
+            if split_mode=='fused':
+                train, val, test = train_val_test_split_fused(spark, down, seed=seed, debug=debug)
+            else:
+                train, val, test = train_val_test_split(spark, down, seed=seed, rm_unobserved=rm_unobserved, split_mode=split_mode, debug=debug, debug_show=False)
 
             if save_pq:
-                # write splits to parquet
-                train = write_to_parquet(spark, train, train_path)
-                val = write_to_parquet(spark, val, val_path)
-                test = write_to_parquet(spark, test, test_path)
+                # write splits to parquet, each moved into place once complete
+                train, val, test = publish_splits(spark, [train, val, test], [train_path, val_path, test_path], params)
+                bucketed = True
 
     if synthetic:
 
-        if not hybrid:
+        if synth_args is not None:
+            df = get_synth_data(spark, size='generated', version='explicit', **synth_args)
+            if rm_zeros:
+                df = remove_zeros(spark, df)
+            df = remove_lowitem_users(spark, df, low_item_threshold)
+
+        elif not hybrid:
             df = get_synth_data(spark, size='large', version='explicit')
 
-        if hybrid:
+        else:
             df = get_synth_data(spark, size='small', version='explicit')
 
         # downsample     
         down = downsample(spark, df, fraction=fraction, seed=seed)
 
         # split into train/val/test
-        train, val, test = train_val_test_split(spark, down, seed=seed, rm_unobserved=rm_unobserved, debug=debug, debug_show=debug)
-
-        # save synthetic data on single partition
-        train = train.coalesce(1)
-        val = val.coalesce(1)
-        test = test.coalesce(1)
-
-    train = train.coalesce(int((0.25+fraction)*200))
-    val = test.coalesce(int((0.25+fraction)*200))
-    test = test.coalesce(int((0.25+fraction)*200))
+        if split_mode=='fused':
+            train, val, test = train_val_test_split_fused(spark, down, seed=seed, debug=debug)
+        else:
+            train, val, test = train_val_test_split(spark, down, seed=seed, rm_unobserved=rm_unobserved, split_mode=split_mode, debug=debug, debug_show=debug)
+
+        if synth_args is None:
+            # save synthetic data on single partition
+            train = train.coalesce(1)
+            val = val.coalesce(1)
+            test = test.coalesce(1)
+
+    if not bucketed:
+        # bucketed splits already have one partition per bucket,
+        # and coalescing would drop the user_id bucketing
+        train = train.coalesce(int((0.25+fraction)*200))
+        val = val.coalesce(int((0.25+fraction)*200))
+        test = test.coalesce(int((0.25+fraction)*200))
     
     # cache the splits
     train.cache()
@@ -548,18 +908,255 @@ def read_sample_split_pq(spark,  fraction=0.01, seed=42, \
 
     return down, train, val, test
 
-def save_down_splits(spark, sample_fractions = [.01, .05, 0.25, 1], low_item_threshold=10):
+def save_down_splits(spark, sample_fractions = [.01, .05, 0.25, 1], low_item_threshold=10, split_mode='sampleBy', 
+                     low_book_threshold=0):
     '''
     Used to save splits to parquet.
     '''
+    if split_mode=='fused':
+        # all fractions from one pass over the data
+        save_splits_single_pass(spark, sample_fractions=sample_fractions, low_item_threshold=low_item_threshold, 
+                                low_book_threshold=low_book_threshold)
+        return
+
     for fraction in sample_fractions:
         _, _, _, _ = read_sample_split_pq(spark, fraction=fraction, seed=42, \
                                                       save_pq=True, rm_unobserved=True, rm_zeros=True, \
                                                       low_item_threshold=low_item_threshold, \
-                                                      synthetic=False, debug=False)
+                                                      synthetic=False, debug=False, split_mode=split_mode, \
+                                                      low_book_threshold=low_book_threshold)
+    return
+
+def split_paths(fraction, low_item_threshold=10, split_mode='sampleBy', low_book_threshold=0):
+    '''
+    Returns train, val, test paths of saved splits (same naming as read_sample_split_pq)
+    '''
+    mode_suffix = '' if split_mode=='sampleBy' else '_'+split_mode
+    if low_book_threshold > 0:
+        mode_suffix = '_book{}'.format(low_book_threshold) + mode_suffix
+    return [data_path('interactions_{}_{}_low{}{}.parquet'.format(int(fraction*100), split, low_item_threshold, mode_suffix))
+                for split in ['train', 'val', 'test']]
+
+def save_splits_single_pass(spark, sample_fractions = [.01, .05, 0.25, 1], seed=42, 
+                            low_item_threshold=10, low_book_threshold=0):
+    '''
+    Saves fused train/val/test splits (rm_zeros=True, rm_unobserved=True) for all fractions 
+    from one pass over the interactions. 
+    Writes the same splits as read_sample_split_pq(split_mode='fused', save_pq=True) per fraction.
+
+    - every interaction is tagged with the smallest fraction whose hash-based user sample contains it
+      (tag_min_fraction), and with its split (tag_splits_fused, which only depends on the user)
+    - one aggregation gives, for each book, the smallest fraction in which it is observed in train
+    - a held-out interaction belongs to fraction f if both its user and its book are in fraction f
+    - each fraction's splits are filtered from the one tagged df
+    '''
+    import pyspark.sql.functions as F
+    from time import localtime, strftime
+    from split_cache import split_params, publish_splits, data_version
+
+    df = remove_zeros(spark, read_interactions(spark))
+    version = data_version()
+    if low_book_threshold > 0:
+        df_nolow = kcore_filter(spark, df, user_threshold=low_item_threshold, book_threshold=low_book_threshold)
+    else:
+        df_nolow = remove_lowitem_users(spark, df, low_item_threshold)
+
+    print('{}: Tagging interactions with fractions and splits'.format(strftime("%Y-%m-%d %H:%M:%S", localtime())))
+    tagged = tag_splits_fused(tag_min_fraction(df_nolow.select('user_id', 'book_id', 'rating'), sample_fractions, seed=seed), seed=seed)
+    tagged.persist()
+
+    # smallest fraction in which each book is observed in train
+    item_fraction = tagged.filter(tagged.split=='train') \
+                          .groupBy('book_id').agg(F.min('min_fraction').alias('item_fraction'))
+    holdout = tagged.filter(tagged.split!='train') \
+                    .join(F.broadcast(item_fraction), 'book_id') \
+                    .withColumn('min_fraction', F.greatest('min_fraction', 'item_fraction'))
+    holdout.persist()
+
+    split_cols = ['user_id', 'book_id', 'rating']
+    for fraction in sorted(sample_fractions):
+        train_path, val_path, test_path = split_paths(fraction, low_item_threshold, 'fused', low_book_threshold)
+        params = split_params(fraction, seed=seed, low_item_threshold=low_item_threshold, 
+                              low_book_threshold=low_book_threshold, split_mode='fused')
+        print('{}: Writing {}% splits'.format(strftime("%Y-%m-%d %H:%M:%S", localtime()), int(fraction*100)))
+        publish_splits(spark, [tagged.filter((tagged.split=='train') & (tagged.min_fraction <= fraction)).select(split_cols), 
+                               holdout.filter((holdout.split=='val') & (holdout.min_fraction <= fraction)).select(split_cols), 
+                               holdout.filter((holdout.split=='test') & (holdout.min_fraction <= fraction)).select(split_cols)], 
+                       [train_path, val_path, test_path], params, version)
+
+    tagged.unpersist()
+    holdout.unpersist()
     return
 
-def quality_check(spark, fraction, synthetic, rm_unobserved=False):
+def split_report(spark, train, val, test, fraction, down=None, full=None, rm_unobserved=True, 
+                 approx=False, rsd=0.01, tol=0.1, out_path=None):
+    '''
+    Validates splits with one pass over the rows (approx) or one shuffle of them (exact)
+    Returns report dict (counts, proportions, checks, ok) and optionally writes it as json
+
+    spark: spark
+    train, val, test: splits to check
+    fraction: downsample fraction the splits were made with
+    down: downsampled df the splits were made from (checks against it are skipped if None,
+          e.g. when the splits were read from Parquet)
+    full: full interactions df (only used for counts and the downsampled user proportion)
+    rm_unobserved: whether the splits were made with rm_unobserved=True
+                   (then val/test must have no users or books missing from train)
+    approx: boolean option to use HyperLogLog sketches (approx_count_distinct) instead of
+            exact distinct counts: one pass over the rows with no shuffle of the interactions
+    rsd: maximum relative standard deviation of the sketches
+    tol: relative tolerance of the val/test user proportion checks (expected 0.2 each)
+    out_path: if given, path (local or hdfs) to write the json report to, e.g. for CI
+
+    All inputs are tagged and unioned. The exact mode groups the union by (user_id, book_id)
+    once and counts rows with a global aggregation of the pairs. Distinct users (books) are
+    sums over the pairs grouped again by user (book), one row per user with a flag per input
+    it appears in, instead of ~16 conditional distinct counts, which Spark plans as an Expand
+    that copies every pair once per count.
+    Set differences (unobserved users/books, down EXCEPT recombined) come from
+    inclusion-exclusion of distinct counts, e.g. |val - train| = |val U train| - |train|.
+    '''
+    import json
+    import pyspark.sql.functions as F
+    from time import localtime, strftime
+
+    print('{}: Building split report'.format(strftime("%Y-%m-%d %H:%M:%S", localtime())))
+
+    inputs = [('train', train), ('val', val), ('test', test), ('down', down), ('full', full)]
+    inputs = [(t, df) for t, df in inputs if df is not None]
+    tags = [t for t, _ in inputs]
+    splits = ['train', 'val', 'test']
+
+    tagged = None
+    for t, df in inputs:
+        df = df.select(F.col('user_id').cast('int'), F.col('book_id').cast('int'), 
+                       F.col('rating').cast('int'), F.lit(t).alias('tag'))
+        tagged = df if tagged is None else tagged.union(df)
+
+    if approx:
+        # one pass over the rows
+        base = tagged
+        present = dict((t, F.col('tag')==t) for t in tags)
+        present['recombined'] = F.col('tag').isin(*splits)
+        count_distinct = lambda c: F.approx_count_distinct(c, rsd)
+        n_rows = lambda t: F.sum(present[t].cast('long'))
+        # extra rows of (user, book) pairs that appear more than once
+        dup_rows = lambda t: n_rows(t) - count_distinct(F.when(present[t], F.struct('user_id', 'book_id')))
+    else:
+        # one shuffle: every (user, book) pair with its row count per input
+        aggs = [F.sum((F.col('tag')==t).cast('long')).alias('n_'+t) for t in tags]
+        if down is not None:
+            aggs += [F.collect_set(F.when(F.col('tag')=='down', F.col('rating'))).alias('down_ratings'),
+                     F.collect_set(F.when(F.col('tag').isin(*splits), F.col('rating'))).alias('rec_ratings')]
+        base = tagged.groupBy('user_id', 'book_id').agg(*aggs) \
+                     .withColumn('n_recombined', F.col('n_train') + F.col('n_val') + F.col('n_test'))
+        present = dict((t, F.col('n_'+t) > 0) for t in tags + ['recombined'])
+        n_rows = lambda t: F.sum('n_'+t)
+        dup_rows = lambda t: F.sum(F.greatest(F.col('n_'+t) - 1, F.lit(0)))
+
+    pairs = [('val', 'train'), ('test', 'train'), ('val', 'test')]
+    aggs = []
+    for t in tags + ['recombined']:
+        aggs += [n_rows(t).alias('interactions_'+t),
+                 dup_rows(t).alias('duplicate_rows_'+t)]
+    if approx:
+        for key, kind in [('user_id', 'users'), ('book_id', 'books')]:
+            aggs += [count_distinct(F.when(present[t], F.col(key))).alias('{}_{}'.format(kind, t))
+                        for t in tags + ['recombined']]
+            aggs += [count_distinct(F.when(present[a] | present[b], F.col(key))).alias('{}_{}_or_{}'.format(kind, a, b))
+                        for a, b in pairs]
+    if down is not None:
+        if approx:
+            row = F.struct('user_id', 'book_id', 'rating')
+            aggs += [count_distinct(F.when(present['down'] | present['recombined'], row)).alias('rows_down_or_recombined'),
+                     count_distinct(F.when(present['down'], row)).alias('rows_down'),
+                     count_distinct(F.when(present['recombined'], row)).alias('rows_recombined')]
+        else:
+            aggs += [F.sum(F.size(F.array_except('down_ratings', 'rec_ratings'))).alias('down_minus_recombined'),
+                     F.sum(F.size(F.array_except('rec_ratings', 'down_ratings'))).alias('recombined_minus_down')]
+
+    if approx:
+        counts = base.agg(*aggs).collect()[0].asDict()
+    else:
+        base.cache()
+        counts = base.agg(*aggs).collect()[0].asDict()
+        for key, kind in [('user_id', 'users'), ('book_id', 'books')]:
+            roles = base.groupBy(key).agg(*[F.max(present[t].cast('int')).alias(t) for t in tags + ['recombined']])
+            sums = [F.sum(t).alias('{}_{}'.format(kind, t)) for t in tags + ['recombined']]
+            sums += [F.sum(F.greatest(a, b)).alias('{}_{}_or_{}'.format(kind, a, b)) for a, b in pairs]
+            counts.update(roles.agg(*sums).collect()[0].asDict())
+        base.unpersist()
+    counts = dict((k, int(v or 0)) for k, v in counts.items())
+
+    if down is not None and approx:
+        counts['down_minus_recombined'] = counts['rows_down_or_recombined'] - counts['rows_recombined']
+        counts['recombined_minus_down'] = counts['rows_down_or_recombined'] - counts['rows_down']
+    for a in ['val', 'test']:
+        counts['unobserved_users_'+a] = counts['users_{}_or_train'.format(a)] - counts['users_train']
+        counts['unobserved_books_'+a] = counts['books_{}_or_train'.format(a)] - counts['books_train']
+    counts['users_val_and_test'] = counts['users_val'] + counts['users_test'] - counts['users_val_or_test']
+
+    # sketches are only exact up to their error, so equality checks get a slack
+    slack = lambda n: int(3*rsd*n) if approx else 0
+
+    proportions = {}
+    checks = {}
+    def check(name, value, expected, ok):
+        checks[name] = {'value': value, 'expected': expected, 'ok': bool(ok)}
+
+    if down is not None:
+        n_down = counts['users_down']
+        proportions['train_users'] = counts['users_train']/max(n_down, 1)
+        proportions['val_users'] = counts['users_val']/max(n_down, 1)
+        proportions['test_users'] = counts['users_test']/max(n_down, 1)
+        proportions['recombined_interactions'] = counts['interactions_recombined']/max(counts['interactions_down'], 1)
+
+        check('train_user_prop', proportions['train_users'], 1, abs(proportions['train_users'] - 1) <= tol*0.2)
+        for t in ['val', 'test']:
+            p = proportions[t+'_users']
+            check(t+'_user_prop', p, 0.2, abs(p - 0.2) <= tol*0.2)
+        check('recombined_minus_down', counts['recombined_minus_down'], 0, 
+              counts['recombined_minus_down'] <= slack(counts['interactions_down']))
+        if not rm_unobserved:
+            check('down_minus_recombined', counts['down_minus_recombined'], 0, 
+                  counts['down_minus_recombined'] <= slack(counts['interactions_down']))
+        check('duplicate_rows_recombined', counts['duplicate_rows_recombined'], counts['duplicate_rows_down'], 
+              abs(counts['duplicate_rows_recombined'] - counts['duplicate_rows_down']) <= slack(counts['interactions_down']))
+    else:
+        check('duplicate_rows_recombined', counts['duplicate_rows_recombined'], 0, 
+              counts['duplicate_rows_recombined'] <= slack(counts['interactions_recombined']))
+
+    if full is not None and down is not None:
+        # full is not low-activity filtered, so this is only approximately fraction
+        proportions['down_users'] = counts['users_down']/max(counts['users_full'], 1)
+
+    check('val_test_user_overlap', counts['users_val_and_test'], 0, 
+          counts['users_val_and_test'] <= slack(counts['users_val']))
+    if rm_unobserved:
+        for t in ['val', 'test']:
+            for kind in ['users', 'books']:
+                name = 'unobserved_{}_{}'.format(kind, t)
+                check(name, counts[name], 0, counts[name] <= slack(counts['{}_{}'.format(kind, t)]))
+
+    report = {'fraction': fraction,
+              'mode': 'approx' if approx else 'exact',
+              'rsd': rsd if approx else None,
+              'counts': counts,
+              'proportions': proportions,
+              'checks': checks,
+              'ok': all(c['ok'] for c in checks.values())}
+
+    for name, c in sorted(checks.items()):
+        print('&&& {}: {} (expected {}) {}'.format(name, c['value'], c['expected'], 'OK' if c['ok'] else 'FAILED'))
+
+    if out_path is not None:
+        from storage import write_text
+        write_text(out_path, json.dumps(report, indent=2, sort_keys=True))
+        print('Wrote split report to ', out_path)
+
+    return report
+
+def quality_check(spark, fraction, synthetic, rm_unobserved=False, approx=False):
     '''
     Check downsample and split functions.
     Only works properly if splits not saved to pq.
@@ -568,12 +1165,12 @@ def quality_check(spark, fraction, synthetic, rm_unobserved=False):
     fraction: downsample fraction
     synthetic: boolean option to use synthetic data. Will use goodreads data if False.
     rm_unobserved: boolean option to remove all unobserved items and move unobserved users to train
+    approx: boolean option to use sketches for the distinct counts (see split_report)
+
+    Writes the report to split_report_[downsample percent].json
     '''
     if synthetic==False:
-        from getpass import getuser
-        net_id=getuser()
-        full_data_path = 'hdfs:/user/'+net_id+'/interactions_100_full.parquet'
-        full = spark.read.parquet(full_data_path)
+        full = read_parquet_store(spark, data_path('interactions_100_full.parquet'))
 
         columns_to_drop = ['is_read', 'is_reviewed']
         full = full.drop(*columns_to_drop)  
@@ -585,97 +1182,21 @@ def quality_check(spark, fraction, synthetic, rm_unobserved=False):
 
     assert down!=None, 'Splits already saved to Parquet. No access to downsampled df used to create them.'
 
-    train = train.cache()
-    test = test.cache()
-    val = val.cache()
-    full = full.cache()
-    down = down.cache()
-
-    print('\n')
-
-    all_users=full.select('user_id').distinct()
-    all_users_count=all_users.count()
-    print('&&& all users count: ', all_users_count)
-
-    down_users=down.select('user_id').distinct()
-    down_users_count=down_users.count()
-    print('&&& downsampled users count: ', down_users_count)
-
-    train_users=train.select('user_id').distinct()
-    train_users_count=train_users.count()
-    print('&&& train users count: ', train_users_count)
-    
-    val_users=val.select('user_id').distinct()
-    val_users_count=val_users.count()
-    print('&&& val users count: ', val_users_count)
-
-    test_users=test.select('user_id').distinct()
-    test_users_count=test_users.count()
-    print('&&& test users count: ', test_users_count)
-
-    print('\n')
-
-    print('&&& downsampled user prop (should be {}): '.format(fraction), down_users_count/all_users_count)
-    print('&&& train user prop (should be 1): ', train_users_count/down_users_count)
-    print('&&& val user prop (should be 0.2): '.format(fraction*0.2), val_users_count/down_users_count)
-    print('&&& test user prop (should be 0.2): '.format(fraction*0.2), test_users_count/down_users_count)
-
-    print('\n')
-
-    down_inter_count = down.count()
-    train_inter_count = train.count()
-    val_inter_count = val.count()
-    test_inter_count = test.count()
-
-    print('&&& full interactions: ', full.count())
-    print('&&& down interactions: ', down_inter_count)
-    print('&&& train interactions: ', train_inter_count)
-    print('&&& val interactions: ', val_inter_count)
-    print('&&& test interactions: ', test_inter_count)
-
-    print('&&& summed splits interactions prop (should be 1): ', (train_inter_count + val_inter_count + test_inter_count)/down_inter_count)
-
-    print('\n')
-
     if synthetic:
         print('down:')
-        down.orderBy('user_id').show(down_inter_count, False)
+        down.orderBy('user_id').show(down.count(), False)
 
         print('train:')
-        train.orderBy('user_id').show(train_inter_count, False)
+        train.orderBy('user_id').show(train.count(), False)
 
         print('val:')
-        val.orderBy('user_id').show(val_inter_count, False)
+        val.orderBy('user_id').show(val.count(), False)
 
         print('test:')
-        test.orderBy('user_id').show(test_inter_count, False)
+        test.orderBy('user_id').show(test.count(), False)
 
-    recombined=train.union(val).union(test)
-    recombined = recombined.cache()
-    if synthetic:
-        print('recombined:')
-        recombined.orderBy('user_id').show(recombined.count(), False)
-    down.createOrReplaceTempView('down')
-    recombined.createOrReplaceTempView('recombined')
-    differences1 = spark.sql('SELECT * FROM down EXCEPT SELECT * FROM recombined')
-    print('&&& downsampled - recombined (should be the number removed due to unobserved items): ', differences1.count())
-    if synthetic:
-        differences1.show()
-    differences2 = spark.sql('SELECT * FROM recombined EXCEPT SELECT * FROM down')
-    print('&&& recombined - downsampled (should be 0): ', differences2.count())
-    if synthetic:
-        differences2.show()
-
-    print('\n')
-
-    duplicates_full = full.groupby(['user_id', 'book_id']).count().where('count > 1')
-    duplicates_down = down.groupby(['user_id', 'book_id']).count().where('count > 1')
-    duplicates_rec = recombined.groupby(['user_id', 'book_id']).count().where('count > 1')
-
-    dupcount = duplicates_down.count()
-    print('&&& full duplicates count (assumed to be 0): ', duplicates_full.count())
-    print('&&& downsampled duplicates count (assumed to be 0): ', dupcount)
-    print('&&& recombined duplicates count (should be {}): '.format(dupcount), duplicates_rec.count())
+    split_report(spark, train, val, test, fraction, down=down, full=full, rm_unobserved=rm_unobserved, 
+                 approx=approx, out_path='split_report_{}.json'.format(int(fraction*100)))
 
     return full, down, train, val, test
 
@@ -722,11 +1243,96 @@ def test_caching_and_persisting(spark):
     return
     
     
-def get_synth_data(spark, size='large', version='explicit'):
+def uniform_draw(seed, *cols):
+    '''
+    Returns column of pseudo-random uniforms in (0, 1] hashed from seed and cols
+
+    Unlike rand(seed), the draw of a row depends only on its own values,
+    not on how the data is partitioned.
+    '''
+    import pyspark.sql.functions as F
+    return (F.pmod(F.hash(F.lit(seed), *cols), F.lit(2147483647)) + 1) / 2147483647.0
+
+def generate_synth_data(spark, n_users=100000, n_books=50000, min_items=5, user_alpha=1.5, 
+                        book_exponent=1.1, rating_probs=[0.55, 0.015, 0.03, 0.09, 0.15, 0.165], 
+                        read_prob=0.5, review_prob=0.12, seed=42, version='explicit', num_partitions=None):
+    '''
+    Returns synthetic interactions df with power-law user activity and book popularity
+
+    Rows are generated on the executors from spark.range, so there is no driver-side data
+    and the size is only limited by the cluster. Every value is hashed from (seed, user_id, ...),
+    so the same arguments give the same data for any num_partitions, and 
+    version='explicit' is exactly the user_id, book_id, rating columns of version='full'.
+
+    n_users: number of users (user_id 0..n_users-1)
+    n_books: number of books (book_id 1..n_books, book_id 1 is the most popular)
+    min_items: smallest number of interactions per user
+    user_alpha: Pareto shape of the number of interactions per user
+                (smaller is heavier-tailed; mean is min_items*user_alpha/(user_alpha-1) for user_alpha > 1)
+    book_exponent: Zipf exponent of book popularity
+    rating_probs: probabilities of ratings 0..5 (0 = shelved but not rated).
+                  The default roughly matches the Goodreads interactions.
+    read_prob: probability that an unrated interaction has is_read=1 (rated ones are always read)
+    review_prob: probability that a rated interaction has is_reviewed=1
+    seed: random seed
+    version: 'explicit' (user_id, book_id, rating) or 
+             'full' (user_id, book_id, is_read, rating, is_reviewed, like the csv)
+    num_partitions: partitions of the user range (spark default parallelism if None)
+
+    Users draw their number of interactions from a Pareto distribution (capped at n_books) 
+    and each interaction draws a book from a continuous power law on [1, n_books+1).
+    Repeated (user_id, book_id) draws are dropped, so the heaviest users end up
+    with somewhat fewer interactions than drawn.
+    '''
+    import pyspark.sql.functions as F
+
+    assert abs(sum(rating_probs) - 1) < 1e-6, 'rating_probs must sum to 1'
+
+    users = spark.range(n_users, numPartitions=num_partitions).withColumnRenamed('id', 'user_id')
+
+    # Pareto number of interactions by inverse cdf: min_items * u^(-1/alpha)
+    n_items = F.least(F.ceil(F.lit(min_items) * F.pow(uniform_draw(seed, F.col('user_id'), F.lit(1)), -1.0/user_alpha)),
+                      F.lit(n_books))
+    df = users.withColumn('n_items', n_items.cast('int')) \
+              .select('user_id', F.explode(F.sequence(F.lit(1), F.col('n_items'))).alias('j'))
+
+    # book rank from a power law on [1, n_books+1) by inverse cdf
+    v = uniform_draw(seed, F.col('user_id'), F.col('j'), F.lit(2))
+    if abs(book_exponent - 1) < 1e-9:
+        x = F.pow(F.lit(float(n_books + 1)), v)
+    else:
+        e = 1.0 - book_exponent
+        x = F.pow((F.lit((n_books + 1.0)**e) - 1) * v + 1, 1.0/e)
+    df = df.withColumn('book_id', F.least(F.floor(x), F.lit(n_books)).cast('int')) \
+           .dropDuplicates(['user_id', 'book_id'])
+
+    # ratings from the cumulative distribution of rating_probs
+    r = uniform_draw(seed, F.col('user_id'), F.col('book_id'), F.lit(3))
+    rating = F.lit(5)
+    cum = 1.0
+    for value in range(5, 0, -1):
+        cum -= rating_probs[value]
+        rating = F.when(r <= cum, F.lit(value - 1)).otherwise(rating)
+    df = df.withColumn('rating', rating)
+
+    if version=='full':
+        read = uniform_draw(seed, F.col('user_id'), F.col('book_id'), F.lit(4)) <= read_prob
+        review = uniform_draw(seed, F.col('user_id'), F.col('book_id'), F.lit(5)) <= review_prob
+        df = df.withColumn('is_read', F.when((F.col('rating') > 0) | read, 1).otherwise(0)) \
+               .withColumn('is_reviewed', F.when((F.col('rating') > 0) & review, 1).otherwise(0)) \
+               .select('user_id', 'book_id', 'is_read', 'rating', 'is_reviewed')
+    else:
+        df = df.select('user_id', 'book_id', 'rating')
+
+    return compact_types(df)
+
+def get_synth_data(spark, size='large', version='explicit', **gen_args):
     '''
     Returns synethetic dataframe
 
-    size options: 'large' or 'small'
+    size options: 'large', 'small' or 'generated'
+    'generated' returns generate_synth_data(spark, version=version, **gen_args),
+        for load testing at any scale
     'large' should be used for testing downsampling and splitting
         - only 'explicit' form is available
         There are 60 distinct user_ids, 1-60
@@ -744,6 +1350,9 @@ def get_synth_data(spark, size='large', version='explicit'):
         Users 1 and 2 each have their 1st rating be 0.
         130 total interactions
     '''
+    if size=='generated':
+        return generate_synth_data(spark, version=version, **gen_args)
+
     if size=='small':
         if version=='explicit':
             return spark.createDataFrame(
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+'''
+Fold-in of new users into a fitted ALS model, without refitting
+
+A user who was not in train (or arrived after the fit) has no factor vector.
+With the item factors Y held fixed, the user's factor solves the same problem that
+ALS solves for every user in its user half-iteration (see numpy_als):
+    explicit: (Y_u^T Y_u + reg n_u I) x_u = Y_u^T r_u
+    implicit: (Y^T Y + Y_u^T C1_u Y_u + reg n_u I) x_u = Y_u^T (1 + C1_u) p_u
+The histories of a batch of users are packed into a CSR matrix over the model's books.
+numpy_als.sweep then solves all of them: one batched solve per block of users with
+histories of similar length.
+
+Folding in a user of train with the model's reg reproduces (up to the fit's last
+item update) the factor ALS learned for them; benchmark_fold_in reports this agreement.
+'''
+
+import numpy as np
+
+
+def histories_to_csr(model, histories, value_col='rating'):
+    '''
+    Returns CSR dict (as csr.matrices_from_df) of histories over the model's books
+    Books the model has no factors for are left out
+
+    histories: dict of user id -> list of (book_id, value) pairs
+    '''
+    from csr import build_csr
+
+    user_ids = np.array(sorted(histories), dtype=np.int64)
+    counts = np.array([len(histories[u]) for u in user_ids], dtype=np.int64)
+    pairs = np.array([pair for u in user_ids for pair in histories[u]], dtype=np.float64).reshape(-1, 2)
+    rows = np.repeat(np.arange(len(user_ids)), counts)
+    books = pairs[:, 0].astype(np.int64)
+
+    book_ids = model['book_ids']
+    pos = np.minimum(np.searchsorted(book_ids, books), len(book_ids) - 1)
+    known = book_ids[pos]==books
+
+    indptr, indices, vals = build_csr(rows[known], pos[known], {value_col: pairs[known, 1].astype(np.float32)},
+                                      len(user_ids))
+    return {'indptr': indptr, 'indices': indices, value_col: vals[value_col],
+            'user_ids': user_ids, 'book_ids': book_ids, 'shape': (len(user_ids), len(book_ids)), 'fmt': 'csr'}
+
+def fold_in(model, histories, reg=None, value_col='rating', implicit=None, alpha=None, cg_steps=10,
+            num_threads=None):
+    '''
+    Solves the factors of the users in histories against the model's fixed item factors
+    Returns users (ids with at least one known book) and their factors (float32)
+
+    model: model dict with user/item factors and ids (numpy_als.fit, artifact.load_artifact)
+    histories: dict of user id -> list of (book_id, value) pairs
+    reg: regularization parameter (the model's reg if None; use the lambda the model was fit with)
+    implicit, alpha: implicit-feedback model and confidence scale (the model's if None)
+    cg_steps: conjugate gradient steps of the implicit solve, started from zero factors
+    '''
+    from numpy_als import make_blocks, sweep
+
+    reg = model.get('reg') if reg is None else reg
+    assert reg is not None, 'reg must be given for models without a recorded reg'
+    implicit = model.get('implicit', False) if implicit is None else implicit
+    alpha = model.get('alpha', 1.0) if alpha is None else alpha
+
+    matrix = histories_to_csr(model, histories, value_col)
+    rank = model['item_factors'].shape[1]
+    current = np.zeros((matrix['shape'][0], rank), dtype=np.float32)
+
+    factors = sweep(matrix, value_col, model['item_factors'], reg, make_blocks(matrix['indptr'], rank),
+                    num_threads, implicit, alpha, current, cg_steps)
+    has_history = np.diff(matrix['indptr']) > 0
+    return matrix['user_ids'][has_history], factors[has_history]
+
+def recommend_fold_in(model, histories, k=500, exclude_seen=False, **kwargs):
+    '''
+    Returns users, books (n x k original book ids) and scores (n x k) for folded-in users,
+    like numpy_als.recommend
+
+    exclude_seen: boolean option to leave the books of each user's history out of their top k
+                  (scores -inf where fewer than k are left)
+    kwargs: passed to fold_in
+    '''
+    from scoring import topk
+
+    users, factors = fold_in(model, histories, **kwargs)
+    exclude = None
+    if exclude_seen:
+        matrix = histories_to_csr(model, histories, kwargs.get('value_col', 'rating'))
+        # fold_in drops users without known books; their rows are empty
+        has_history = np.diff(matrix['indptr']) > 0
+        exclude = {'indptr': np.r_[matrix['indptr'][0], matrix['indptr'][1:][has_history]],
+                   'indices': matrix['indices']}
+    top, scores = topk(factors, model['item_factors'], k, exclude=exclude)
+    return users, model['book_ids'][top], scores
+
+def histories_from_df(df, value_col='rating'):
+    '''
+    Collects a spark df of interactions into a dict of user id -> list of (book_id, value)
+    '''
+    histories = {}
+    for row in df.select('user_id', 'book_id', value_col).toLocalIterator():
+        histories.setdefault(row[0], []).append((row[1], row[2]))
+    return histories
+
+def fold_in_df(spark, model, df, k=500, value_col='rating', **kwargs):
+    '''
+    Returns top k recommendations, with the schema of ALSModel.recommendForUserSubset,
+    for the users of a spark df of interactions folded into model
+
+    df: spark df with user_id, book_id and value_col (the new users' histories)
+    kwargs: passed to recommend_fold_in (e.g. exclude_seen) and fold_in
+    '''
+    from numpy_als import recs_to_df
+    histories = histories_from_df(df, value_col)
+    users, books, scores = recommend_fold_in(model, histories, k, value_col=value_col, **kwargs)
+    return recs_to_df(spark, users, books, scores, valid=np.isfinite(scores))
+
+def benchmark_fold_in(model, histories, fraction, reg, k=500, batch_sizes=[1, 100, 10000]):
+    '''
+    Times fold_in plus top k for batches of users from histories
+    Appends ms per user and the agreement (mean top k overlap) with the model's own
+    factors of the same users to foldin_benchmark.txt
+    '''
+    from time import localtime, strftime, time
+    from numpy_als import recommend
+
+    users = sorted(histories)
+    for batch_size in batch_sizes:
+        batch = {u: histories[u] for u in users[:batch_size]}
+        start = time()
+        folded, books, _ = recommend_fold_in(model, batch, k, reg=reg)
+        ms = 1000 * (time() - start) / max(len(batch), 1)
+
+        fitted, fitted_books, _ = recommend(model, folded, k)
+        in_fitted = np.isin(folded, fitted)
+        overlap = [len(np.intersect1d(a, b)) / len(a) for a, b in zip(books[in_fitted], fitted_books)]
+        agreement = float(np.mean(overlap)) if overlap else float('nan')
+
+        line = '{}: {}% rank={} lambda={} k={} batch={}: {:.2f} ms/user, agreement with fitted factors {:.4f}'\
+                    .format(strftime("%Y-%m-%d %H:%M:%S", localtime()), int(fraction*100),
+                            model['item_factors'].shape[1], reg, k, len(batch), ms, agreement)
+        print(line)
+        f = open("foldin_benchmark.txt", "a")
+        f.write(line + '\n')
+        f.close()
+    return
@@ -3,11 +3,9 @@
 
 def get_isrev_splits_from_ratings(spark, train, val, fraction, 
                                     test=None, get_test=True, save_pq=False, 
-                                    synthetic=False, final_test=False):
+                                    synthetic=False, final_test=False, synth_args=None):
 
-    #get netid
-    from getpass import getuser
-    net_id=getuser()
+    from storage import data_path
 
     if not get_test:
         isrev_test = None
@@ -15,43 +13,39 @@ def get_isrev_splits_from_ratings(spark, train, val, fraction,
     if not synthetic:
 
         # set split paths
-        train_isrev_path = 'hdfs:/user/'+net_id+'/isrev_{}_train.parquet'.format(int(fraction*100))
-        val_isrev_path = 'hdfs:/user/'+net_id+'/isrev_{}_val.parquet'.format(int(fraction*100))
+        train_isrev_path = data_path('isrev_{}_train.parquet'.format(int(fraction*100)))
+        val_isrev_path = data_path('isrev_{}_val.parquet'.format(int(fraction*100)))
+        test_isrev_path = data_path('isrev_{}_test.parquet'.format(int(fraction*100)))
 
         if final_test:
-            train_isrev_path = 'hdfs:/user/'+net_id+'/isrev_final_{}_train.parquet'.format(int(fraction*100))
-            val_isrev_path = 'hdfs:/user/'+net_id+'/isrev_final_{}_val.parquet'.format(int(fraction*100))
+            train_isrev_path = data_path('isrev_final_{}_train.parquet'.format(int(fraction*100)))
+            val_isrev_path = data_path('isrev_final_{}_val.parquet'.format(int(fraction*100)))
+            test_isrev_path = data_path('isrev_final_{}_test.parquet'.format(int(fraction*100)))
 
         # read in isrev dfs from parquet if they exist
         try:
-            isrev_train = spark.read.parquet(train_isrev_path)
-            isrev_val = spark.read.parquet(val_isrev_path)
+            from data_prep import read_parquet_store
+            isrev_train = read_parquet_store(spark, train_isrev_path)
+            isrev_val = read_parquet_store(spark, val_isrev_path)
             if get_test:
-                isrev_test = spark.read.parquet(test_isrev_path)
+                isrev_test = read_parquet_store(spark, test_isrev_path)
             print('Succesfullly read is_reviewed splits from hdfs')
 
         # create isrev dfs if they dont exist in hdfs
         except:
-            from data_prep import path_exist, write_to_parquet
+            from data_prep import read_interactions
 
             # read in full data
-            full_data_path = 'hdfs:/user/'+net_id+'/interactions_100_full.parquet'
-            if path_exist(full_data_path):
-                # if full interactions dataset already saved to parquet, read in pq df
-                print('Reading interactions file from Parquet')
-                df = spark.read.parquet(full_data_path)
-            else:
-                from data_prep import read_data_from_csv
-                print('Reading interactions file from csv')
-                df_csv = read_data_from_csv(spark, 'interactions')
-                # write full interactions dataset to parquet if not already saved
-                df = write_to_parquet(spark, df_csv, 'interactions_100_full')
+            df = read_interactions(spark)
 
             # create tempviews
             df.createOrReplaceTempView('df')
             train.createOrReplaceTempView('train')
             val.createOrReplaceTempView('val')
 
+            # df and the saved splits are bucketed by user_id with the same bucket count, so these
+            # (user_id, book_id) joins do not shuffle (see requireAllClusterKeysForCoPartition in main.py)
+
             # create dfs from inner joins
             isrev_train =  spark.sql('SELECT df.user_id, df.book_id, is_reviewed \
                                       FROM df INNER JOIN train \
@@ -66,11 +60,11 @@ def get_isrev_splits_from_ratings(spark, train, val, fraction,
             isrev_val = isrev_val.coalesce(int((0.25+fraction)*200))
 
         if save_pq:
-            from data_prep import write_to_parquet
-            isrev_train = write_to_parquet(spark, isrev_train, train_isrev_path)
-            isrev_val = write_to_parquet(spark, isrev_val, val_isrev_path)
+            from data_prep import write_bucketed
+            isrev_train = write_bucketed(spark, isrev_train, train_isrev_path)
+            isrev_val = write_bucketed(spark, isrev_val, val_isrev_path)
             if get_test:
-                isrev_test = write_to_parquet(spark, isrev_test, test_isrev_path)
+                isrev_test = write_bucketed(spark, isrev_test, test_isrev_path)
 
 
     if synthetic:
@@ -82,7 +76,11 @@ def get_isrev_splits_from_ratings(spark, train, val, fraction,
 
         from data_prep import get_synth_data
 
-        df = get_synth_data(spark, size='small', version='full')
+        if synth_args is not None:
+            # generated data is deterministic, so this is the same data train and val were made from
+            df = get_synth_data(spark, size='generated', version='full', **synth_args)
+        else:
+            df = get_synth_data(spark, size='small', version='full')
 
         # create tempviews
         df.createOrReplaceTempView('df')
@@ -112,7 +110,7 @@ def hybrid_pred_labels(spark, train, val, fraction,
                         k=500, lamb=1, rank=10, isrev_weight=1,
                         debug=False, synthetic=False, 
                         save_revsplits = True, save_model=True, 
-                        save_recs_pq=False, final_test=False):
+                        save_recs_pq=False, final_test=False, synth_args=None):
 
     from pyspark.sql.functions import col, explode, collect_list, size, desc
     from pyspark.sql import Window
@@ -126,7 +124,7 @@ def hybrid_pred_labels(spark, train, val, fraction,
 
     isrev_train, isrev_val, _ = get_isrev_splits_from_ratings(spark, train, val, \
                                 fraction, get_test=False, save_pq=save_revsplits, \
-                                synthetic=synthetic, final_test=final_test)
+                                synthetic=synthetic, final_test=final_test, synth_args=synth_args)
 
     rating_recs = get_recs(spark, train, fraction, val=val, 
                                     lamb=lamb, rank=rank, k=k, implicit=False,
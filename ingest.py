@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+'''
+Incremental ingestion of new Goodreads interactions
+
+A store (e.g. interactions_100_full.parquet, or a saved split) is a bucketed base table
+plus a directory of per-user patches next to it ([store]_patches/batch_00001, ...).
+Each patch batch holds:
+    users - user_ids whose rows are replaced by this batch
+    rows - the complete new rows of those users
+Readers (read_patched) take the base, drop every patched user and add back that user's
+rows from the latest batch that contains them. The patched users are broadcast to that
+join; past MAX_BROADCAST_USERS of them, read_patched falls back to a shuffle join and asks
+for compact_store, which folds the patches into a new base.
+
+store_version identifies the data a store currently holds (its base version plus the
+names of its patch batches). Compaction keeps the version, since the rows do not change.
+
+ingest_delta merges a delta file of interactions into the interactions store
+(upsert on (user_id, book_id)) and re-derives the low-activity filter and the
+saved fused splits of every fraction for the affected users only, so a refresh
+costs in proportion to the delta instead of the full history.
+'''
+
+
+# most patched users of a store that read_patched broadcasts
+MAX_BROADCAST_USERS = 1000000
+
+
+def patches_path(path):
+    '''
+    Returns directory holding the patch batches of the store at path
+    '''
+    path = path.rstrip('/')
+    if path.endswith('.parquet'):
+        path = path[:-len('.parquet')]
+    return path + '_patches'
+
+def list_batches(path):
+    '''
+    Returns sorted list of patch batch names of the store at path
+    (in-progress batches start with '_' and are skipped)
+    '''
+    from storage import list_dir
+    return [b for b in list_dir(patches_path(path)) if b.startswith('batch_')]
+
+def patched_stores():
+    '''
+    Returns paths of the stores under the output root that have patch batches
+    (the interactions store and the splits ingest_delta patched)
+    '''
+    from storage import get_root, join, list_dir, path_exist
+
+    stores = []
+    for name in list_dir(get_root()):
+        if name.endswith('_patches'):
+            path = join(get_root(), name[:-len('_patches')] + '.parquet')
+            if path_exist(path) and len(list_batches(path)) > 0:
+                stores.append(path)
+    return stores
+
+def store_version(path):
+    '''
+    Returns version id of the data in the store at path (None if there is no store at path)
+
+    Changes whenever a patch batch is added or the base is rewritten with new rows,
+    stays the same when compact_store folds the patches into the base.
+    Plain Parquet stores written before bucketing have no recorded version; theirs is
+    derived from the names of their part files, which every rewrite changes.
+    '''
+    from hashlib import sha1
+    from data_prep import is_bucketed, bucketing_meta
+    from storage import path_exist, list_dir
+
+    if is_bucketed(path):
+        # bucketed stores written before versioning share one version
+        base = bucketing_meta(path).get('version', 'unversioned')
+    elif path_exist(path):
+        parts = [name for name in list_dir(path) if not name.startswith(('_', '.'))]
+        base = 'legacy_' + sha1(','.join(parts).encode('utf-8')).hexdigest()[:16]
+    else:
+        return None
+
+    batches = list_batches(path)
+    if len(batches)==0:
+        return base
+    return sha1(','.join([base] + batches).encode('utf-8')).hexdigest()[:16]
+
+def read_patched(spark, path):
+    '''
+    Returns df of the store at path with all patch batches applied
+    Same as read_parquet_store if the store has no patches
+    '''
+    import pyspark.sql.functions as F
+    from data_prep import read_parquet_store
+    from storage import join
+
+    base = read_parquet_store(spark, path)
+    batches = list_batches(path)
+
+    if len(batches)==0:
+        return base
+
+    print('Applying {} patch batches to {}'.format(len(batches), path))
+    users = None
+    rows = None
+    for i, b in enumerate(batches):
+        b_users = spark.read.parquet(join(patches_path(path), b, 'users')).withColumn('batch', F.lit(i))
+        b_rows = spark.read.parquet(join(patches_path(path), b, 'rows')).withColumn('batch', F.lit(i))
+        users = b_users if users is None else users.union(b_users)
+        rows = b_rows if rows is None else rows.unionByName(b_rows)
+
+    # counted from the batches' parquet metadata; users in several batches count once per batch
+    n_patched = users.count()
+    hint = F.broadcast
+    if n_patched > MAX_BROADCAST_USERS:
+        print('NOTICE: {} has {} patched users, too many to broadcast; compact it (compact_store)'.format(path, n_patched))
+        hint = lambda df: df
+
+    # every patched user takes its rows from the latest batch that contains it
+    latest = users.groupBy('user_id').agg(F.max('batch').alias('batch'))
+    rows = rows.join(hint(latest), ['user_id', 'batch']) \
+               .select([F.col(f.name).cast(f.dataType) for f in base.schema.fields])
+
+    return base.join(hint(latest.select('user_id')), 'user_id', 'left_anti').union(rows)
+
+def apply_user_patch(spark, path, users, rows):
+    '''
+    Writes a new patch batch for the store at path
+
+    users: df with a user_id column, the users whose rows are replaced
+           (users with no rows in rows are removed from the store)
+    rows: df with the complete new rows of those users, same columns as the store
+
+    The batch is written under a temporary name and renamed when complete,
+    so readers never see a half-written batch.
+    '''
+    from data_prep import compact_types
+    from storage import join, rename, mark_written
+
+    batches = list_batches(path)
+    n = int(batches[-1][len('batch_'):]) + 1 if batches else 1
+    batch = 'batch_{:05d}'.format(n)
+    tmp_path = join(patches_path(path), '_' + batch)
+
+    print('Writing patch {} for {}'.format(batch, path))
+    users.select('user_id').distinct().write.mode('overwrite').parquet(join(tmp_path, 'users'))
+    compact_types(rows).write.mode('overwrite').parquet(join(tmp_path, 'rows'))
+    rename(tmp_path, join(patches_path(path), batch))
+    # the first batch also creates the patches directory (see patched_stores)
+    mark_written(patches_path(path))
+    return
+
+def compact_store(spark, path):
+    '''
+    Folds all patch batches of the store at path into a new bucketed base
+    '''
+    from data_prep import write_bucketed, bucketed_table_name
+    from storage import rename, delete, join, path_exist, read_text, write_text
+
+    if len(list_batches(path))==0:
+        print('No patches to compact for ', path)
+        return
+
+    tmp_path = path.rstrip('/') + '_compacting'
+    old_path = path.rstrip('/') + '_old'
+
+    write_bucketed(spark, read_patched(spark, path), tmp_path, version=store_version(path))
+
+    # saved splits carry a cache manifest (see split_cache.py)
+    if path_exist(join(path, '_manifest.json')):
+        write_text(join(tmp_path, '_manifest.json'), read_text(join(path, '_manifest.json')))
+
+    rename(path, old_path)
+    rename(tmp_path, path)
+    delete(old_path)
+    delete(patches_path(path))
+
+    # external tables: dropping only forgets the registration, files stay
+    spark.sql('DROP TABLE IF EXISTS {}'.format(bucketed_table_name(path)))
+    spark.sql('DROP TABLE IF EXISTS {}'.format(bucketed_table_name(tmp_path)))
+    print('Compacted ', path)
+    return
+
+def read_delta(spark, delta_path, delta_format='csv'):
+    '''
+    Returns df of a delta of interactions, one row per (user_id, book_id)
+
+    delta_path: csv (same columns as goodreads_interactions.csv) or parquet
+    delta_format: 'csv' or 'parquet'
+    '''
+    from data_prep import compact_types
+
+    if delta_format=='csv':
+        delta = spark.read.csv(delta_path, header = True,
+                               schema = 'user_id INT, book_id INT, is_read INT, rating INT, is_reviewed INT')
+    else:
+        delta = spark.read.parquet(delta_path)
+    return compact_types(delta).dropDuplicates(['user_id', 'book_id'])
+
+def ingest_delta(spark, delta_path, delta_format='csv', seed=42, low_item_threshold=10, update_splits=True, 
+                 fractions=[.01, .05, 0.25, 1]):
+    '''
+    Merges a delta of interactions into the interactions store
+    Updates the derived split stores for the affected users only
+
+    spark: spark
+    delta_path: csv (same columns as goodreads_interactions.csv) or parquet of new/changed interactions
+    delta_format: 'csv' or 'parquet'
+    seed, low_item_threshold: parameters the saved fused splits were built with
+    update_splits: boolean option to patch the saved fused splits
+                   (train/val/test with rm_zeros=True and rm_unobserved=True)
+    fractions: downsample fractions whose saved fused splits are patched (missing ones are skipped)
+
+    Upserts are on (user_id, book_id): a delta row replaces the stored row with the same key.
+
+    Only splits made with split_mode='fused' can be patched per user, because their
+    hash-based user samples, user roles and holdouts depend only on the user's own 
+    interactions. Splits built with a book threshold (k-core) are not patched. Held-out rows of
+    unaffected users that were dropped as unobserved items are not restored when the delta
+    makes those items observed; compact and rebuild the splits to pick those up.
+    '''
+    import pyspark.sql.functions as F
+    from pyspark.sql import Window
+    from time import localtime, strftime
+    from data_prep import read_interactions, tag_splits_fused, \
+                          split_paths, user_sample_bucket, SAMPLE_BUCKETS
+    from split_cache import split_params, data_version, fingerprint, read_manifest, refresh_manifest
+    from storage import data_path
+
+    print('{}: Reading delta {}'.format(strftime("%Y-%m-%d %H:%M:%S", localtime()), delta_path))
+    delta = read_delta(spark, delta_path, delta_format)
+    delta.persist()
+
+    # affected users are delta-sized, and a literal IN filter lets spark prune
+    # buckets and parquet row groups of the user_id-sorted store
+    affected = [row.user_id for row in delta.select('user_id').distinct().collect()]
+    users = spark.createDataFrame([(u,) for u in affected], 'user_id INT')
+    print('{}: {} affected users'.format(strftime("%Y-%m-%d %H:%M:%S", localtime()), len(affected)))
+
+    # upsert affected users' rows
+    full_data_path = data_path('interactions_100_full.parquet')
+    current = read_interactions(spark)
+    current_affected = current.filter(F.col('user_id').isin(affected))
+    merged = current_affected.join(delta.select('user_id', 'book_id'), ['user_id', 'book_id'], 'left_anti') \
+                             .union(delta.select(current.columns))
+    merged.persist()
+
+    old_version = data_version()
+    apply_user_patch(spark, full_data_path, users, merged)
+    new_version = data_version()
+
+    if not update_splits:
+        return
+
+    # same filters as read_sample_split_pq(rm_zeros=True), restricted to affected users
+    w_user = Window.partitionBy('user_id')
+    nolow = merged.filter(merged.rating > 0) \
+                  .withColumn('user_count', F.count('*').over(w_user)) \
+                  .filter(F.col('user_count') > low_item_threshold) \
+                  .drop('user_count') \
+                  .select('user_id', 'book_id', 'rating')
+
+    tagged = tag_splits_fused(nolow, seed=seed)
+    tagged.persist()
+
+    split_cols = ['user_id', 'book_id', 'rating']
+    for fraction in fractions:
+        train_path, val_path, test_path = split_paths(fraction, low_item_threshold, 'fused')
+
+        # only patch splits that were current before this delta and built with these parameters
+        expected = fingerprint(split_params(fraction, seed=seed, low_item_threshold=low_item_threshold, split_mode='fused'), 
+                               old_version)
+        manifests = [read_manifest(p) for p in [train_path, val_path, test_path]]
+        if not all(m is not None and m['fingerprint']==expected for m in manifests):
+            print('NOTICE: No current {}% fused splits with seed={}, low_item_threshold={}, skipping.'\
+                        .format(int(fraction*100), seed, low_item_threshold))
+            continue
+
+        # affected users inside this fraction's hash-based user sample
+        in_sample = user_sample_bucket(seed) < int(round(fraction*SAMPLE_BUCKETS))
+        users_f = users.filter(in_sample)
+        tagged_f = tagged.filter(in_sample)
+        new_train = tagged_f.filter(tagged_f.split=='train')
+        holdout = tagged_f.filter(tagged_f.split!='train')
+
+        # holdout books are observed if they are in the new train rows of affected users
+        # or in the train rows of any other user in the split
+        holdout_books = holdout.select('book_id').distinct()
+        other_train_books = read_patched(spark, train_path) \
+                                .join(F.broadcast(users_f), 'user_id', 'left_anti') \
+                                .join(F.broadcast(holdout_books), 'book_id', 'left_semi') \
+                                .select('book_id')
+        observed_items = other_train_books.union(new_train.select('book_id')).distinct()
+        holdout_ob = holdout.join(F.broadcast(observed_items), 'book_id', 'left_semi')
+
+        apply_user_patch(spark, train_path, users_f, new_train.select(split_cols))
+        apply_user_patch(spark, val_path, users_f, holdout_ob.filter(holdout_ob.split=='val').select(split_cols))
+        apply_user_patch(spark, test_path, users_f, holdout_ob.filter(holdout_ob.split=='test').select(split_cols))
+
+        for p in [train_path, val_path, test_path]:
+            refresh_manifest(p, new_version)
+
+    print('{}: Finished ingesting {}'.format(strftime("%Y-%m-%d %H:%M:%S", localtime()), delta_path))
+    return
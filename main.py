@@ -2,7 +2,7 @@
 
 import sys
 from pyspark.sql import SparkSession
-from data_prep import read_sample_split_pq, save_down_splits
+from data_prep import read_sample_split_pq, save_down_splits, benchmark_splits
 from modeling import tune, get_recs, get_val_ids_and_true_labels, eval
 from hybrid import tune_isrev_weight, hybrid_pred_labels
 from time import localtime, strftime
@@ -16,20 +16,67 @@ Usage:
     [rank] [regularization parameter]
     Note: [regularization parameter] not necessary if tuning hybrid
 
+    Additional argument if ingesting:
+    [delta csv path]
+
+    Additional arguments if refreshing a model after ingesting:
+    [rank] [regularization parameter] [delta csv path]
+
+    Optional arguments if tuning:
+    [engine] 'spark' or 'numpy'
+    [max parallel] number of grid cells to run at once (engine 'spark'), or 'auto'
+
+    Additional arguments for serve, serve-bench, fold-in-bench and export-model:
+    [rank] [regularization parameter]
+    Optional for serve: [port]
+    Optional for export-model: [float16]
+
+    Additional argument for split-report:
+    [approx] to use approximate distinct counts
+
     Additional arguments if requesting resources from Dumbo:
     [memory (# of gigabytes to request)] [# cores to request] [# instances to request]
+
+    Storage locations (see storage.py), e.g. to run on a single machine:
+    $ GOODREADS_DATA=/data/goodreads GOODREADS_ROOT=/data/out spark-submit --master local[*] main.py [task] ...
 '''
 
 
 def main(spark, task, fraction, k):
 
-    # read in data, get splits
-    _, train, val, test = read_sample_split_pq(spark,  fraction=fraction, seed=42, \
-                            save_pq=False, rm_unobserved=True, rm_zeros=True, 
-                            low_item_threshold=10, synthetic=False, debug=False)
+    if task=='ingest':
+        # merge a delta of interactions into the store and patch the affected users' splits
+        from ingest import ingest_delta
+        ingest_delta(spark, sys.argv[4])
+        return
 
-    train = train.coalesce((int((0.25+fraction)*200))) 
-    val = val.coalesce((int((0.25+fraction)*200))) 
+    if task=='compact':
+        # fold ingested patches into new bucketed bases: the interactions store and every
+        # saved split ingest_delta patched, whatever fraction and parameters it was built with
+        from ingest import compact_store, patched_stores
+        for path in patched_stores():
+            compact_store(spark, path)
+        return
+
+    if task=='split-bench':
+        # time the split engines at 1%, 5% and 25%
+        # results are appended to split_benchmark.txt
+        benchmark_splits(spark)
+        return
+
+    # read in data, get splits
+    split_args = {'seed': 42, 'rm_unobserved': True, 'rm_zeros': True, 'low_item_threshold': 10}
+    if task=='refresh':
+        # ingest_delta only patches the fused splits
+        split_args['split_mode'] = 'fused'
+    _, train, val, test = read_sample_split_pq(spark,  fraction=fraction, save_pq=False, 
+                            synthetic=False, debug=False, **split_args)
+    # identifies these splits (parameters and interactions version) to saved id maps and models
+    from split_cache import training_fingerprint
+    fingerprint = training_fingerprint(fraction, **split_args)
+
+    # read_sample_split_pq already coalesced splits that are not bucketed;
+    # bucketed ones keep one partition per user_id bucket for the joins in hybrid.py
 
     # ensure that train and val are cached
     if not train.is_cached:
@@ -38,17 +85,167 @@ def main(spark, task, fraction, k):
         val.cache()
 
 
+    if task=='als-bench':
+        # time spark's implicit ALS against numpy_als on the is_reviewed splits (e.g. fraction 0.05)
+        # results are appended to als_benchmark.txt
+        from hybrid import get_isrev_splits_from_ratings
+        from numpy_als import benchmark_engines
+        isrev_train, _, _ = get_isrev_splits_from_ratings(spark, train, val, fraction, get_test=False)
+        isrev_train.cache()
+        benchmark_engines(spark, isrev_train, fraction, ranks=[100, 500], implicit=True, value_col='is_reviewed')
+        return
+
+    if task=='split-report':
+        # validate the splits with one pass over the rows (approx) or one shuffle of them (exact)
+        # report is written to split_report_[downsample percent].json
+        from data_prep import split_report
+        report = split_report(spark, train, val, test, fraction, rm_unobserved=True, 
+                              approx=(len(sys.argv) > 4 and sys.argv[4]=='approx'),
+                              out_path='split_report_{}.json'.format(int(fraction*100)))
+        if not report['ok']:
+            sys.exit(1)
+        return
+
+    if task=='export-model':
+        # write a saved explicit ALSModel as a memory-mappable factor artifact (see artifact.py)
+        # [rank] [regularization parameter], optional: [float16]
+        import numpy as np
+        from modeling import saved_model_path
+        from artifact import export_als_model, artifact_path
+        rank, lamb = int(sys.argv[4]), float(sys.argv[5])
+        dtype = np.float16 if len(sys.argv) > 6 and sys.argv[6]=='float16' else np.float32
+        model_path = saved_model_path(spark, train, fraction, rank, lamb, fingerprint)
+        export_als_model(spark, model_path, artifact_path(model_path), fraction, lamb, fingerprint=fingerprint, dtype=dtype)
+        return
+
+    if task=='export-csr':
+        # write train/val/test as memory-mappable CSR/CSC arrays for single-node code
+        # optional: [output directory] (default: csr_[downsample percent])
+        from csr import export_csr
+        out_dir = sys.argv[4] if len(sys.argv) > 4 else 'csr_{}'.format(int(fraction*100))
+        export_csr(spark, {'train': train, 'val': val, 'test': test}, out_dir)
+        return
+
     if task=='tune':
         # tune hyperparameters
         f = open("results_{}.txt".format(int(fraction*100)), "a")
         f.write('Hyperparameter Tuning on {}% of the Goodreads Interaction Data\n'.format(int(fraction*100)))
         f.close()
-        tune(spark, train, val, k=k, fraction=fraction)
+        # optional: [engine] 'spark' (default) or 'numpy' (warm-started across the grid)
+        #           [max parallel] grid cells at once for 'spark', 'auto' to size by executor memory
+        engine = sys.argv[4] if len(sys.argv) > 4 else 'spark'
+        max_parallel = 1
+        if len(sys.argv) > 5:
+            max_parallel = None if sys.argv[5]=='auto' else int(sys.argv[5])
+        tune(spark, train, val, k=k, fraction=fraction, engine=engine, max_parallel=max_parallel, fingerprint=fingerprint)
         f = open("results.txt", "a")
         f.write('---------------------------------------------------------------\n\n')
         f.close()
         return
 
+    if task=='topk-bench':
+        # time recommendForUserSubset against blocked scoring at k=10, 100, 500 and rank 10, 100, 500
+        # results are appended to topk_benchmark.txt
+        from scoring import benchmark_topk
+        benchmark_topk(spark, train, val.select('user_id').distinct(), fraction)
+        return
+
+    if task=='ann-bench':
+        # recall@k and latency of the IVF index over the item factors of an ALS model
+        # optional: [rank] (default 100); results are appended to ann_benchmark.txt
+        from modeling import saved_model_path
+        from artifact import ensure_artifact, load_artifact
+        from ann import benchmark_ann
+        rank = int(sys.argv[4]) if len(sys.argv) > 4 else 100
+        model_path = saved_model_path(spark, train, fraction, rank, 1, fingerprint)
+        model = load_artifact(ensure_artifact(spark, model_path, fraction, 1, fingerprint=fingerprint), dtype='float32')
+        benchmark_ann(model['user_factors'], model['item_factors'], fraction, rank, k=k)
+        return
+
+    if task=='serve':
+        # answer top-k requests (line-delimited JSON over TCP) from a saved explicit ALSModel
+        # (read from its factor artifact, exported on first use)
+        # [rank] [regularization parameter], optional: [port] (default 8765)
+        from modeling import saved_model_path
+        from artifact import ensure_artifact, load_artifact
+        from serve import serve
+        rank, lamb = int(sys.argv[4]), float(sys.argv[5])
+        model_path = saved_model_path(spark, train, fraction, rank, lamb, fingerprint)
+        model = load_artifact(ensure_artifact(spark, model_path, fraction, lamb, fingerprint=fingerprint), dtype='float32')
+        # leave the users' train books out of their recommendations
+        from csr import matrices_from_df
+        from scoring import seen_items
+        model['seen'] = seen_items(matrices_from_df(train)[0], model['user_ids'], model['book_ids'])
+        serve(model, port=int(sys.argv[6]) if len(sys.argv) > 6 else 8765)
+        return
+
+    if task=='serve-bench':
+        # replay val user requests against the serving daemon
+        # [rank] [regularization parameter]; results are appended to serve_benchmark.txt
+        from modeling import saved_model_path
+        from artifact import ensure_artifact, load_artifact
+        from serve import replay_requests, benchmark_serving
+        rank, lamb = int(sys.argv[4]), float(sys.argv[5])
+        model_path = saved_model_path(spark, train, fraction, rank, lamb, fingerprint)
+        model = load_artifact(ensure_artifact(spark, model_path, fraction, lamb, fingerprint=fingerprint), dtype='float32')
+        # leave the users' train books out of their recommendations
+        from csr import matrices_from_df
+        from scoring import seen_items
+        model['seen'] = seen_items(matrices_from_df(train)[0], model['user_ids'], model['book_ids'])
+        users = [row.user_id for row in val.select('user_id').distinct().collect()]
+        benchmark_serving(model, replay_requests(users, k=k), fraction, rank)
+        return
+
+    if task=='fold-in-bench':
+        # fold the val users in from their train rows against a saved model's item factors
+        # [rank] [regularization parameter]; results are appended to foldin_benchmark.txt
+        from modeling import saved_model_path
+        from artifact import ensure_artifact, load_artifact
+        from foldin import histories_from_df, benchmark_fold_in
+        rank, lamb = int(sys.argv[4]), float(sys.argv[5])
+        model_path = saved_model_path(spark, train, fraction, rank, lamb, fingerprint)
+        model = load_artifact(ensure_artifact(spark, model_path, fraction, lamb, fingerprint=fingerprint), dtype='float32')
+        histories = histories_from_df(train.join(val.select('user_id').distinct(), 'user_id', 'left_semi'))
+        benchmark_fold_in(model, histories, fraction, lamb, k=k)
+        return
+
+    if task=='refresh':
+        # after ingest: refresh the explicit model of the fused splits with the delta instead of refitting
+        # [rank] [regularization parameter] [delta csv path]
+        # the first run (no saved model yet) only fits the base model on the current fused splits;
+        # later runs save the refreshed model (artifact and ALSModel) and append its eval
+        # against a full refit to refresh_benchmark.txt
+        from time import time
+        from modeling import als_model_path, saved_model_path, model_fingerprint
+        from artifact import ensure_artifact, load_artifact, save_artifact, artifact_path
+        from ingest import read_delta
+        from storage import path_exist
+        from refresh import refresh_model, save_als_model, refreshed_model_path, compare_refresh
+        rank, lamb = int(sys.argv[4]), float(sys.argv[5])
+        model_path = als_model_path(fraction, rank, lamb, suffix='_fused')
+        if not path_exist(model_path):
+            saved_model_path(spark, train, fraction, rank, lamb, fingerprint, suffix='_fused')
+            print('NOTICE: Fit the base model {}, refresh it after the next ingest'.format(model_path))
+            return
+        if model_fingerprint(model_path)==fingerprint:
+            print('NOTICE: {} was fit on the current splits, nothing to refresh'.format(model_path))
+            return
+        model = load_artifact(ensure_artifact(spark, model_path, fraction, lamb), dtype='float32')
+        start = time()
+        refreshed = refresh_model(model, train, read_delta(spark, sys.argv[6]))
+        refresh_time = time() - start
+        new_model_path = refreshed_model_path(model_path, fingerprint)
+        save_artifact(refreshed, artifact_path(new_model_path), fraction, fingerprint=fingerprint)
+        save_als_model(spark, refreshed, model_path, new_model_path, fingerprint)
+        compare_refresh(spark, model, refreshed, train, val, fraction, rank, lamb, k=k, refresh_time=refresh_time)
+        return
+
+    if task=='search':
+        # successive halving over random rank/lambda configurations
+        from modeling import successive_halving
+        successive_halving(spark, train, val, fraction, k=k, fingerprint=fingerprint)
+        return
+
     if task=='hybrid-tune':
 
         # get hyperparameters from command line
@@ -98,7 +295,7 @@ def main(spark, task, fraction, k):
         recs = get_recs(spark, train, fraction, val_ids=val_ids, 
                         lamb=best_lamb, rank=best_rank, k=k, implicit=False, 
                         save_model=True, save_recs_pq=True, 
-                        debug=False, final_test=True)
+                        debug=False, final_test=True, fingerprint=fingerprint)
 
         # select basic pred labels
         pred_labels = recs.select('user_id','recommendations.book_id')
@@ -280,12 +477,23 @@ if __name__ == "__main__":
     # # Get the cores from the command line
     # instances = sys.argv[6]
 
-    assert (task=='coalesce-test') or (task=='tune') or (task == 'hybrid-tune') or (task == 'test'), \
-            'Task must be one of:  \"coalesce-test," \"tune,\" \"hybrid-tune,\" \"save-splits,\" \"test\"'
+    assert (task=='coalesce-test') or (task=='tune') or (task == 'hybrid-tune') or (task == 'test') \
+            or (task == 'save-splits') or (task == 'split-bench') or (task == 'ingest') or (task == 'compact') \
+            or (task == 'export-csr') or (task == 'split-report') or (task == 'als-bench') \
+            or (task == 'search') or (task == 'topk-bench') \
+            or (task == 'ann-bench') or (task == 'serve') or (task == 'serve-bench') \
+            or (task == 'fold-in-bench') or (task == 'refresh') or (task == 'export-model'), \
+            'Task must be one of:  \"coalesce-test," \"tune,\" \"hybrid-tune,\" \"save-splits,\" \"split-bench,\" \"ingest,\" \"compact,\" \"export-csr,\" \"split-report,\" \"als-bench,\" \"search,\" \"topk-bench,\" \"ann-bench,\" \"serve,\" \"serve-bench,\" \"fold-in-bench,\" \"refresh,\" \"export-model,\" \"test\"'
     #assert (task=='predict') or (task=='tune') or (task=='eval'), 'Task must be  \"predict,\" \"eval,\"or \"tune\"'
 
     # Create the spark session object
-    spark = SparkSession.builder.appName('goodreads_{}_{}'.format(task, fraction)).getOrCreate()
+    # FAIR scheduling lets concurrent tune cells share the executors (see modeling.tune_concurrent)
+    # Interactions and splits are bucketed by user_id with the same bucket count; joins on
+    # (user_id, book_id) can use that co-partitioning instead of shuffling both sides
+    # (Spark 3.3+, ignored by older versions)
+    spark = SparkSession.builder.appName('goodreads_{}_{}'.format(task, fraction)) \
+                                .config('spark.scheduler.mode', 'FAIR') \
+                                .config('spark.sql.requireAllClusterKeysForCoPartition', 'false').getOrCreate()
 
                                 #  Requesting resources from Dumbo:
 
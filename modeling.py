@@ -55,10 +55,117 @@ def dummy_run(spark):
     print('MAP: ', mean_ap , 'NDCG: ', ndcg_at_k, 'Precision at k: ', p_at_k)
     return 
 
+def als_model_path(fraction, rank, lamb, implicit=False, final_test=False, suffix=''):
+    '''
+    Returns path of the ALSModel get_recs saves for these hyperparameters
+
+    suffix: see dense_suffix in get_recs ('' for the default spark engine on original ids)
+    '''
+    from storage import data_path
+
+    model_type = 'implicit' if implicit else 'explicit'
+    prefix = 'als_final' if final_test else 'als'
+    return data_path('{}_{}_{}_rank_{}_lambda_{}{}'.format(prefix, int(fraction*100), model_type, rank, lamb, suffix))
+
+def model_fingerprint(model_path):
+    '''
+    Returns the training fingerprint recorded with the ALSModel at model_path
+    (None if there is none, e.g. models saved before fingerprints were recorded)
+    '''
+    from storage import join, path_exist, read_text
+    path = join(model_path, '_fingerprint')
+    if not path_exist(path):
+        return None
+    return read_text(path).strip()
+
+def save_fitted_model(model, model_path, fingerprint=None):
+    '''
+    Saves an ALSModel at model_path, replacing any model there, and records the
+    split_cache fingerprint of the splits it was fit on next to it
+    '''
+    from storage import join, mark_written, invalidate, write_text
+    model.write().overwrite().save(model_path)
+    # the overwrite drops any _fingerprint of the replaced model
+    invalidate(join(model_path, '_fingerprint'))
+    mark_written(model_path)
+    if fingerprint is not None:
+        write_text(join(model_path, '_fingerprint'), fingerprint)
+    return
+
+def saved_model_path(spark, train, fraction, rank, lamb, fingerprint=None, suffix=''):
+    '''
+    Returns als_model_path of the explicit model, after fitting and saving it if there is none
+    (or, if fingerprint is given, if the saved one was fit on other splits)
+
+    suffix: see als_model_path (e.g. '_fused' for the model of the fused splits)
+    '''
+    from storage import path_exist
+
+    model_path = als_model_path(fraction, rank, lamb, suffix=suffix)
+    if path_exist(model_path) and (fingerprint is None or model_fingerprint(model_path)==fingerprint):
+        return model_path
+
+    if path_exist(model_path):
+        print('NOTICE: {} was fit on other splits, refitting'.format(model_path))
+    from pyspark.ml.recommendation import ALS
+    model = ALS(rank=rank, regParam=lamb, userCol='user_id', itemCol='book_id', ratingCol='rating', 
+                coldStartStrategy='drop').fit(train)
+    save_fitted_model(model, model_path, fingerprint)
+    return model_path
+
+# train's driver-side matrices and per-user seen books, kept for the latest split fingerprint
+# (see collected_train and seen_books)
+_split_cache = {'fingerprint': None, 'matrices': {}, 'seen': {}}
+
+def _for_split(fingerprint):
+    '''
+    Returns the cached structures of the split with fingerprint, dropping those of any other split
+    '''
+    if _split_cache['fingerprint']!=fingerprint:
+        for seen in _split_cache['seen'].values():
+            seen.unpersist()
+        _split_cache.update({'fingerprint': fingerprint, 'matrices': {}, 'seen': {}})
+    return _split_cache
+
+def collected_train(train, value_col='rating', fingerprint=None):
+    '''
+    Returns csr, csc of train (csr.matrices_from_df), collected once per split fingerprint
+    (on every call if fingerprint is None)
+
+    fingerprint: split_cache.training_fingerprint of the splits train comes from
+    '''
+    from csr import matrices_from_df
+
+    if fingerprint is None:
+        return matrices_from_df(train, value_col=value_col)
+    cache = _for_split(fingerprint)
+    if value_col not in cache['matrices']:
+        cache['matrices'][value_col] = matrices_from_df(train, value_col=value_col)
+    return cache['matrices'][value_col]
+
+def seen_books(seen, fingerprint=None, user_col='user_id', item_col='book_id'):
+    '''
+    Returns df of id and seen (scoring.seen_lists) of each user's books in seen,
+    built and persisted once per split fingerprint (on every call if fingerprint is None)
+
+    seen: df with user_col and item_col (train, or train on dense ids)
+    fingerprint: split_cache.training_fingerprint of the splits seen comes from
+    '''
+    from scoring import seen_lists
+
+    if fingerprint is None:
+        return seen_lists(seen, user_col, item_col)
+    cache = _for_split(fingerprint)
+    if user_col not in cache['seen']:
+        cache['seen'][user_col] = seen_lists(seen, user_col, item_col).persist()
+    return cache['seen'][user_col]
+
 def get_recs(spark, train, fraction, val=None, val_ids=None, 
                     lamb=1, rank=10, k=500, implicit=False, 
                     save_model = True, save_recs_pq=False,
-                    debug=False, synthetic=False, final_test=False):
+                    debug=False, synthetic=False, final_test=False, dense_ids=False, engine='spark',
+                    warm_start=None, max_iter=10, alpha=1.0, topk='spark', ann_args=None,
+                    exclude_seen=False, export_factors=False, fingerprint=None):
     ''' 
         Fits or loads ALS model from train and makes predictions 
         Imput: training file
@@ -66,6 +173,32 @@ def get_recs(spark, train, fraction, val=None, val_ids=None,
             spark - spark
             lamba - 
             rank - 
+            dense_ids - fit on dense contiguous user/book indices (data_prep.get_id_maps)
+                        instead of the raw ids; recommendations are mapped back to user_id/book_id
+            engine - 'spark' (pyspark.ml ALS) or 'numpy' (single-node numpy_als on the driver,
+                     for splits that fit in driver memory; with save_model, its models are
+                     saved and read as factor artifacts instead of ALSModels)
+                     implicit recommendations are saved with an '_implicit' suffix
+            warm_start - engine='numpy' only: dict kept across calls on the same train
+                         (see numpy_als.warm_fit) to start from earlier fits' factors;
+                         also keeps train's matrices for exclude_seen
+            max_iter - ALS iterations (maxIter)
+            alpha - confidence scale of the implicit model (only used if implicit)
+                    models and recs with non-default max_iter or alpha get '_iter'/'_alpha' suffixes
+            topk - 'spark' (recommendForUserSubset, or exact blocked scoring for engine='numpy'),
+                   'blocked' (GEMM and argpartition in mapPartitions, see scoring.recommend_blocked)
+                   or 'ann' (approximate, IVF index over the item factors, see ann.py)
+            ann_args - dict of nlist and nprobe for topk='ann'
+            exclude_seen - boolean option to leave each user's train books out of their top k
+                           (topk='spark' on engine='spark' then scores with 'blocked',
+                           since recommendForUserSubset cannot exclude items)
+            export_factors - engine='spark': boolean option to also write a saved model's factors as a
+                             memory-mappable artifact (artifact.py); engine='numpy' models are
+                             saved as artifacts whenever save_model is True
+            fingerprint - split_cache.training_fingerprint of the splits train comes from;
+                          saved models, artifacts and recs fit on other splits are refit
+                          instead of reused, and the saved ones record it
+                          (it also keys the saved id maps of dense_ids)
         Returns: Predictions generated by als 
     Notes: 
         https://spark.apache.org/docs/2.2.0/ml-collaborative-filtering.html
@@ -78,7 +211,7 @@ def get_recs(spark, train, fraction, val=None, val_ids=None,
         The evaluation metric will then be computed over the non-NaN data and will be valid" 
        
     '''
-    from data_prep import path_exist
+    from storage import data_path, path_exist
     from time import localtime, strftime
 
     if synthetic:
@@ -86,41 +219,141 @@ def get_recs(spark, train, fraction, val=None, val_ids=None,
         save_model = False
         save_recs_pq=False
 
-    #get netid
-    from getpass import getuser
-    net_id=getuser()
-
-    recs_path_pq = 'hdfs:/user/{}/recs_val{}_k{}_rank{}_lambda{}.parquet'.format(net_id, int(fraction*100), k, rank, lamb)
+    assert engine in ['spark', 'numpy'], 'engine must be \'spark\' or \'numpy\''
+
+    # models fit on dense indices or with another engine are saved under their own names
+    dense_suffix = '_dense' if dense_ids else ''
+    if engine!='spark':
+        dense_suffix += '_' + engine
+    if max_iter!=10:
+        dense_suffix += '_iter{}'.format(max_iter)
+    if implicit and alpha!=1.0:
+        dense_suffix += '_alpha{}'.format(alpha)
+    # keep the implicit (is_reviewed) recs of hybrid_pred_labels apart from the rating recs
+    recs_suffix = dense_suffix + '_implicit' if implicit else dense_suffix
+    # approximate recs are saved apart from exact ones
+    if topk=='ann':
+        recs_suffix += '_ann'
+    if exclude_seen:
+        recs_suffix += '_unseen'
+    recs_path_pq = data_path('recs_val{}_k{}_rank{}_lambda{}{}.parquet'.format(int(fraction*100), k, rank, lamb, recs_suffix))
     if final_test:
-        recs_path_pq = 'hdfs:/user/{}/recs_final_val{}_k{}_rank{}_lambda{}.parquet'.format(net_id, int(fraction*100), k, rank, lamb)
+        recs_path_pq = data_path('recs_final_val{}_k{}_rank{}_lambda{}{}.parquet'.format(int(fraction*100), k, rank, lamb, recs_suffix))
+
+    model_path = als_model_path(fraction, rank, lamb, implicit=implicit, final_test=final_test, suffix=dense_suffix)
+
+    # saved models (and recs made with them) are only reused if they were fit on train's splits
+    stale = False
+    if fingerprint is not None:
+        if engine=='numpy':
+            from artifact import artifact_path, read_header
+            header = read_header(artifact_path(model_path))
+            stale = header is None or header['training_fingerprint']!=fingerprint
+        else:
+            stale = model_fingerprint(model_path)!=fingerprint
+        if stale and path_exist(recs_path_pq):
+            from storage import delete
+            print('NOTICE: {} was made with a model fit on other splits, removing it'.format(recs_path_pq))
+            delete(recs_path_pq)
 
     if path_exist(recs_path_pq):
         # read recs from hdfs if exists
         recs = spark.read.parquet(recs_path_pq)
 
+    elif engine=='numpy':
+        from data_prep import write_to_parquet
+        from numpy_als import fit, train_matrices, recommend, recs_to_df
+
+        from artifact import artifact_path, read_header, load_artifact, save_artifact
+
+        value_col = 'is_reviewed' if implicit else 'rating'
+        # train collected to the driver at most once per split fingerprint (once per call, or per
+        # warm_start state, without one), shared by the fit, warm_start and the seen books
+        matrices = None
+        def collected():
+            if fingerprint is None and warm_start is not None:
+                return train_matrices(warm_start, train, value_col)
+            return collected_train(train, value_col, fingerprint)
+
+        factors_path = artifact_path(model_path)
+        if save_model and (not stale) and read_header(factors_path) is not None:
+            print('{}: Reading model'.format(strftime("%Y-%m-%d %H:%M:%S", localtime())))
+            model = load_artifact(factors_path)
+        else:
+            print('{}: Fitting model'.format(strftime("%Y-%m-%d %H:%M:%S", localtime())))
+            if warm_start is not None:
+                from numpy_als import warm_fit
+                matrices = train_matrices(warm_start, train, value_col, collected())
+                model = warm_fit(warm_start, train, rank=rank, reg=lamb, implicit=implicit, value_col=value_col, 
+                                 max_iter=max_iter, alpha=alpha)
+            else:
+                matrices = collected()
+                model = fit(*matrices, rank=rank, reg=lamb, implicit=implicit, value_col=value_col, 
+                            max_iter=max_iter, alpha=alpha)
+            if save_model:
+                print('{}: Saving model'.format(strftime("%Y-%m-%d %H:%M:%S", localtime())))
+                save_artifact(model, factors_path, fraction, fingerprint=fingerprint)
+
+        if val_ids==None:
+            val_ids = val.select('user_id').distinct()
+
+        print('{}: Begin getting {} recommendations for validation user subset'.format(strftime("%Y-%m-%d %H:%M:%S", localtime()), k))
+        users = [row.user_id for row in val_ids.collect()]
+        seen = None
+        if exclude_seen:
+            if matrices is None:
+                matrices = collected()
+            seen = matrices[0]
+        if topk=='ann':
+            from numpy_als import recommend_ann
+            recs = recs_to_df(spark, *recommend_ann(model, users, k, seen=seen, **(ann_args or {})))
+        else:
+            import numpy as np
+            users, books, scores = recommend(model, users, k, seen=seen)
+            recs = recs_to_df(spark, users, books, scores, valid=np.isfinite(scores))
+        print('{}: Finish getting {} recommendations for validation user subset'.format(strftime("%Y-%m-%d %H:%M:%S", localtime()), k))
+
+        recs = recs.coalesce((int((0.25+fraction)*200)))
+
+        if save_recs_pq:
+            recs = write_to_parquet(spark, recs, recs_path_pq)
+
     else:
         from data_prep import write_to_parquet
         from pyspark.ml.recommendation import ALS
         from pyspark.ml.recommendation import ALSModel
 
-        if implicit:
-            model_type = 'implicit'
+        old_model_path = data_path('als_{}_rank_{}_lambda_{}'.format(int(fraction*100), rank, lamb))
+        if final_test or (fingerprint is not None):
+            # models under the old naming protocol have no recorded fingerprint
+            old_model_path = None
+        if max_iter!=10:
+            old_model_path = None
+        if dense_ids:
+            old_model_path = None
+            from data_prep import get_id_maps
+            user_map, book_map = get_id_maps(spark, train, fraction, save=save_model, 
+                                             synthetic=synthetic, final_test=final_test, fingerprint=fingerprint)
+            userCol, itemCol = 'user_idx', 'book_idx'
         else:
-            model_type = 'explicit'
-
-        model_path = 'hdfs:/user/{}/als_{}_{}_rank_{}_lambda_{}'.format(net_id, int(fraction*100), model_type, rank, lamb)
-        old_model_path = 'hdfs:/user/{}/als_{}_rank_{}_lambda_{}'.format(net_id, int(fraction*100), rank, lamb)
-        if final_test:
-            model_path = 'hdfs:/user/{}/als_final_{}_{}_rank_{}_lambda_{}'.format(net_id, int(fraction*100), model_type, rank, lamb)
-            old_model_path = 'Null'
+            userCol, itemCol = 'user_id', 'book_id'
+
+        # books to leave out of each user's recs, in the model's ids
+        seen = None
+        if exclude_seen:
+            seen = seen_books(to_dense_ids(train, user_map, book_map) if dense_ids else train, fingerprint,
+                              userCol, itemCol)
+            if topk=='spark':
+                print('NOTICE: recommendForUserSubset cannot exclude seen books, scoring with topk=\'blocked\'')
+                topk = 'blocked'
         
-        # load model if exists
-        if path_exist(model_path):
+        # load model if exists (and was fit on train's splits)
+        if path_exist(model_path) and not stale:
             print('{}: Reading model'.format(strftime("%Y-%m-%d %H:%M:%S", localtime())))
             model = ALSModel.load(model_path)
 
         # load model if exists under old naming protocol
-        elif (not implicit) and path_exist(old_model_path):
+        elif (not implicit) and (old_model_path is not None) and path_exist(old_model_path):
             print('{}: Reading model'.format(strftime("%Y-%m-%d %H:%M:%S", localtime())))
             model = ALSModel.load(old_model_path)
 
@@ -133,8 +366,11 @@ def get_recs(spark, train, fraction, val=None, val_ids=None,
                 implicitPrefs = False
                 ratingCol = 'rating'
 
-            als = ALS(rank = rank, regParam=lamb, 
-                        userCol="user_id", itemCol="book_id", ratingCol=ratingCol, 
+            if dense_ids:
+                train = to_dense_ids(train, user_map, book_map)
+
+            als = ALS(rank = rank, regParam=lamb, maxIter=max_iter, alpha=alpha,
+                        userCol=userCol, itemCol=itemCol, ratingCol=ratingCol, 
                         implicitPrefs=implicitPrefs, coldStartStrategy="drop")
             if debug and (not synthetic):
                 f = open("results_{}.txt".format(int(fraction*100)), "a")
@@ -145,14 +381,19 @@ def get_recs(spark, train, fraction, val=None, val_ids=None,
 
             if save_model:
                 print('{}: Saving model'.format(strftime("%Y-%m-%d %H:%M:%S", localtime())))
-                model.save(model_path)
-
-                print('{}: Reloading model'.format(strftime("%Y-%m-%d %H:%M:%S", localtime())))
-                model = ALSModel.load(model_path)
+                save_fitted_model(model, model_path, fingerprint)
+                if export_factors:
+                    from artifact import artifact_path, export_als_model
+                    export_als_model(spark, model, artifact_path(model_path), fraction, lamb, 
+                                     implicit=implicit, alpha=alpha, fingerprint=fingerprint)
 
         if val_ids==None:
                 val_ids = val.select('user_id').distinct()
 
+        if dense_ids:
+            # users missing from train have no factors and would be dropped anyway
+            val_ids = to_dense_ids(val_ids, user_map)
+
         val_ids = val_ids.coalesce((int((0.25+fraction)*200))) 
                 
         # recommend for user subset
@@ -162,7 +403,15 @@ def get_recs(spark, train, fraction, val=None, val_ids=None,
             f.write('{}: Begin getting {} recommendations for validation user subset\n'.format(strftime("%Y-%m-%d %H:%M:%S", localtime()), k))
             f.close()
 
-        recs = model.recommendForUserSubset(val_ids, k)
+        if topk=='blocked':
+            from scoring import recommend_blocked
+            recs = recommend_blocked(spark, model, val_ids, k, user_col=userCol, item_col=itemCol, seen=seen)
+        elif topk=='ann':
+            from ann import recommend_ann
+            recs = recommend_ann(spark, model, val_ids, k, user_col=userCol, item_col=itemCol, seen=seen,
+                                 **(ann_args or {}))
+        else:
+            recs = model.recommendForUserSubset(val_ids, k)
         if debug:
             recs.explain()
             recs.cache()
@@ -174,6 +423,9 @@ def get_recs(spark, train, fraction, val=None, val_ids=None,
 
         print('{}: Finish getting {} recommendations for validation user subset'.format(strftime("%Y-%m-%d %H:%M:%S", localtime()), k))
 
+        if dense_ids:
+            recs = recs_to_original_ids(recs, user_map, book_map)
+
         recs = recs.coalesce((int((0.25+fraction)*200)))
 
         if save_recs_pq:
@@ -183,6 +435,42 @@ def get_recs(spark, train, fraction, val=None, val_ids=None,
 
     return recs
 
+def to_dense_ids(df, user_map, book_map=None):
+    '''
+    Replaces user_id (and book_id if book_map is given) of df with the dense
+    user_idx (and book_idx) of data_prep.get_id_maps
+    Rows whose ids are not in the maps are dropped
+    '''
+    from pyspark.sql.functions import broadcast
+
+    df = df.join(broadcast(user_map.select('user_id', 'user_idx')), 'user_id').drop('user_id')
+    if book_map is not None:
+        df = df.join(broadcast(book_map.select('book_id', 'book_idx')), 'book_id').drop('book_id')
+    return df
+
+def recs_to_original_ids(recs, user_map, book_map):
+    '''
+    Maps recommendations of a model fit on dense indices back to the original ids
+    Returns df with the same schema as recommendForUserSubset on the raw ids:
+        user_id, recommendations array<struct<book_id, rating>> (highest rating first)
+
+    The arrays are exploded with their positions, joined to the broadcast book map,
+    and regrouped in the original order.
+    '''
+    import pyspark.sql.functions as F
+
+    long = recs.select('user_idx', F.posexplode('recommendations').alias('pos', 'rec')) \
+               .select('user_idx', 'pos', F.col('rec.book_idx').alias('book_idx'), F.col('rec.rating').alias('rating'))
+    long = long.join(F.broadcast(book_map.select('book_idx', 'book_id')), 'book_idx')
+
+    recs = long.groupBy('user_idx') \
+               .agg(F.sort_array(F.collect_list(F.struct('pos', 'book_id', 'rating'))).alias('recs')) \
+               .select('user_idx', F.expr('transform(recs, r -> named_struct("book_id", r.book_id, "rating", r.rating))')
+                                    .alias('recommendations'))
+
+    return recs.join(F.broadcast(user_map.select('user_idx', 'user_id')), 'user_idx') \
+               .select('user_id', 'recommendations')
+
 def get_val_ids_and_true_labels(spark, val):
     # for all users in val set, get list of books rated over 3 stars
     from time import localtime, strftime
@@ -201,16 +489,20 @@ def get_val_ids_and_true_labels(spark, val):
 
 
 def eval(spark, pred_labels, true_labels, fraction, rank, lamb, 
-         k=500, isrev_weight=0, debug=False, synthetic=False):
+         k=500, isrev_weight=0, debug=False, synthetic=False, write_results=True):
+    '''
+    Evaluates predicted labels against true labels with MAP, NDCG at k and precision at k
+    Returns mean_ap, ndcg_at_k, p_at_k
+
+    write_results: boolean option to append the metrics to results_[downsample percent].txt
+                   (callers running several evaluations at once write them in order
+                   with write_eval_results instead)
+    '''
 
     from time import localtime, strftime
     from pyspark.mllib.evaluation import RankingMetrics
     import pyspark.sql.functions as F
 
-    #get netid
-    from getpass import getuser
-    net_id=getuser()
-
     print('{}: Building RDD with predictions and true labels'.format(strftime("%Y-%m-%d %H:%M:%S", localtime())))
     if debug and (not synthetic):
         f = open("results_{}.txt".format(int(fraction*100)), "a")
@@ -267,19 +559,76 @@ def eval(spark, pred_labels, true_labels, fraction, rank, lamb,
     p_at_k=  metrics.precisionAt(k)
     print('Lambda ', lamb, 'and Rank ', rank , 'MAP: ', mean_ap , 'NDCG: ', ndcg_at_k, 'Precision at k: ', p_at_k)
 
-    if not synthetic:
-        f = open("results_{}.txt".format(int(fraction*100)), "a")
-        f.write('{}: Evaluation for k={}, isrev_weight={}, lambda={}, and rank={}: MAP={}, NDCG={}, Precision at k={}\n\n\n\n'\
-                .format(strftime("%Y-%m-%d %H:%M:%S", localtime()), \
-                        k, isrev_weight, lamb, rank, mean_ap, ndcg_at_k, p_at_k))
-        f.close()
+    if write_results and (not synthetic):
+        write_eval_results(fraction, rank, lamb, k, isrev_weight, mean_ap, ndcg_at_k, p_at_k)
 
     return mean_ap, ndcg_at_k, p_at_k
 
+def write_eval_results(fraction, rank, lamb, k, isrev_weight, mean_ap, ndcg_at_k, p_at_k):
+    '''
+    Appends evaluation metrics to results_[downsample percent].txt
+    '''
+    from time import localtime, strftime
+
+    f = open("results_{}.txt".format(int(fraction*100)), "a")
+    f.write('{}: Evaluation for k={}, isrev_weight={}, lambda={}, and rank={}: MAP={}, NDCG={}, Precision at k={}\n\n\n\n'\
+            .format(strftime("%Y-%m-%d %H:%M:%S", localtime()), \
+                    k, isrev_weight, lamb, rank, mean_ap, ndcg_at_k, p_at_k))
+    f.close()
+    return
+
+def parse_memory(value):
+    '''
+    Returns bytes of a spark memory setting such as '4g', '512m' or '2048' (MiB)
+    '''
+    units = {'k': 2**10, 'm': 2**20, 'g': 2**30, 't': 2**40}
+    value = value.strip().lower().rstrip('b')
+    if value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value) * 2**20
+
+def max_parallel_cells(spark, train, ranks, max_cells=None):
+    '''
+    Returns how many tune grid cells can run at once within the executors' memory
+
+    Total executor memory (spark.executor.memory times the number of executors registered with
+    the SparkContext, or spark.executor.instances if none have registered yet; the driver
+    memory in local mode) times spark.memory.fraction is divided by a rough estimate of
+    what one ALS fit of the largest rank holds while running:
+        4 copies of the factors: 4 * 4 bytes * rank * (users + books)
+        user and item rating blocks: 2 * 12 bytes * interactions
+    '''
+    import pyspark.sql.functions as F
+
+    conf = spark.sparkContext.getConf()
+    if spark.sparkContext.master.startswith('local'):
+        total = parse_memory(conf.get('spark.driver.memory', '1g'))
+    else:
+        # the memory status lists the driver's block manager too
+        executors = spark.sparkContext._jsc.sc().getExecutorMemoryStatus().size() - 1
+        if executors < 1:
+            executors = int(conf.get('spark.executor.instances', '0'))
+        assert executors > 0, 'No executors registered yet; set spark.executor.instances'
+        total = parse_memory(conf.get('spark.executor.memory', '1g')) * executors
+    available = total * float(conf.get('spark.memory.fraction', '0.6'))
+
+    counts = train.agg(F.approx_count_distinct('user_id').alias('users'), 
+                       F.approx_count_distinct('book_id').alias('books'),
+                       F.count('*').alias('interactions')).collect()[0]
+    per_cell = 16 * max(ranks) * (counts['users'] + counts['books']) + 24 * counts['interactions']
+
+    n = max(1, int(available // per_cell))
+    if max_cells is not None:
+        n = min(n, max_cells)
+    print('{:.1f} GB executor memory for ALS, ~{:.2f} GB per fit at rank {}: {} cells at once'\
+                .format(available/2**30, per_cell/2**30, max(ranks), n))
+    return n
+
 
 def tune(spark, train, val, fraction, k=500, 
         rank =[10, 20, 100, 500], 
-        regParam = [0.01, 0.1, 1, 10]):
+        regParam = [0.01, 0.1, 1, 10],
+        engine='spark', warm_start=True, max_parallel=1, fingerprint=None):
     ''' 
         Fits ALS model from train, ranks k top items, and evaluates with MAP, P, NDCG across combos of rank/lambda hyperparameter
         Imput: training file
@@ -288,6 +637,15 @@ def tune(spark, train, val, fraction, k=500,
             train - training set
             val - validation set 
             k - how many top items to predict (default = 500)
+            engine - 'spark' or 'numpy', see get_recs
+            warm_start - engine='numpy' only: start each fit from the converged factors of the
+                         previous lambda (same rank) or of the largest smaller rank, and stop
+                         once the factors converge
+            max_parallel - engine='spark' only: number of grid cells to run at once, each from its own
+                           thread in its own FAIR scheduler pool; None derives it from executor
+                           memory (max_parallel_cells). Results are still written in grid order.
+                           Needs spark.scheduler.mode=FAIR to share the cluster fairly.
+            fingerprint - split_cache.training_fingerprint of train's splits, see get_recs
         Returns: MAP, P, NDCG for each model
     '''
     from time import localtime, strftime
@@ -310,6 +668,18 @@ def tune(spark, train, val, fraction, k=500,
     paramGrid = itertools.product(rank, regParam) # cycle through lambas first
                                                   # work up to large ranks
 
+    if engine=='spark' and max_parallel!=1:
+        train.cache()
+        if max_parallel is None:
+            max_parallel = max_parallel_cells(spark, train, rank, max_cells=len(rank)*len(regParam))
+        if max_parallel > 1:
+            tune_concurrent(spark, train, val_ids, true_labels, fraction, k, list(paramGrid), max_parallel, 
+                            fingerprint=fingerprint)
+            return
+
+    # pyspark.ml ALS cannot be given initial factors
+    state = {} if (engine=='numpy' and warm_start) else None
+
     #fit and evaluate for all combos
     for i in paramGrid:
 
@@ -319,7 +689,8 @@ def tune(spark, train, val, fraction, k=500,
         # train or load model, get recommendations
         recs = get_recs(spark, train, fraction, val_ids=val_ids, 
                         lamb=i[1], rank=i[0], k=k, implicit=False, 
-                        save_model=True, save_recs_pq=False, debug=False)
+                        save_model=True, save_recs_pq=False, debug=False,
+                        engine=engine, warm_start=state, fingerprint=fingerprint)
 
         # select pred labels
         pred_labels = recs.select('user_id','recommendations.book_id')
@@ -331,6 +702,167 @@ def tune(spark, train, val, fraction, k=500,
 
     return
 
+def tune_concurrent(spark, train, val_ids, true_labels, fraction, k, grid, max_parallel, fingerprint=None):
+    '''
+    Runs get_recs and eval for the (rank, lambda) cells of grid, max_parallel at a time
+    Writes each cell's results in grid order
+
+    Every cell runs in a pool thread under its own FAIR scheduler pool, so the jobs of
+    concurrent cells share executors instead of queueing behind each other.
+    The cached train, val_ids and true_labels are shared by all cells.
+    With spark < 3.2 (no pinned thread mode) the pool property may not reach the jobs.
+    '''
+    from time import localtime, strftime
+    from concurrent.futures import ThreadPoolExecutor
+
+    sc = spark.sparkContext
+
+    def run_cell(cell):
+        r, lamb = cell
+        sc.setLocalProperty('spark.scheduler.pool', 'tune_rank{}_lambda{}'.format(r, lamb))
+        try:
+            print('{}: Evaluating {}% at k={}, rank={}, lambda={}'.format(strftime("%Y-%m-%d %H:%M:%S", localtime()), \
+                                                                    int(fraction*100), k, r, lamb))
+            recs = get_recs(spark, train, fraction, val_ids=val_ids, 
+                            lamb=lamb, rank=r, k=k, implicit=False, 
+                            save_model=True, save_recs_pq=False, debug=False, fingerprint=fingerprint)
+            pred_labels = recs.select('user_id','recommendations.book_id')
+            results = eval(spark, pred_labels, true_labels, fraction=fraction, 
+                           rank=r, lamb=lamb, k=500, 
+                           isrev_weight=0, debug=False, synthetic=False, write_results=False)
+            recs.unpersist()
+            return results
+        finally:
+            sc.setLocalProperty('spark.scheduler.pool', None)
+
+    with ThreadPoolExecutor(max_parallel) as pool:
+        futures = [pool.submit(run_cell, cell) for cell in grid]
+        # wait in grid order, so results are recorded in the same order as sequential tuning
+        for (r, lamb), future in zip(grid, futures):
+            mean_ap, ndcg_at_k, p_at_k = future.result()
+            write_eval_results(fraction, r, lamb, 500, 0, mean_ap, ndcg_at_k, p_at_k)
+
+    return
+
+def sample_configs(space, n_configs, seed=42):
+    '''
+    Returns list of n_configs distinct random configurations (dicts) from space
+
+    space: dict of parameter -> list of values (picked uniformly) or
+           (low, high) tuple (picked log-uniformly; 'rank' is rounded to an int,
+           other parameters to 3 significant digits)
+    '''
+    import math
+    import random
+
+    rng = random.Random(seed)
+    configs = []
+    for _ in range(100*n_configs):
+        config = {}
+        for name, values in sorted(space.items()):
+            if isinstance(values, tuple):
+                value = math.exp(rng.uniform(math.log(values[0]), math.log(values[1])))
+                config[name] = int(round(value)) if name=='rank' else float('{:.3g}'.format(value))
+            else:
+                config[name] = rng.choice(values)
+        if config not in configs:
+            configs.append(config)
+        if len(configs)==n_configs:
+            break
+    return configs
+
+def successive_halving(spark, train, val, fraction, k=500, 
+                       space={'rank': (10, 500), 'regParam': (0.01, 10)},
+                       n_configs=27, eta=3, max_iter=10, implicit=False, engine='spark', seed=42, fingerprint=None):
+    ''' 
+        Adaptive alternative to tune: successive halving over random configurations
+        arguments:
+            spark - spark
+            train - training set
+            val - validation set 
+            k - how many top items to predict
+            space - search space, see sample_configs ('rank', 'regParam' and, for implicit, 'alpha')
+            n_configs - number of configurations in the first rung
+            eta - each rung keeps the best 1/eta configurations and gives them eta times
+                  more validation users and iterations
+            max_iter - ALS iterations of the last rung
+            engine - 'spark' or 'numpy', see get_recs
+            fingerprint - split_cache.training_fingerprint of train's splits, see get_recs
+        Returns: best configuration (dict) and its MAP on all validation users
+
+    Rung i of R scores its configurations by MAP on the validation users in a hash-based
+    sample of eta^(i-R+1) of them (every rung's users contain the previous rung's; the hash is
+    salted apart from the downsampling one, which every validation user already passed), with
+    ALS fit for max_iter * eta^(i-R+1) iterations (at least 1). Only the last rung uses all
+    users and max_iter. Models and recs are not saved.
+    '''
+    import math
+    from time import localtime, strftime
+    from data_prep import user_sample_bucket, SAMPLE_BUCKETS
+
+    val_ids, true_labels = get_val_ids_and_true_labels(spark, val)
+    val_ids = val_ids.coalesce((int((0.25+fraction)*200))) 
+    true_labels = true_labels.coalesce((int((0.25+fraction)*200))) 
+    val_ids.cache()
+    true_labels.cache()
+
+    configs = sample_configs(space, n_configs, seed=seed)
+    n_rungs = int(math.floor(math.log(len(configs), eta) + 1e-9)) + 1
+
+    f = open("results_{}.txt".format(int(fraction*100)), "a")
+    f.write('{}: Successive halving over {} configurations in {} rungs (eta={})\n'\
+                .format(strftime("%Y-%m-%d %H:%M:%S", localtime()), len(configs), n_rungs, eta))
+    f.close()
+
+    for rung in range(n_rungs):
+        share = float(eta)**(rung - n_rungs + 1)
+        iterations = max(1, int(round(max_iter * share)))
+
+        in_sample = user_sample_bucket(seed, salt='halving') < int(round(share*SAMPLE_BUCKETS))
+        rung_ids = val_ids.filter(in_sample)
+        rung_labels = true_labels.filter(in_sample)
+        if share < 1:
+            rung_ids.cache()
+            rung_labels.cache()
+
+        scores = []
+        for config in configs:
+            print('{}: Rung {}: {} with {:.1%} of validation users and maxIter={}'\
+                        .format(strftime("%Y-%m-%d %H:%M:%S", localtime()), rung, config, share, iterations))
+            recs = get_recs(spark, train, fraction, val_ids=rung_ids, 
+                            lamb=config['regParam'], rank=config['rank'], k=k, implicit=implicit,
+                            alpha=config.get('alpha', 1.0), max_iter=iterations,
+                            save_model=False, save_recs_pq=False, debug=False, engine=engine, 
+                            fingerprint=fingerprint)
+            pred_labels = recs.select('user_id','recommendations.book_id')
+            mean_ap, _, _ = eval(spark, pred_labels, rung_labels, fraction=fraction, 
+                                 rank=config['rank'], lamb=config['regParam'], k=k, 
+                                 isrev_weight=0, debug=False, synthetic=False, write_results=False)
+            recs.unpersist()
+            scores.append(mean_ap)
+
+            f = open("results_{}.txt".format(int(fraction*100)), "a")
+            f.write('{}: Rung {} ({:.1%} of validation users, maxIter={}): {} MAP={}\n'\
+                        .format(strftime("%Y-%m-%d %H:%M:%S", localtime()), rung, share, iterations, config, mean_ap))
+            f.close()
+
+        rung_ids.unpersist()
+        rung_labels.unpersist()
+
+        ranked = sorted(zip(scores, range(len(configs))), reverse=True)
+        if rung==n_rungs - 1:
+            best_map, best = ranked[0]
+            break
+        configs = [configs[i] for _, i in ranked[:max(1, len(configs)//eta)]]
+
+    best = configs[best]
+    f = open("results_{}.txt".format(int(fraction*100)), "a")
+    f.write('{}: Successive halving best configuration: {} MAP={}\n\n\n\n'\
+                .format(strftime("%Y-%m-%d %H:%M:%S", localtime()), best, best_map))
+    f.close()
+
+    return best, best_map
+
 def train_eval(spark, train, val, fraction, k=500, rank=10, lamb=1, final_test=False):
 
     #for all users in val set, get list of books rated over 3 stars
@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+
+'''
+Single-node alternating least squares on NumPy, an alternative to pyspark.ml ALS
+for splits that fit in driver memory (e.g. the 1% and 5% fractions)
+
+Same models as spark's ALS. Explicit feedback:
+    minimize sum over observed (u, i) of (r_ui - x_u . y_i)^2
+             + reg * (n_u |x_u|^2 + n_i |y_i|^2)
+where n_u, n_i are the numbers of ratings of user u and item i.
+Implicit feedback (implicitPrefs=True, e.g. is_reviewed):
+    minimize sum over all (u, i) of c_ui (p_ui - x_u . y_i)^2
+             + reg * (n_u |x_u|^2 + n_i |y_i|^2)
+with confidence c_ui = 1 + alpha |r_ui|, preference p_ui = 1 if r_ui > 0 else 0,
+and n_u, n_i counting only positive entries.
+Factors start as random unit-norm rows, and every iteration solves all item factors,
+then all user factors.
+
+Each half-iteration solves the normal equations of many rows at once. Rows are
+sorted by number of interactions and cut into blocks of similar length. The factors
+of a block's interactions are gathered into a zero-padded (rows, length, rank) array.
+Then one batched matmul gives every Gramian and one batched np.linalg.solve
+gives every factor. Blocks run on a thread pool; NumPy releases the GIL
+in BLAS and LAPACK calls.
+
+The implicit model sums over every item, but its normal equations are
+    (Y^T Y + Y_u^T C1_u Y_u + reg n_u I) x_u = Y_u^T (1 + C1_u) p_u
+where C1_u = alpha |r_u| is only non-zero on the user's own interactions. Y^T Y is
+computed once per half-iteration. A few conjugate gradient steps, started from the
+previous factors, then solve all rows of a block together. Each step applies
+the matrix as Y^T Y v + Y_u^T (c1 * (Y_u v)) + reg n_u v, so a user costs
+O(n_u rank + rank^2) per step, independent of the number of items.
+
+Models are plain dicts:
+    user_factors, item_factors - float32 arrays (n_users x rank, n_items x rank)
+    user_ids, book_ids - original id of each row (sorted)
+    rank, reg, implicit, alpha, iterations
+'''
+
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# size budget (in array elements) of the padded gather of one block
+BLOCK_ELEMENTS = 1 << 24
+
+
+def init_factors(n, rank, seed=42):
+    '''
+    Returns n x rank float32 array of random rows with unit norm
+    '''
+    rng = np.random.RandomState(seed)
+    factors = rng.normal(size=(n, rank)).astype(np.float32)
+    factors /= np.linalg.norm(factors, axis=1, keepdims=True)
+    return factors
+
+def make_blocks(indptr, rank, block_elements=BLOCK_ELEMENTS, rows=None):
+    '''
+    Cuts the rows of a CSR matrix into blocks of rows with similar numbers of entries
+    Returns list of arrays of row indices (rows without entries are left out)
+
+    A block of b rows whose longest row has c entries needs b*rank*(c+rank) elements
+    for its padded gather and Gramians, which is kept under block_elements.
+
+    rows: optional array of row indices to cut into blocks instead of all rows
+    '''
+    counts = np.diff(indptr)
+    order = np.argsort(counts, kind='stable') if rows is None else rows[np.argsort(counts[rows], kind='stable')]
+    order = order[counts[order] > 0]
+    sorted_counts = counts[order]
+
+    blocks = []
+    start = 0
+    while start < len(order):
+        # sizes are increasing in the block end because rows are sorted by count
+        sizes = np.arange(1, len(order) - start + 1) * rank * (sorted_counts[start:] + rank)
+        end = start + max(1, int(np.searchsorted(sizes, block_elements, side='right')))
+        blocks.append(order[start:end])
+        start = end
+    return blocks
+
+def gather_block(rows, indptr, indices, values, pad_index):
+    '''
+    Returns (rows x length) arrays of column indices and values of the given rows,
+    padded with pad_index and 0, and the number of entries of each row
+    '''
+    counts = indptr[rows + 1] - indptr[rows]
+    length = counts.max()
+
+    # positions of the rows' entries in indices, concatenated
+    offsets = np.repeat(indptr[rows] - np.cumsum(np.r_[0, counts[:-1]]), counts)
+    positions = offsets + np.arange(counts.sum())
+
+    mask = np.arange(length)[None, :] < counts[:, None]
+    idx = np.full((len(rows), length), pad_index, dtype=np.int64)
+    vals = np.zeros((len(rows), length), dtype=np.float32)
+    idx[mask] = indices[positions]
+    vals[mask] = values[positions]
+    return idx, vals, counts
+
+def solve_block(rows, matrix, value_col, other_padded, reg):
+    '''
+    Solves the regularized least squares problems of a block of rows
+    Returns len(rows) x rank float32 array of factors
+    '''
+    idx, vals, counts = gather_block(rows, matrix['indptr'], matrix['indices'], matrix[value_col],
+                                     other_padded.shape[0] - 1)
+    rank = other_padded.shape[1]
+
+    Y = other_padded[idx]
+    Yt = Y.transpose(0, 2, 1)
+    A = np.matmul(Yt, Y).astype(np.float64)
+    b = np.matmul(Yt, vals[:, :, None]).astype(np.float64)
+
+    diag = np.arange(rank)
+    A[:, diag, diag] += reg * counts[:, None]
+    return np.linalg.solve(A, b)[:, :, 0].astype(np.float32)
+
+def solve_block_cg(rows, matrix, value_col, other_padded, reg, gramian, alpha, x0, cg_steps):
+    '''
+    Runs cg_steps conjugate gradient steps on the implicit-feedback normal equations
+    of a block of rows, all rows at once, starting from their factors x0
+    Returns len(rows) x rank float32 array of factors
+    '''
+    idx, vals, _ = gather_block(rows, matrix['indptr'], matrix['indices'], matrix[value_col],
+                                other_padded.shape[0] - 1)
+
+    # padded entries have value 0, so they get c1 = 0 and no weight
+    c1 = alpha * np.abs(vals)
+    positive = vals > 0
+    n_explicit = positive.sum(axis=1)
+    Y = other_padded[idx]
+
+    def apply(v):
+        Yv = np.einsum('blr,br->bl', Y, v)
+        return v @ gramian + np.einsum('blr,bl->br', Y, c1 * Yv) + (reg * n_explicit)[:, None] * v
+
+    b = np.einsum('blr,bl->br', Y, np.where(positive, 1 + c1, 0).astype(np.float32))
+
+    x = x0.copy()
+    r = b - apply(x)
+    p = r.copy()
+    rs = (r * r).sum(axis=1)
+    for _ in range(cg_steps):
+        Ap = apply(p)
+        pAp = (p * Ap).sum(axis=1)
+        step = np.where(pAp > 0, rs / np.where(pAp > 0, pAp, 1), 0)
+        x += step[:, None] * p
+        r -= step[:, None] * Ap
+        rs_new = (r * r).sum(axis=1)
+        p = r + np.where(rs > 0, rs_new / np.where(rs > 0, rs, 1), 0)[:, None] * p
+        rs = rs_new
+    return x.astype(np.float32)
+
+def sweep(matrix, value_col, other, reg, blocks, num_threads=None, 
+          implicit=False, alpha=1.0, current=None, cg_steps=3, out=None):
+    '''
+    Returns new factors of all rows of matrix given the fixed factors other
+    of its columns (rows without entries get zero factors)
+
+    implicit: boolean option to solve the implicit-feedback problem by conjugate gradient
+              starting from current (the rows' factors before this sweep)
+    out: optional factor array to update in place; rows outside blocks keep their values
+    '''
+    # zero row that padded entries point to
+    other_padded = np.vstack([other, np.zeros((1, other.shape[1]), dtype=other.dtype)])
+    factors = np.zeros((matrix['shape'][0], other.shape[1]), dtype=np.float32) if out is None else out
+
+    if implicit:
+        gramian = (other.T.astype(np.float64) @ other).astype(np.float32)
+
+    def run(rows):
+        if implicit:
+            factors[rows] = solve_block_cg(rows, matrix, value_col, other_padded, reg, gramian, alpha, 
+                                           current[rows], cg_steps)
+        else:
+            factors[rows] = solve_block(rows, matrix, value_col, other_padded, reg)
+
+    with ThreadPoolExecutor(num_threads or os.cpu_count()) as pool:
+        list(pool.map(run, blocks))
+    return factors
+
+def loss(csr, value_col, user_factors, item_factors, reg, implicit=False, alpha=1.0, 
+         chunk_size=1 << 20):
+    '''
+    Returns the objective of the model (see module docstring) on the user x book matrix csr
+
+    The implicit sum over all (u, i) is the sum of (x_u . y_i)^2 over every pair,
+    trace(X^T X Y^T Y), plus a correction on the observed entries,
+    so both models cost O(nnz rank) and run over the entries in chunks of chunk_size.
+    '''
+    indptr, indices, values = csr['indptr'], csr['indices'], csr[value_col]
+    rows = np.repeat(np.arange(csr['shape'][0]), np.diff(indptr))
+
+    total = 0.0
+    for start in range(0, len(indices), chunk_size):
+        u, i = rows[start:start + chunk_size], indices[start:start + chunk_size]
+        r = values[start:start + chunk_size].astype(np.float64)
+        pred = np.einsum('nr,nr->n', user_factors[u], item_factors[i]).astype(np.float64)
+        if implicit:
+            c = 1 + alpha * np.abs(r)
+            total += (c * ((r > 0) - pred)**2 - pred**2).sum()
+        else:
+            total += ((r - pred)**2).sum()
+    if implicit:
+        total += (((user_factors.T.astype(np.float64) @ user_factors)
+                   * (item_factors.T.astype(np.float64) @ item_factors)).sum())
+
+    # n_u, n_i count positive entries in the implicit model
+    counted = values > 0 if implicit else np.ones(len(values), dtype=bool)
+    n_u = np.bincount(rows[counted], minlength=user_factors.shape[0])
+    n_i = np.bincount(indices[counted], minlength=item_factors.shape[0])
+    total += reg * ((n_u * (user_factors.astype(np.float64)**2).sum(axis=1)).sum()
+                    + (n_i * (item_factors.astype(np.float64)**2).sum(axis=1)).sum())
+    return total
+
+def resize_factors(factors, rank, seed=42, noise=0.01):
+    '''
+    Returns factors with rank columns to warm-start a fit of another rank
+    Extra columns are small noise (noise times the mean absolute factor),
+    surplus columns are dropped
+    '''
+    if factors.shape[1] >= rank:
+        return np.ascontiguousarray(factors[:, :rank])
+
+    rng = np.random.RandomState(seed)
+    scale = noise * np.abs(factors).mean()
+    extra = (scale * rng.normal(size=(factors.shape[0], rank - factors.shape[1]))).astype(np.float32)
+    return np.hstack([factors, extra])
+
+def fit(csr, csc, rank=10, reg=1.0, max_iter=10, seed=42, value_col='rating',
+        implicit=False, alpha=1.0, cg_steps=3, init=None, tol=None,
+        num_threads=None, block_elements=BLOCK_ELEMENTS, verbose=True):
+    '''
+    Fits explicit- or implicit-feedback ALS
+    Returns model dict (see module docstring)
+
+    csr, csc: user x book and book x user matrices (csr.matrices_from_df or csr.load_csr)
+    rank: number of latent factors
+    reg: regularization parameter (regParam)
+    max_iter: number of iterations (spark's default is 10)
+    seed: random seed of the initial factors
+    value_col: key of the matrix values in csr/csc
+    implicit: boolean option to fit the implicit-feedback model (implicitPrefs)
+    alpha: confidence scale of the implicit model (spark's alpha, default 1.0)
+    cg_steps: conjugate gradient steps per row and half-iteration of the implicit model
+    init: model dict of an earlier fit on the same matrices to start from instead of random
+          factors (e.g. the previous lambda in a tuning grid); factors of another rank are
+          resized with resize_factors
+    tol: if given, stop once an iteration lowers the objective (see loss) by less than
+         tol relative to its previous value (max_iter is then an upper bound)
+    num_threads: threads solving blocks in parallel (number of cpus if None)
+    block_elements: size budget of a block, see make_blocks
+    '''
+    from time import localtime, strftime, time
+
+    n_users, n_items = csr['shape']
+    if init is not None:
+        assert init['user_factors'].shape[0]==n_users and init['item_factors'].shape[0]==n_items, \
+                'init was fit on other matrices'
+        user_factors = resize_factors(init['user_factors'], rank, seed)
+        item_factors = resize_factors(init['item_factors'], rank, seed + 1)
+    else:
+        user_factors = init_factors(n_users, rank, seed)
+        item_factors = init_factors(n_items, rank, seed + 1)
+
+    user_blocks = make_blocks(csr['indptr'], rank, block_elements)
+    item_blocks = make_blocks(csc['indptr'], rank, block_elements)
+
+    # a warm start is compared against its starting point, so a converged init stops after one iteration
+    previous = None
+    if tol is not None and init is not None:
+        previous = loss(csr, value_col, user_factors, item_factors, reg, implicit, alpha)
+
+    iterations = 0
+    for it in range(max_iter):
+        start = time()
+        item_factors = sweep(csc, value_col, user_factors, reg, item_blocks, num_threads, 
+                             implicit, alpha, item_factors, cg_steps)
+        user_factors = sweep(csr, value_col, item_factors, reg, user_blocks, num_threads, 
+                             implicit, alpha, user_factors, cg_steps)
+        iterations = it + 1
+        if tol is None:
+            if verbose:
+                print('{}: ALS iteration {} ({:.1f}s)'.format(strftime("%Y-%m-%d %H:%M:%S", localtime()), 
+                                                             iterations, time() - start))
+            continue
+
+        current = loss(csr, value_col, user_factors, item_factors, reg, implicit, alpha)
+        change = np.inf if previous is None else (previous - current) / max(abs(previous), 1e-12)
+        if verbose:
+            print('{}: ALS iteration {} ({:.1f}s, loss {:.6g}, relative decrease {:.2e})'\
+                        .format(strftime("%Y-%m-%d %H:%M:%S", localtime()), iterations, time() - start, 
+                                current, change))
+        if change < tol:
+            break
+        previous = current
+
+    return {'user_factors': user_factors, 'item_factors': item_factors,
+            'user_ids': csr['user_ids'], 'book_ids': csr['book_ids'],
+            'rank': rank, 'reg': reg, 'implicit': implicit, 'alpha': alpha, 'iterations': iterations}
+
+def fit_from_df(df, rank=10, reg=1.0, value_col='rating', **kwargs):
+    '''
+    Collects a spark df of interactions and fits ALS on it
+    Returns model dict
+
+    df: spark df with user_id, book_id and value_col
+    kwargs: passed to fit
+    '''
+    from csr import matrices_from_df
+    csr, csc = matrices_from_df(df, value_col=value_col)
+    return fit(csr, csc, rank=rank, reg=reg, value_col=value_col, **kwargs)
+
+def train_matrices(state, df, value_col='rating', matrices=None):
+    '''
+    Returns csr, csc of df (csr.matrices_from_df), collected once per state
+    (see warm_fit; the state is reset if value_col changes)
+
+    matrices: csr, csc of df already collected (e.g. modeling.collected_train), used
+              instead of collecting df when the state has none
+    '''
+    from csr import matrices_from_df
+
+    if state.get('value_col')!=value_col:
+        state.clear()
+        state['value_col'] = value_col
+        state['matrices'] = matrices_from_df(df, value_col=value_col) if matrices is None else matrices
+        state['by_rank'] = {}
+        state['by_reg'] = {}
+    return state['matrices']
+
+def warm_fit(state, df, rank=10, reg=1.0, value_col='rating', tol=1e-3, **kwargs):
+    '''
+    Fits ALS on df, warm-started from earlier fits recorded in state
+    Returns model dict
+
+    state: dict kept by the caller across fits on the same df (start with {});
+           holds the collected matrices and the latest model of each rank and lambda
+    tol: convergence tolerance of warm-started fits (see fit)
+
+    Starts from the latest fit of the same rank (e.g. the previous lambda), otherwise from the
+    largest smaller rank fit with the same lambda (padded with noise), otherwise from random factors.
+    '''
+    csr, csc = train_matrices(state, df, value_col)
+
+    init = state['by_rank'].get(rank)
+    if init is None:
+        smaller = [m for m in state['by_reg'].get(reg, []) if m['rank'] < rank]
+        init = max(smaller, key=lambda m: m['rank']) if smaller else None
+
+    model = fit(csr, csc, rank=rank, reg=reg, value_col=value_col, init=init, 
+                tol=tol if init is not None else None, **kwargs)
+    print('Fit rank={}, lambda={} in {} iterations ({})'.format(rank, reg, model['iterations'],
+                'warm start from rank={}, lambda={}'.format(init['rank'], init['reg']) if init else 'random start'))
+
+    state['by_rank'][rank] = model
+    state['by_reg'][reg] = [m for m in state['by_reg'].get(reg, []) if m['rank']!=rank] + [model]
+    return model
+
+def recommend(model, user_ids, k=500, block_size=1024, seen=None):
+    '''
+    Returns users (original ids of the users that have factors),
+    books (n x k original book ids) and scores (n x k), highest score first
+
+    user_ids: array of original user ids (users without factors are dropped)
+    block_size: users per GEMM, see scoring.topk
+    seen: optional user x book CSR (e.g. train from csr.matrices_from_df); each user's
+          books in it are excluded from their top k (scores -inf where fewer than k are left)
+    '''
+    from scoring import topk, seen_items
+
+    user_ids = np.asarray(user_ids)
+    pos = np.searchsorted(model['user_ids'], user_ids)
+    pos = np.minimum(pos, len(model['user_ids']) - 1)
+    known = model['user_ids'][pos]==user_ids
+    users, rows = user_ids[known], pos[known]
+
+    exclude = None if seen is None else seen_items(seen, users, model['book_ids'])
+    top, scores = topk(model['user_factors'][rows], model['item_factors'], k, block_size, exclude)
+    return users, model['book_ids'][top], scores
+
+def recommend_ann(model, user_ids, k=500, nlist=None, nprobe=8, seen=None):
+    '''
+    Same as recommend, but approximate: searches an IVF index over the item factors (see ann.py)
+    Also returns valid (n x k boolean), False where a user had fewer than k candidates
+
+    The index is built on the first call and kept in model['ann_index'] (one per nlist),
+    so later calls on the same model only search
+    '''
+    from ann import build_index, search
+    from scoring import seen_items
+
+    user_ids = np.asarray(user_ids)
+    pos = np.searchsorted(model['user_ids'], user_ids)
+    pos = np.minimum(pos, len(model['user_ids']) - 1)
+    known = model['user_ids'][pos]==user_ids
+    users, rows = user_ids[known], pos[known]
+
+    exclude = None if seen is None else seen_items(seen, users, model['book_ids'])
+    indexes = model.setdefault('ann_index', {})
+    if nlist not in indexes:
+        indexes[nlist] = build_index(model['item_factors'], model['book_ids'], nlist=nlist)
+    index = indexes[nlist]
+    top, scores = search(index, model['user_factors'][rows], k, nprobe, exclude)
+    return users, model['book_ids'][np.maximum(top, 0)], scores, top >= 0
+
+def recs_to_df(spark, users, books, scores, valid=None):
+    '''
+    Returns spark df with the schema of ALSModel.recommendForUserSubset:
+        user_id, recommendations array<struct<book_id, rating>>
+
+    valid: optional boolean array like books, entries that are False are left out
+    '''
+    if valid is None:
+        rows = [(int(u), [(int(b), float(s)) for b, s in zip(bs, ss)]) for u, bs, ss in zip(users, books, scores)]
+    else:
+        rows = [(int(u), [(int(b), float(s)) for b, s, v in zip(bs, ss, vs) if v]) 
+                    for u, bs, ss, vs in zip(users, books, scores, valid)]
+    return spark.createDataFrame(rows, 'user_id INT, recommendations ARRAY<STRUCT<book_id: INT, rating: FLOAT>>')
+
+def benchmark_engines(spark, train, fraction, ranks=[100, 500], reg=1.0, implicit=True, 
+                      value_col='is_reviewed', alpha=1.0, max_iter=10):
+    '''
+    Times pyspark.ml ALS against numpy_als fits on train
+    Appends wall times to als_benchmark.txt
+
+    Spark fits are materialized by counting both factor dfs. The numpy times are
+    split into collecting train to the driver (once) and fitting.
+    '''
+    from time import localtime, strftime, time
+    from pyspark.ml.recommendation import ALS
+    from csr import matrices_from_df
+
+    start = time()
+    csr, csc = matrices_from_df(train, value_col=value_col)
+    collect_time = time() - start
+
+    model_type = 'implicit' if implicit else 'explicit'
+    for rank in ranks:
+        start = time()
+        als = ALS(rank=rank, regParam=reg, maxIter=max_iter, alpha=alpha, 
+                  userCol='user_id', itemCol='book_id', ratingCol=value_col, 
+                  implicitPrefs=implicit, coldStartStrategy='drop')
+        model = als.fit(train)
+        model.userFactors.count()
+        model.itemFactors.count()
+        spark_time = time() - start
+
+        start = time()
+        fit(csr, csc, rank=rank, reg=reg, max_iter=max_iter, value_col=value_col, 
+            implicit=implicit, alpha=alpha, verbose=False)
+        numpy_time = time() - start
+
+        line = '{}: {}% {} rank={} lambda={}: spark {:.1f}s, numpy {:.1f}s (+{:.1f}s collect)'\
+                    .format(strftime("%Y-%m-%d %H:%M:%S", localtime()), int(fraction*100), model_type, 
+                            rank, reg, spark_time, numpy_time, collect_time)
+        print(line)
+        f = open("als_benchmark.txt", "a")
+        f.write(line + '\n')
+        f.close()
+    return
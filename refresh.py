@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+'''
+Incremental refresh of a fitted ALS model after a delta of interactions
+
+A full refit solves every user and book for max_iter iterations. After a small delta,
+most factors barely move. refresh_model starts from the previous model's factors
+(new users and books start from random factors). It re-solves, with numpy_als's
+batched solves:
+    1. the books, then the users, touched by the delta (every row of the delta,
+       plus users and books that are new to train)
+    2. neighbour_sweeps more times, the touched books and users plus their neighbours:
+       users who interacted with a touched book and books a touched user interacted with
+Each solve uses the row's full history in the new train. Rows outside these sets keep
+their previous factors.
+
+ingest_delta only patches the fused splits, so the model to refresh is the one fit on
+them (main.py's refresh task keeps it under a '_fused' suffix). The refreshed model is
+saved as a new version next to the previous one, named by the training fingerprint of
+the patched splits, as a factor artifact (artifact.save_artifact) for the single-node
+consumers, and as an ALSModel:
+the previous model's metadata is copied and the factors are written in ALSModel's
+layout, so ALSModel.load and get_recs read it like any fitted model.
+compare_refresh measures the refresh against a full refit with eval's metrics.
+'''
+
+import numpy as np
+
+
+def align_factors(old_ids, old_factors, new_ids, seed=42):
+    '''
+    Returns factors for new_ids: the old factors where old_ids has the id,
+    random unit-norm rows otherwise, and a boolean array marking the ids that are new
+    '''
+    from numpy_als import init_factors
+
+    pos = np.minimum(np.searchsorted(old_ids, new_ids), len(old_ids) - 1)
+    known = old_ids[pos]==new_ids
+    factors = init_factors(len(new_ids), old_factors.shape[1], seed)
+    factors[known] = old_factors[pos[known]]
+    return factors, ~known
+
+def neighbours(matrix, rows):
+    '''
+    Returns the sorted unique column indices of the entries of rows in a CSR matrix
+    '''
+    indptr = matrix['indptr']
+    counts = indptr[rows + 1] - indptr[rows]
+    offsets = np.repeat(indptr[rows] - np.cumsum(np.r_[0, counts[:-1]]), counts)
+    return np.unique(matrix['indices'][offsets + np.arange(counts.sum())])
+
+def refresh_model(model, train, delta, reg=None, neighbour_sweeps=2, value_col='rating',
+                  implicit=None, alpha=None, cg_steps=3, num_threads=None, seed=42):
+    '''
+    Updates model to train (which already contains the delta) by re-solving only the users and
+    books touched by delta and their neighbours (see module docstring)
+    Returns new model dict with refreshed_users and refreshed_books counts
+
+    model: model dict of the previous fit (numpy_als.fit, artifact.load_artifact)
+    train: spark df with user_id, book_id and value_col, after the delta was ingested
+    delta: spark df with user_id and book_id of the new/changed interactions (ingest.read_delta)
+    reg: regularization parameter (the model's reg if None)
+    neighbour_sweeps: passes over the touched rows and their neighbours after the first solve
+    '''
+    from time import localtime, strftime
+    from csr import matrices_from_df, collect_columns
+    from numpy_als import make_blocks, sweep
+
+    reg = model.get('reg') if reg is None else reg
+    assert reg is not None, 'reg must be given for models without a recorded reg'
+    implicit = model.get('implicit', False) if implicit is None else implicit
+    alpha = model.get('alpha', 1.0) if alpha is None else alpha
+
+    csr, csc = matrices_from_df(train, value_col=value_col)
+    rank = model['item_factors'].shape[1]
+    user_factors, new_users = align_factors(model['user_ids'], model['user_factors'], csr['user_ids'], seed)
+    item_factors, new_books = align_factors(model['book_ids'], model['item_factors'], csr['book_ids'], seed + 1)
+
+    delta_users, delta_books = collect_columns(delta, ['user_id', 'book_id'], [np.int32, np.int32])
+    users = np.union1d(np.flatnonzero(new_users),
+                       np.flatnonzero(np.isin(csr['user_ids'], delta_users)))
+    books = np.union1d(np.flatnonzero(new_books),
+                       np.flatnonzero(np.isin(csr['book_ids'], delta_books)))
+
+    def solve(user_rows, book_rows):
+        sweep(csc, value_col, user_factors, reg, make_blocks(csc['indptr'], rank, rows=book_rows), num_threads,
+              implicit, alpha, item_factors, cg_steps, out=item_factors)
+        sweep(csr, value_col, item_factors, reg, make_blocks(csr['indptr'], rank, rows=user_rows), num_threads,
+              implicit, alpha, user_factors, cg_steps, out=user_factors)
+
+    print('{}: Re-solving {} touched users and {} touched books'.format(strftime("%Y-%m-%d %H:%M:%S", localtime()),
+                                                                        len(users), len(books)))
+    solve(users, books)
+
+    if neighbour_sweeps > 0:
+        users, books = np.union1d(users, neighbours(csc, books)), np.union1d(books, neighbours(csr, users))
+        print('{}: {} sweeps over {} users and {} books with neighbours'\
+                    .format(strftime("%Y-%m-%d %H:%M:%S", localtime()), neighbour_sweeps, len(users), len(books)))
+        for _ in range(neighbour_sweeps):
+            solve(users, books)
+
+    return {'user_factors': user_factors, 'item_factors': item_factors,
+            'user_ids': csr['user_ids'], 'book_ids': csr['book_ids'],
+            'rank': rank, 'reg': reg, 'implicit': implicit, 'alpha': alpha,
+            'refreshed_users': len(users), 'refreshed_books': len(books)}
+
+def save_als_model(spark, model, template_path, path, fingerprint=None):
+    '''
+    Saves the factors of a model dict as an ALSModel at path
+    Metadata (params, rank) is copied from the ALSModel at template_path
+
+    fingerprint: split_cache training fingerprint of the splits the model now matches,
+                 recorded like modeling.save_fitted_model does
+    '''
+    from storage import join, mark_written, write_text
+
+    spark.read.text(join(template_path, 'metadata')).coalesce(1).write.mode('overwrite').text(join(path, 'metadata'))
+    for name, ids, factors in [('userFactors', model['user_ids'], model['user_factors']),
+                               ('itemFactors', model['book_ids'], model['item_factors'])]:
+        rows = [(int(i), [float(x) for x in f]) for i, f in zip(ids, factors)]
+        spark.createDataFrame(rows, 'id INT, features ARRAY<FLOAT>').write.mode('overwrite').parquet(join(path, name))
+    mark_written(path)
+    if fingerprint is not None:
+        write_text(join(path, '_fingerprint'), fingerprint)
+    return
+
+def refreshed_model_path(model_path, fingerprint):
+    '''
+    Returns path of the refresh of the ALSModel at model_path to the splits with
+    training fingerprint (split_cache.training_fingerprint)
+    '''
+    assert fingerprint is not None, 'No saved interactions store, so there is nothing to refresh to (see ingest.py)'
+    return '{}_refresh_{}'.format(model_path.rstrip('/'), fingerprint[:12])
+
+def compare_refresh(spark, model, refreshed, train, val, fraction, rank, lamb, k=500, refresh_time=None):
+    '''
+    Evaluates the refreshed model, the stale model and a full spark refit on train against val
+    Appends MAP, NDCG at k, precision at k and fit times to refresh_benchmark.txt
+    '''
+    from time import localtime, strftime, time
+    from pyspark.ml.recommendation import ALS
+    from modeling import get_val_ids_and_true_labels, eval
+    from numpy_als import recommend, recs_to_df
+
+    val_ids, true_labels = get_val_ids_and_true_labels(spark, val)
+    true_labels.cache()
+    users = [row.user_id for row in val_ids.collect()]
+
+    start = time()
+    full = ALS(rank=rank, regParam=lamb, userCol='user_id', itemCol='book_id', ratingCol='rating',
+               coldStartStrategy='drop').fit(train)
+    full.userFactors.count()
+    refit_time = time() - start
+
+    results = []
+    for name, recs in [('stale', recs_to_df(spark, *recommend(model, users, k))),
+                       ('refresh', recs_to_df(spark, *recommend(refreshed, users, k))),
+                       ('refit', full.recommendForUserSubset(val_ids, k))]:
+        pred_labels = recs.select('user_id', 'recommendations.book_id')
+        mean_ap, ndcg_at_k, p_at_k = eval(spark, pred_labels, true_labels, fraction=fraction, rank=rank, lamb=lamb,
+                                          k=k, write_results=False)
+        results.append('{} MAP={:.5f} NDCG={:.5f} P={:.5f}'.format(name, mean_ap, ndcg_at_k, p_at_k))
+
+    line = '{}: {}% rank={} lambda={} k={} ({} users, {} books refreshed): {} (refresh {}, refit {:.1f}s)'\
+                .format(strftime("%Y-%m-%d %H:%M:%S", localtime()), int(fraction*100), rank, lamb, k,
+                        refreshed['refreshed_users'], refreshed['refreshed_books'], ', '.join(results),
+                        'n/a' if refresh_time is None else '{:.1f}s'.format(refresh_time), refit_time)
+    print(line)
+    f = open("refresh_benchmark.txt", "a")
+    f.write(line + '\n')
+    f.close()
+    return
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+'''
+Blocked top-k scoring of ALS factors, a replacement for ALSModel.recommendForUserSubset
+
+A block of user factors is multiplied with the whole item factor matrix in one GEMM
+(block x rank times rank x items). Each row's k best items are then picked with
+np.argpartition in O(items), and only those k are sorted. Spark's recommendForUserSubset
+instead cross-joins user and item factor blocks and feeds every score through a bounded
+priority queue per user.
+
+The same kernel runs:
+    - on a single node (topk on numpy arrays, used by numpy_als.recommend)
+    - inside mapPartitions over the user factors of an ALSModel, with the item factors
+      broadcast once to every executor (recommend_blocked)
+
+The number of users per block is capped so that the block x items score matrix
+stays under SCORE_ELEMENTS elements.
+
+Seen-item exclusion: a user's training books are kept as a sorted array of item
+positions, and all users together as one CSR-like pair (indptr, indices; see seen_items).
+The scores of those positions are set to -inf before argpartition. Filtering costs
+O(books the user has seen), not O(candidates), and the top k needs no over-fetching.
+'''
+
+import numpy as np
+
+# size budget (in float32 elements) of one block's score matrix
+SCORE_ELEMENTS = 1 << 25
+
+
+def block_rows(n_items, block_size=1024):
+    '''
+    Returns number of users to score at once against n_items items
+    '''
+    return max(1, min(block_size, SCORE_ELEMENTS // max(n_items, 1)))
+
+def topk_block(user_vecs, item_factors, k, exclude=None):
+    '''
+    Returns item indices (n x k) and scores (n x k) of the k highest scoring items
+    of each row of user_vecs, highest score first
+
+    exclude: optional (indptr, indices) of item positions to leave out of each row's top k
+             (see seen_items); rows with fewer than k other items are padded with -inf scores
+    '''
+    scores = user_vecs @ item_factors.T
+    k = min(k, scores.shape[1])
+    if exclude is not None:
+        indptr, indices = exclude
+        scores[np.repeat(np.arange(len(indptr) - 1), np.diff(indptr)), indices] = -np.inf
+
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind='stable')
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+def topk(user_factors, item_factors, k=500, block_size=1024, exclude=None):
+    '''
+    Returns item indices (n_users x k) and scores (n_users x k) of the top k items
+    of every row of user_factors, scored in blocks
+
+    exclude: optional seen items, dict with indptr and indices with one row per row of
+             user_factors (see seen_items)
+    '''
+    k = min(k, item_factors.shape[0])
+    rows = block_rows(item_factors.shape[0], block_size)
+
+    top = np.empty((user_factors.shape[0], k), dtype=np.int64)
+    scores = np.empty((user_factors.shape[0], k), dtype=np.float32)
+    for start in range(0, user_factors.shape[0], rows):
+        block_exclude = None if exclude is None else slice_rows(exclude, start, start + rows)
+        top[start:start + rows], scores[start:start + rows] = topk_block(user_factors[start:start + rows], item_factors, k,
+                                                                         block_exclude)
+    return top, scores
+
+def slice_rows(exclude, start, end):
+    '''
+    Returns (indptr, indices) of rows start:end of a seen items dict, indptr starting at 0
+    '''
+    indptr = exclude['indptr'][start:end + 1]
+    return indptr - indptr[0], exclude['indices'][indptr[0]:indptr[-1]]
+
+def take_rows(exclude, rows):
+    '''
+    Returns (indptr, indices) of the given rows (any order, repeats allowed) of a seen items dict
+    '''
+    starts = exclude['indptr'][rows]
+    counts = exclude['indptr'][rows + 1] - starts
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    offsets = np.repeat(starts - indptr[:-1], counts)
+    return indptr, exclude['indices'][offsets + np.arange(indptr[-1])]
+
+def seen_items(matrix, user_ids, book_ids):
+    '''
+    Returns the books each user has seen as dict of indptr and indices (sorted positions in
+    book_ids), one row per entry of user_ids (empty for users not in matrix)
+
+    matrix: user x book CSR of the training interactions (csr.matrices_from_df, csr.load_csr)
+    user_ids: original user ids, in the order their factors are scored
+    book_ids: sorted original book ids of the item factors (books missing from it are left out)
+    '''
+    user_ids = np.asarray(user_ids)
+    pos = np.minimum(np.searchsorted(matrix['user_ids'], user_ids), len(matrix['user_ids']) - 1)
+    known = matrix['user_ids'][pos]==user_ids
+    starts = matrix['indptr'][pos]
+    counts = np.where(known, matrix['indptr'][pos + 1] - starts, 0)
+
+    offsets = np.repeat(starts - np.cumsum(np.r_[0, counts[:-1]]), counts)
+    books = matrix['book_ids'][matrix['indices'][offsets + np.arange(counts.sum())]]
+    indptr, indices = book_positions(np.repeat(np.arange(len(user_ids)), counts), books, len(user_ids), book_ids)
+    return {'indptr': indptr, 'indices': indices}
+
+def seen_to_positions(seen_books, book_ids):
+    '''
+    Returns (indptr, indices) of sorted positions in book_ids for a list of
+    per-user sorted arrays of seen original book ids
+    '''
+    counts = [len(books) for books in seen_books]
+    books = np.asarray([b for books in seen_books for b in books], dtype=book_ids.dtype)
+    return book_positions(np.repeat(np.arange(len(seen_books)), counts), books, len(seen_books), book_ids)
+
+def book_positions(rows, books, n_rows, book_ids):
+    '''
+    Returns (indptr, indices) of the positions in book_ids of books, grouped by rows
+    Books missing from book_ids are left out; both id arrays being sorted,
+    positions stay sorted within a row
+    '''
+    pos = np.minimum(np.searchsorted(book_ids, books), len(book_ids) - 1)
+    in_model = book_ids[pos]==books
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows[in_model], minlength=n_rows), out=indptr[1:])
+    return indptr, pos[in_model]
+
+def factors_to_numpy(factors_df):
+    '''
+    Collects an ALSModel factor df (id, features) to the driver
+    Returns ids (int32, sorted) and factors (float32, one row per id)
+    '''
+    rows = factors_df.orderBy('id').collect()
+    ids = np.array([row.id for row in rows], dtype=np.int32)
+    factors = np.array([row.features for row in rows], dtype=np.float32)
+    return ids, factors
+
+def seen_lists(seen, user_col='user_id', item_col='book_id'):
+    '''
+    Returns df of id (user) and seen (sorted array of the user's books in seen),
+    to join next to the user factors of an ALSModel
+    '''
+    import pyspark.sql.functions as F
+    return seen.groupBy(F.col(user_col).alias('id')) \
+               .agg(F.array_sort(F.collect_set(item_col)).alias('seen'))
+
+def as_seen_lists(seen, user_col='user_id', item_col='book_id'):
+    '''
+    Returns seen as a df of id and seen: as is if it already is one (seen_lists,
+    modeling.seen_books), otherwise seen_lists of its user_col and item_col
+    '''
+    if 'seen' in seen.columns:
+        return seen
+    return seen_lists(seen, user_col, item_col)
+
+def recommend_blocked(spark, model, user_ids, k=500, block_size=1024, user_col='user_id', item_col='book_id',
+                      seen=None):
+    '''
+    Returns top k recommendations of an ALSModel for the users in user_ids, computed
+    in mapPartitions with broadcast item factors
+    Same schema as model.recommendForUserSubset(user_ids, k):
+        [user_col], recommendations array<struct<[item_col], rating>>
+
+    user_ids: df with a user_col column (users the model has no factors for are dropped)
+    block_size: users per GEMM (capped by SCORE_ELEMENTS)
+    seen: optional df with user_col and item_col (e.g. train), or its prebuilt lists of id and
+          seen (modeling.seen_books); each user's books in it are excluded from their top k
+    '''
+    import pyspark.sql.functions as F
+
+    item_ids, item_factors = factors_to_numpy(model.itemFactors)
+    item_ids_bc = spark.sparkContext.broadcast(item_ids)
+    item_factors_bc = spark.sparkContext.broadcast(item_factors)
+    rows = block_rows(len(item_ids), block_size)
+    # the closure must not capture the seen df, which cannot be pickled
+    exclude_seen = seen is not None
+
+    def score_partition(partition):
+        item_ids = item_ids_bc.value
+        item_factors = item_factors_bc.value
+
+        def emit(users, vecs, seen_books):
+            exclude = seen_to_positions(seen_books, item_ids) if exclude_seen else None
+            top, scores = topk_block(np.asarray(vecs, dtype=np.float32), item_factors, k, exclude)
+            for u, t, s in zip(users, item_ids[top], scores):
+                yield (int(u), [(int(b), float(r)) for b, r in zip(t, s) if r > -np.inf])
+
+        users, vecs, seen_books = [], [], []
+        for row in partition:
+            users.append(row[0])
+            vecs.append(row[1])
+            seen_books.append(row[2] or [])
+            if len(users)==rows:
+                for rec in emit(users, vecs, seen_books):
+                    yield rec
+                users, vecs, seen_books = [], [], []
+        if users:
+            for rec in emit(users, vecs, seen_books):
+                yield rec
+
+    subset = model.userFactors.join(F.broadcast(user_ids.select(F.col(user_col).alias('id')).distinct()), 'id')
+    if seen is not None:
+        subset = subset.join(as_seen_lists(seen, user_col, item_col), 'id', 'left').select('id', 'features', 'seen')
+    else:
+        subset = subset.select('id', 'features', F.lit(None).alias('seen'))
+    schema = '{} INT, recommendations ARRAY<STRUCT<{}: INT, rating: FLOAT>>'.format(user_col, item_col)
+    return spark.createDataFrame(subset.rdd.mapPartitions(score_partition), schema)
+
+def benchmark_topk(spark, train, val_ids, fraction, ranks=[10, 100, 500], ks=[10, 100, 500], lamb=1, max_iter=2):
+    '''
+    Times recommendForUserSubset against recommend_blocked
+    Appends wall times to topk_benchmark.txt
+
+    Models are fit with few iterations (max_iter): scoring cost only depends on the rank
+    and the numbers of users and items, not on how well the model fits.
+    Recommendations are materialized with count().
+    '''
+    from time import localtime, strftime, time
+    from pyspark.ml.recommendation import ALS
+
+    val_ids.cache()
+    n_users = val_ids.count()
+
+    for rank in ranks:
+        als = ALS(rank=rank, regParam=lamb, maxIter=max_iter,
+                  userCol='user_id', itemCol='book_id', ratingCol='rating', coldStartStrategy='drop')
+        model = als.fit(train)
+        model.userFactors.cache().count()
+        model.itemFactors.cache().count()
+
+        for k in ks:
+            timings = []
+            for name, recommend in [('recommendForUserSubset', lambda: model.recommendForUserSubset(val_ids, k)),
+                                    ('blocked', lambda: recommend_blocked(spark, model, val_ids, k))]:
+                start = time()
+                recommend().count()
+                timings.append('{} {:.1f}s'.format(name, time() - start))
+
+            line = '{}: {}% rank={} k={} ({} users): {}'.format(strftime("%Y-%m-%d %H:%M:%S", localtime()),
+                                                               int(fraction*100), rank, k, n_users, ', '.join(timings))
+            print(line)
+            f = open("topk_benchmark.txt", "a")
+            f.write(line + '\n')
+            f.close()
+
+        model.userFactors.unpersist()
+        model.itemFactors.unpersist()
+    return
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+'''
+Recommendation serving daemon over the factors of a saved ALS model
+
+Factors are opened from a memory-mapped artifact (artifact.load_artifact), so starting
+the daemon needs no Spark job.
+
+Protocol: line-delimited JSON over TCP, one request per line
+    request:  {"user_id": 123, "k": 10}
+              {"user_id": 123, "k": 10, "history": [[book_id, rating], ...]}
+    response: {"user_id": 123, "recommendations": [[book_id, score], ...]}
+              {"user_id": 123, "error": "unknown user"}
+Each connection gets its responses in request order; connections are served concurrently.
+
+The user and item factors are numpy arrays. Requests for known users are micro-batched
+(Batcher): the requests that arrive while a batch is being scored are scored together as
+the next batch, with one matrix product and argpartition (scoring.topk_block, see
+recommend_batch). A lone request is scored at once, so batching adds no wait; under load,
+batches grow with the number of requests in flight. Scoring runs in a thread pool so the
+event loop keeps reading requests while numpy (which releases the GIL) scores.
+Recent responses are kept in an LRU cache keyed by (user_id, k).
+If the model dict has seen items (scoring.seen_items over its user_ids), each user's
+training books are left out of their recommendations; a fold-in leaves out its history.
+Requests with a history are folded in against the item factors (see foldin.py)
+and scored like any other user, whether or not the model knows the user; this
+needs the model's reg.
+
+benchmark_serving replays a stream of requests over several concurrent connections
+and reports p50/p99 latency and throughput.
+'''
+
+import asyncio
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_K = 500
+
+
+class LRUCache:
+    '''
+    Bounded mapping that evicts the least recently used entry
+    '''
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class Batcher:
+    '''
+    Collects the requests that arrive while earlier ones are being scored and scores
+    them as one batch (see module docstring)
+    '''
+
+    def __init__(self, model, executor, max_batch=None, workers=1):
+        '''
+        max_batch: most requests per batch (scoring.block_rows of the model's items if None)
+        workers: batches scored at once
+        '''
+        from scoring import block_rows
+
+        self.model = model
+        self.executor = executor
+        self.max_batch = block_rows(len(model['book_ids'])) if max_batch is None else max_batch
+        self.workers = workers
+        self.pending = []
+        self.running = 0
+        self.batches = 0
+        self.requests = 0
+
+    def submit(self, user_id, k):
+        '''
+        Returns a future of the response dict of user_id's top k (see recommend_batch)
+        '''
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((user_id, k, future))
+        if self.running < self.workers:
+            self.running += 1
+            asyncio.ensure_future(self.drain())
+        return future
+
+    async def drain(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self.pending:
+                batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+                try:
+                    responses = await loop.run_in_executor(self.executor, recommend_batch, self.model,
+                                                           [u for u, _, _ in batch], [k for _, k, _ in batch])
+                except Exception as e:
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                self.batches += 1
+                self.requests += len(batch)
+                # futures of clients that disconnected meanwhile are cancelled
+                for (_, _, future), response in zip(batch, responses):
+                    if not future.done():
+                        future.set_result(response)
+        finally:
+            self.running -= 1
+
+
+def recommend_batch(model, user_ids, ks):
+    '''
+    Returns response dicts with the top k [book_id, score] pairs of each user_id,
+    scored with one topk_block call
+
+    user_ids: original user ids
+    ks: k of each user_id
+    '''
+    from scoring import topk_block, take_rows
+
+    ks = np.asarray(ks)
+    query = np.asarray(user_ids, dtype=model['user_ids'].dtype)
+    pos = np.minimum(np.searchsorted(model['user_ids'], query), len(model['user_ids']) - 1)
+    known = model['user_ids'][pos]==query
+    responses = [{'user_id': user_id, 'error': 'unknown user'} for user_id in user_ids]
+    if not known.any():
+        return responses
+
+    rows = pos[known]
+    exclude = None if model.get('seen') is None else take_rows(model['seen'], rows)
+    top, scores = topk_block(model['user_factors'][rows], model['item_factors'], int(ks[known].max()), exclude)
+    for i, user_top, user_scores in zip(np.flatnonzero(known), top, scores):
+        books = model['book_ids'][user_top[:ks[i]]]
+        responses[i] = {'user_id': user_ids[i],
+                        'recommendations': [[int(b), float(s)] for b, s in zip(books, user_scores[:ks[i]]) 
+                                                if s > -np.inf]}
+    return responses
+
+def recommend_one(model, user_id, k=DEFAULT_K):
+    '''
+    Returns response dict with the top k [book_id, score] pairs of user_id
+    '''
+    return recommend_batch(model, [user_id], [k])[0]
+
+def recommend_new_user(model, user_id, history, k=DEFAULT_K):
+    '''
+    Returns response dict with the top k [book_id, score] pairs of a user folded in
+    from history (see foldin.py)
+    '''
+    from foldin import recommend_fold_in
+
+    users, books, scores = recommend_fold_in(model, {user_id: history}, k, exclude_seen=True, num_threads=1)
+    if len(users)==0:
+        return {'user_id': user_id, 'error': 'no known books in history'}
+    return {'user_id': user_id,
+            'recommendations': [[int(b), float(s)] for b, s in zip(books[0], scores[0]) if s > -np.inf]}
+
+async def respond(model, cache, line, executor, batcher):
+    '''
+    Returns response dict to one request line, from the cache if possible
+    '''
+    try:
+        request = json.loads(line)
+        user_id = int(request['user_id'])
+        k = int(request.get('k', DEFAULT_K))
+        history = request.get('history')
+        if history is not None:
+            history = [(int(b), float(r)) for b, r in history]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return {'error': 'bad request'}
+    if k < 1:
+        return {'user_id': user_id, 'error': 'k must be positive'}
+
+    loop = asyncio.get_running_loop()
+    if history is not None:
+        # histories change between requests, so fold-ins are not cached
+        return await loop.run_in_executor(executor, recommend_new_user, model, user_id, history, k)
+
+    # ids the model's id dtype cannot hold are not in the model (and would fail the whole batch)
+    id_range = np.iinfo(model['user_ids'].dtype)
+    if not id_range.min <= user_id <= id_range.max:
+        return {'user_id': user_id, 'error': 'unknown user'}
+
+    key = (user_id, k)
+    response = cache.get(key)
+    if response is None:
+        response = await batcher.submit(user_id, k)
+        cache.put(key, response)
+    return response
+
+async def start_server(model, host='127.0.0.1', port=8765, cache_size=10000, num_threads=4, batch_workers=1):
+    '''
+    Starts serving model on host:port (port 0 picks a free port)
+    Returns the asyncio server, its LRUCache and its Batcher
+
+    num_threads: threads scoring batches and fold-ins
+    batch_workers: batches scored at once (see Batcher)
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    executor = ThreadPoolExecutor(num_threads)
+    cache = LRUCache(cache_size)
+    batcher = Batcher(model, executor, workers=batch_workers)
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = await respond(model, cache, line, executor, batcher)
+                except Exception as e:
+                    # one failed request does not close the connection
+                    response = {'error': 'internal error: {}'.format(type(e).__name__)}
+                writer.write((json.dumps(response) + '\n').encode('utf-8'))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    return server, cache, batcher
+
+def serve(model, host='127.0.0.1', port=8765, cache_size=10000, num_threads=4):
+    '''
+    Serves model until interrupted
+    '''
+    from time import localtime, strftime
+
+    async def run():
+        server, _, _ = await start_server(model, host, port, cache_size, num_threads)
+        print('{}: Serving {} users, {} books on {}:{}'.format(strftime("%Y-%m-%d %H:%M:%S", localtime()),
+                                                               len(model['user_ids']), len(model['book_ids']),
+                                                               host, port))
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    return
+
+async def replay(host, port, requests, concurrency=8):
+    '''
+    Sends requests over concurrency connections (round robin), one in flight per connection
+    Returns per-request latencies in seconds and the total wall time
+    '''
+    from time import perf_counter
+
+    async def client(lines):
+        reader, writer = await asyncio.open_connection(host, port)
+        latencies = []
+        for line in lines:
+            start = perf_counter()
+            writer.write(line)
+            await writer.drain()
+            await reader.readline()
+            latencies.append(perf_counter() - start)
+        writer.close()
+        return latencies
+
+    lines = [(json.dumps(r) + '\n').encode('utf-8') for r in requests]
+    start = perf_counter()
+    results = await asyncio.gather(*[client(lines[i::concurrency]) for i in range(concurrency)])
+    elapsed = perf_counter() - start
+    return np.concatenate([np.asarray(r) for r in results]), elapsed
+
+def replay_requests(user_ids, n_requests=10000, k=DEFAULT_K, skew=1.1, seed=42):
+    '''
+    Returns a request stream over user_ids with Zipf-like popularity (rank r drawn with weight r^-skew),
+    so that popular users repeat as they would in traffic
+    '''
+    rng = np.random.RandomState(seed)
+    user_ids = rng.permutation(np.asarray(user_ids))
+    weights = np.arange(1, len(user_ids) + 1, dtype=np.float64)**-skew
+    users = rng.choice(user_ids, n_requests, p=weights / weights.sum())
+    return [{'user_id': int(u), 'k': k} for u in users]
+
+def benchmark_serving(model, requests, fraction, rank, concurrency=[1, 8, 32], cache_sizes=[0, 10000], num_threads=4):
+    '''
+    Replays requests against an in-process server for every concurrency and cache size
+    Appends p50/p99 latency, throughput, cache hit rate and mean batch size to serve_benchmark.txt
+    '''
+    from time import localtime, strftime
+
+    async def run(n_clients, cache_size):
+        server, cache, batcher = await start_server(model, port=0, cache_size=cache_size, num_threads=num_threads)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            latencies, elapsed = await replay('127.0.0.1', port, requests, n_clients)
+        return latencies, elapsed, cache, batcher
+
+    for cache_size in cache_sizes:
+        for n_clients in concurrency:
+            latencies, elapsed, cache, batcher = asyncio.run(run(n_clients, cache_size))
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+            hit_rate = cache.hits / max(cache.hits + cache.misses, 1)
+            batch_size = batcher.requests / max(batcher.batches, 1)
+            line = '{}: {}% rank={} ({} requests) concurrency={} cache={}: p50={:.2f} ms, p99={:.2f} ms, {:.0f} requests/s, hit rate {:.2f}, batch {:.1f}'\
+                        .format(strftime("%Y-%m-%d %H:%M:%S", localtime()), int(fraction*100), rank, len(requests),
+                                n_clients, cache_size, p50, p99, len(requests) / elapsed, hit_rate, batch_size)
+            print(line)
+            f = open("serve_benchmark.txt", "a")
+            f.write(line + '\n')
+            f.close()
+    return
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+'''
+Fingerprinted cache of saved train/val/test splits
+
+Every saved split directory (see data_prep.split_paths) holds a _manifest.json:
+    params - every parameter the split was built with (fraction, seed, rm_zeros,
+             rm_unobserved, low_item_threshold, low_book_threshold, split_mode)
+    data_version - store_version of the interactions store it was derived from
+    fingerprint - hash of params and data_version
+    split - 'train', 'val' or 'test'
+    rows - row count when written (None after ingest_delta patched the split)
+    schema - spark schema json
+
+A split is published by writing it under a temporary name, adding the manifest
+and renaming the directory into place, so a directory at the split path is
+always complete (train, val and test are three renames, see publish_splits). read_cached_splits only serves splits whose three manifests
+match the expected fingerprint. Splits that are missing, have no manifest
+(partial or legacy writes), were built with other parameters or from older
+interactions are reported as a miss and rebuilt by read_sample_split_pq.
+
+Checking the cache only lists directories and reads the small json files,
+so a hit runs no Spark job.
+'''
+
+import json
+
+SPLITS = ['train', 'val', 'test']
+FULL_DATA = 'interactions_100_full.parquet'
+
+
+def split_params(fraction, seed=42, rm_zeros=True, rm_unobserved=True, low_item_threshold=10,
+                 low_book_threshold=0, split_mode='sampleBy'):
+    '''
+    Returns dict of the parameters that determine a split (the cache key)
+    '''
+    return {'fraction': int(fraction*100)/100,
+            'seed': seed,
+            'rm_zeros': bool(rm_zeros),
+            'rm_unobserved': bool(rm_unobserved),
+            'low_item_threshold': low_item_threshold,
+            'low_book_threshold': low_book_threshold,
+            'split_mode': split_mode}
+
+def data_version():
+    '''
+    Returns version of the interactions store splits are built from (None if not saved yet,
+    see ingest.store_version)
+    '''
+    from storage import data_path
+    from ingest import store_version
+    return store_version(data_path(FULL_DATA))
+
+def fingerprint(params, version):
+    '''
+    Returns hex fingerprint of split parameters and input data version
+    '''
+    from hashlib import sha1
+    key = json.dumps({'params': params, 'data_version': version}, sort_keys=True)
+    return sha1(key.encode('utf-8')).hexdigest()
+
+def training_fingerprint(fraction, **split_args):
+    '''
+    Returns the fingerprint of the splits of fraction built with split_args from the current
+    interactions data (None if the interactions store is not saved yet)
+    The same for a split read from the cache and one rebuilt with the same arguments.
+
+    split_args: split_params arguments the splits were read with (seed, low_item_threshold, ...)
+    '''
+    version = data_version()
+    if version is None:
+        return None
+    return fingerprint(split_params(fraction, **split_args), version)
+
+def manifest_path(path):
+    from storage import join
+    return join(path, '_manifest.json')
+
+def read_manifest(path):
+    '''
+    Returns manifest dict of the split at path, None if there is none
+    '''
+    from storage import path_exist, read_text
+    if not (path_exist(path) and path_exist(manifest_path(path))):
+        return None
+    return json.loads(read_text(manifest_path(path)))
+
+def is_valid(path, expected):
+    '''
+    Returns True if the split at path is complete and its manifest fingerprint is expected
+    '''
+    from storage import join, path_exist
+
+    manifest = read_manifest(path)
+    if manifest is None:
+        print('NOTICE: No manifest for {}'.format(path))
+        return False
+    if manifest['fingerprint']!=expected:
+        print('NOTICE: {} was built with other parameters or older data'.format(path))
+        return False
+    return path_exist(join(path, '_bucketing.json'))
+
+def read_cached_splits(spark, paths, params):
+    '''
+    Returns [train, val, test] dfs if all three splits at paths are valid for params,
+    None otherwise
+
+    paths: train, val, test paths (data_prep.split_paths)
+    params: dict from split_params
+    '''
+    from ingest import read_patched
+
+    version = data_version()
+    if version is None:
+        return None
+
+    expected = fingerprint(params, version)
+    if not all(is_valid(path, expected) for path in paths):
+        return None
+
+    print('Split cache hit ({})'.format(expected[:12]))
+    return [read_patched(spark, path) for path in paths]
+
+def stage_split(spark, df, path, split, params, version):
+    '''
+    Writes df as a bucketed split with its manifest under a temporary name next to path
+    Returns the temporary path (see commit_split)
+    '''
+    from data_prep import write_bucketed, bucketed_table_name
+    from storage import delete, write_text
+
+    tmp_path = path.rstrip('/') + '_publishing'
+    delete(tmp_path)
+
+    df = write_bucketed(spark, df, tmp_path)
+    manifest = {'params': params,
+                'data_version': version,
+                'fingerprint': fingerprint(params, version),
+                'split': split,
+                'rows': df.count(),
+                'schema': json.loads(df.schema.json())}
+    write_text(manifest_path(tmp_path), json.dumps(manifest))
+
+    # the table registered by write_bucketed points at the temporary location
+    spark.sql('DROP TABLE IF EXISTS {}'.format(bucketed_table_name(tmp_path)))
+    print('Staged {} ({} rows)'.format(tmp_path, manifest['rows']))
+    return tmp_path
+
+def commit_split(spark, tmp_path, path):
+    '''
+    Moves a split staged at tmp_path into place at path
+    Replaces any split (and its patches) already at path
+    Returns df read back from path
+    '''
+    from data_prep import read_bucketed, bucketed_table_name
+    from storage import rename, delete
+    from ingest import patches_path
+
+    spark.sql('DROP TABLE IF EXISTS {}'.format(bucketed_table_name(path)))
+    delete(path)
+    delete(patches_path(path))
+    rename(tmp_path, path)
+    print('Published {}'.format(path))
+    return read_bucketed(spark, path)
+
+def publish_split(spark, df, path, split, params, version=None):
+    '''
+    Writes df as a bucketed split with its manifest and moves it into place at path
+    Replaces any split (and its patches) already at path
+    Returns df read back from path
+
+    split: 'train', 'val' or 'test'
+    params: dict from split_params
+    version: data_version the split was built from (read now if None)
+    '''
+    if version is None:
+        version = data_version()
+    return commit_split(spark, stage_split(spark, df, path, split, params, version), path)
+
+def publish_splits(spark, splits, paths, params, version=None):
+    '''
+    Publishes train, val, test dfs to paths (see publish_split)
+    Returns [train, val, test] read back from paths
+
+    version: data_version the splits were built from (read now if None)
+
+    All three splits are written and staged before any of them is moved into place, so
+    the three renames run back to back after every Spark job has finished. They are still
+    three separate renames: a failure between them leaves some splits new and some old.
+    The old ones keep their old manifests, so read_cached_splits sees the fingerprints
+    disagree and rebuilds all three instead of serving a mix.
+    '''
+    if version is None:
+        version = data_version()
+    staged = [stage_split(spark, df, path, split, params, version)
+                for df, path, split in zip(splits, paths, SPLITS)]
+    return [commit_split(spark, tmp_path, path) for tmp_path, path in zip(staged, paths)]
+
+def refresh_manifest(path, version):
+    '''
+    Records that the split at path was patched to match interactions data version
+    (used by ingest_delta, which updates splits in place)
+    '''
+    from storage import write_text
+
+    manifest = read_manifest(path)
+    if manifest is None:
+        return
+    manifest['data_version'] = version
+    manifest['fingerprint'] = fingerprint(manifest['params'], version)
+    manifest['rows'] = None
+    write_text(manifest_path(path), json.dumps(manifest))
+    return
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+'''
+Storage helpers shared by data_prep, modeling and hybrid
+
+All paths are built from two roots:
+    data root - where the raw Goodreads csvs live
+                default: hdfs:/user/bm106/pub/goodreads
+                override with the GOODREADS_DATA environment variable or set_roots()
+    root - where parquet files, models and recommendations are written
+           default: hdfs:/user/[net_id]
+           override with the GOODREADS_ROOT environment variable or set_roots()
+
+Either root can be an hdfs: path or a local directory (plain path or file: url),
+so the whole pipeline can run on a single machine.
+
+Existence checks list the parent directory once and cache the listing for the run,
+instead of starting a new `hdfs dfs -test` JVM for every check.
+The cache is shared by the threads of a parallel tune, so it is only touched under a lock.
+'''
+
+import os
+import posixpath
+import threading
+
+# configured roots (None = use environment / default)
+_roots = {'root': None, 'data': None}
+
+# parent directory -> set of entry names, filled lazily by path_exist
+_listings = {}
+_listings_lock = threading.Lock()
+
+
+def set_roots(root=None, data_root=None):
+    '''
+    Sets where outputs are written (root) and where the raw csvs are read from (data_root)
+    Clears the existence cache
+
+    root, data_root: hdfs: paths or local directories. None keeps the current setting.
+    '''
+    if root is not None:
+        _roots['root'] = root.rstrip('/')
+    if data_root is not None:
+        _roots['data'] = data_root.rstrip('/')
+    invalidate()
+    return
+
+def get_root():
+    '''
+    Returns the directory that parquet files, models and recommendations are written to
+    '''
+    if _roots['root'] is None:
+        from getpass import getuser
+        _roots['root'] = os.environ.get('GOODREADS_ROOT', 'hdfs:/user/{}'.format(getuser())).rstrip('/')
+    return _roots['root']
+
+def get_data_root():
+    '''
+    Returns the directory the raw Goodreads csvs are read from
+    '''
+    if _roots['data'] is None:
+        _roots['data'] = os.environ.get('GOODREADS_DATA', 'hdfs:/user/bm106/pub/goodreads').rstrip('/')
+    return _roots['data']
+
+def data_path(name):
+    '''
+    Returns full path of an output file (parquet, model, recs) under the root
+
+    name: file or directory name, e.g. 'interactions_100_full.parquet'
+    '''
+    return join(get_root(), name)
+
+def source_path(name):
+    '''
+    Returns full path of a raw Goodreads file under the data root
+
+    name: e.g. 'goodreads_interactions.csv'
+    '''
+    return join(get_data_root(), name)
+
+def join(*parts):
+    return posixpath.join(*parts)
+
+def is_local(path):
+    '''
+    Returns True if path is on the local filesystem (plain path or file: url)
+    '''
+    return ':' not in path.split('/')[0] or path.startswith('file:')
+
+def local_path(path):
+    '''
+    Strips a file: scheme so that the path can be used with os functions
+    '''
+    if path.startswith('file://'):
+        return path[len('file://'):]
+    if path.startswith('file:'):
+        return path[len('file:'):]
+    return path
+
+def _list_dir(parent):
+    '''
+    Returns set of entry names in directory parent (empty if it does not exist)
+
+    Local directories use os.listdir.
+    Remote directories use the Hadoop FileSystem of the active SparkContext if there is one,
+    otherwise a single `hdfs dfs -ls` call.
+    '''
+    if is_local(parent):
+        parent = local_path(parent) or '.'
+        if not os.path.isdir(parent):
+            return set()
+        return set(os.listdir(parent))
+
+    from pyspark import SparkContext
+    sc = SparkContext._active_spark_context
+
+    if sc is not None:
+        jvm = sc._jvm
+        jpath = jvm.org.apache.hadoop.fs.Path(parent)
+        fs = jpath.getFileSystem(sc._jsc.hadoopConfiguration())
+        if not fs.exists(jpath):
+            return set()
+        return set(status.getPath().getName() for status in fs.listStatus(jpath))
+
+    import subprocess
+    proc = subprocess.Popen(['hdfs', 'dfs', '-ls', parent], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+    out, _ = proc.communicate()
+    if proc.returncode != 0:
+        return set()
+    # skip the 'Found n items' header, last field of each line is the full path
+    return set(posixpath.basename(line.split()[-1])
+                    for line in out.decode().splitlines() if line and not line.startswith('Found'))
+
+def path_exist(path):
+    '''
+    Returns True if path already exists
+    Returns False if path does not exist
+
+    path: filepath to check (hdfs: or local)
+
+    The parent directory is listed once per run and cached,
+    so repeated checks in the same directory are free.
+    '''
+    parent, name = posixpath.split(path.rstrip('/'))
+    with _listings_lock:
+        if parent not in _listings:
+            _listings[parent] = _list_dir(parent)
+        exists = name in _listings[parent]
+
+    if exists:
+        print(path, ' exists')
+        return True
+    else:
+        print(path, ' does not exist.')
+        return False
+
+def mark_written(path):
+    '''
+    Records that path now exists, so the cached listing of its parent stays correct
+    Call after writing a file or directory
+    '''
+    parent, name = posixpath.split(path.rstrip('/'))
+    with _listings_lock:
+        if parent in _listings:
+            _listings[parent].add(name)
+    return
+
+def invalidate(path=None):
+    '''
+    Drops cached directory listings
+
+    path: drop only the listing of this path's parent. Drops everything if None.
+    '''
+    with _listings_lock:
+        if path is None:
+            _listings.clear()
+        else:
+            _listings.pop(posixpath.split(path.rstrip('/'))[0], None)
+    return
+
+def _hadoop_fs(path):
+    '''
+    Returns (jvm, Hadoop FileSystem, Hadoop Path) for path using the active SparkContext
+    '''
+    from pyspark import SparkContext
+    sc = SparkContext._active_spark_context
+    assert sc is not None, 'An active SparkContext is needed to access {}'.format(path)
+
+    jvm = sc._jvm
+    jpath = jvm.org.apache.hadoop.fs.Path(path)
+    return jvm, jpath.getFileSystem(sc._jsc.hadoopConfiguration()), jpath
+
+def write_text(path, text):
+    '''
+    Writes a small text file (e.g. json metadata), overwriting it if it exists
+    '''
+    if is_local(path):
+        parent = os.path.dirname(local_path(path))
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        with open(local_path(path), 'w') as f:
+            f.write(text)
+    else:
+        jvm, fs, jpath = _hadoop_fs(path)
+        out = fs.create(jpath, True)
+        out.write(bytearray(text.encode('utf-8')))
+        out.close()
+    mark_written(path)
+    return
+
+def read_text(path):
+    '''
+    Returns contents of a small text file
+    '''
+    if is_local(path):
+        with open(local_path(path)) as f:
+            return f.read()
+
+    jvm, fs, jpath = _hadoop_fs(path)
+    stream = fs.open(jpath)
+    reader = jvm.java.io.BufferedReader(jvm.java.io.InputStreamReader(stream, 'UTF-8'))
+    lines = []
+    line = reader.readLine()
+    while line is not None:
+        lines.append(line)
+        line = reader.readLine()
+    reader.close()
+    return '\n'.join(lines)
+
+def list_dir(path):
+    '''
+    Returns sorted list of entry names in directory path (empty if it does not exist)
+    The listing is cached like path_exist's and kept up to date by mark_written
+    '''
+    path = path.rstrip('/')
+    with _listings_lock:
+        if path not in _listings:
+            _listings[path] = _list_dir(path)
+        return sorted(_listings[path])
+
+def rename(src, dst):
+    '''
+    Moves file or directory src to dst (dst must not exist)
+    On hdfs and local filesystems this is a single atomic metadata operation
+    '''
+    if is_local(src):
+        os.rename(local_path(src), local_path(dst))
+    else:
+        jvm, fs, jsrc = _hadoop_fs(src)
+        assert fs.rename(jsrc, jvm.org.apache.hadoop.fs.Path(dst)), 'Could not rename {} to {}'.format(src, dst)
+    invalidate(src)
+    mark_written(dst)
+    return
+
+def delete(path):
+    '''
+    Recursively deletes file or directory path if it exists
+    '''
+    if is_local(path):
+        import shutil
+        path_local = local_path(path)
+        if os.path.isdir(path_local):
+            shutil.rmtree(path_local)
+        elif os.path.exists(path_local):
+            os.remove(path_local)
+    else:
+        jvm, fs, jpath = _hadoop_fs(path)
+        fs.delete(jpath, True)
+    invalidate(path)
+    with _listings_lock:
+        _listings.pop(path.rstrip('/'), None)
+    return